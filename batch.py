@@ -0,0 +1,202 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from resources import available_memory, estimate_job_memory, BASE_JOB_BYTES
+
+# Parameters of run_pipeline that can be set in a manifest, with their types
+JOB_PARAMETERS = {
+    'building_outline': str,
+    'point_cloud': str,
+    'dsm': str,
+    'dtm': str,
+    'epsg': int,
+    'cell_size': float,
+    'cloth_resolution': float,
+    'slope': lambda value: value if isinstance(value, bool) else str(value).lower() in ('true', '1', 'yes'),
+    'output_format': str,
+    'compress': str,
+    'workers': int,
+    'workspace': str,
+    'scratch_dir': str,
+    'height_method': str,
+    'simplify_tolerance': float,
+    'min_area': float,
+    'sliver_ratio': float,
+    'stage_jobs': int,
+    'intermediate_format': str,
+    'resume': lambda value: value if isinstance(value, bool) else str(value).lower() in ('true', '1', 'yes'),
+}
+PATH_PARAMETERS = ('building_outline', 'point_cloud', 'dsm', 'dtm', 'scratch_dir')
+
+# Optional publishing of a job's buildings to PostGIS through a saved connection
+# profile, into its own table (the job name by default)
+PUBLISH_PARAMETERS = ('database_profile', 'database_table', 'database_mode')
+
+def read_manifest(manifest_path):
+    # Jobs from a JSON, YAML or CSV manifest as a list of dicts
+    extension = os.path.splitext(manifest_path)[1].lower()
+    if extension == '.csv':
+        with open(manifest_path, newline='') as f:
+            jobs = [dict(row) for row in csv.DictReader(f)]
+    elif extension in ('.yaml', '.yml'):
+        import yaml  # pip install pyyaml
+        with open(manifest_path) as f:
+            jobs = yaml.safe_load(f)
+    else:
+        with open(manifest_path) as f:
+            jobs = json.load(f)
+
+    # A manifest can be a plain list or hold the list under "jobs"
+    if isinstance(jobs, dict):
+        jobs = jobs.get('jobs', [])
+    return jobs
+
+def prepare_job(index, job, manifest_dir, output_root):
+    # Turn a manifest entry into a job name and run_pipeline parameters
+    name = str(job.get('name') or f"job_{index + 1}")
+    params = {}
+    for key, cast in JOB_PARAMETERS.items():
+        value = job.get(key)
+        if value is None or value == '':
+            continue
+        params[key] = cast(value)
+        if key in PATH_PARAMETERS:
+            params[key] = os.path.join(manifest_dir, params[key])
+    for key in PUBLISH_PARAMETERS:
+        if job.get(key):
+            params[key] = str(job[key])
+
+    # Jobs already run next to each other, so their stages run one after another unless
+    # the manifest asks otherwise
+    params.setdefault('stage_jobs', 1)
+
+    output_folder = job.get('output_folder') or os.path.join(output_root, name)
+    params['output_folder'] = os.path.join(manifest_dir, output_folder)
+    return name, params
+
+def publish_results(name, output_folder, database_profile, database_table=None, database_mode='replace', log=print,
+                    intermediate_format='gpkg'):
+    # Load the zonal statistics of a job with the shared engine of the profile
+    from vector_io import read_vector, intermediate_path
+    from connection import get_engine, load_profiles
+    from database import bulk_load, sync_table, content_hashes, HASH_COLUMN
+
+    profile = load_profiles().get(database_profile)
+    if profile is None:
+        raise ValueError(f"Unknown connection profile: {database_profile}")
+    if not profile["password"]:
+        log(f"Connection profile {database_profile} has no saved password (no system keyring when it was saved)")
+    engine = get_engine(profile)
+    gdf = read_vector(intermediate_path(output_folder, 'zonal stat', intermediate_format), layer='buildings')
+    table = database_table or name
+    if database_mode == 'sync':
+        sync_table(gdf, engine, table, log=log)
+    else:
+        gdf[HASH_COLUMN] = content_hashes(gdf)
+        bulk_load(gdf, engine, table, log=log)
+
+def run_batch_job(name, params):
+    # Run one job in a pool process with its output written to a log in its folder
+    from worker import run_job
+
+    publish = {key: params.pop(key) for key in PUBLISH_PARAMETERS if key in params}
+    os.makedirs(params['output_folder'], exist_ok=True)
+    status = {'status': 'done', 'error': None}
+    start = time.perf_counter()
+    with open(os.path.join(params['output_folder'], 'log.txt'), 'w') as log:
+        def emit(kind, message):
+            if kind in ('error', 'cancelled'):
+                status.update(status=kind, error=message.strip().splitlines()[-1])
+            if message and kind != 'progress':
+                log.write(f"[{kind}] {message}\n")
+                log.flush()
+        run_job(params, emit)
+
+        if publish and status['status'] == 'done':
+            try:
+                publish_results(name, params['output_folder'], log=lambda message: emit('log', message),
+                                intermediate_format=params.get('intermediate_format', 'gpkg'), **publish)
+            except Exception as e:
+                status.update(status='error', error=f"Publishing failed: {e}")
+                emit('log', status['error'])
+    return name, status['status'], time.perf_counter() - start, status['error']
+
+def run_batch(manifest_path, output_root, max_jobs=None, memory_limit=None):
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    output_root = os.path.abspath(output_root)
+    jobs = [prepare_job(index, job, manifest_dir, output_root) for index, job in enumerate(read_manifest(manifest_path))]
+    names = [name for name, params in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Job names in the manifest must be unique.")
+    max_jobs = max_jobs or os.cpu_count() or 1
+    memory_limit = memory_limit or available_memory()
+
+    # Estimated memory of every job, read from the inputs before scheduling
+    estimates = {}
+    for name, params in jobs:
+        try:
+            estimates[name] = estimate_job_memory(params)
+        except Exception:
+            estimates[name] = BASE_JOB_BYTES
+    print(f"{len(jobs)} jobs, up to {max_jobs} at a time within {memory_limit / 1024 ** 3:.1f} GB")
+
+    pending = list(jobs)
+    running = {}
+    results = []
+    with ProcessPoolExecutor(max_workers=max_jobs) as executor:
+        while pending or running:
+            # Admit pending jobs in manifest order while they fit in the memory budget,
+            # a job larger than the budget still runs once nothing else is running
+            used = sum(estimates[name] for name in running.values())
+            for job in list(pending):
+                name, params = job
+                if len(running) >= max_jobs:
+                    break
+                if running and used + estimates[name] > memory_limit:
+                    continue
+                pending.remove(job)
+
+                # Concurrent stages of the job stay within its estimate and its share of the cores
+                params = dict(params, memory_limit=estimates[name], max_cores=max(1, (os.cpu_count() or 1) // max_jobs))
+                running[executor.submit(run_batch_job, name, params)] = name
+                used += estimates[name]
+                print(f"Started {name} (estimated {estimates[name] / 1024 ** 3:.1f} GB)")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = (name, 'error', None, str(e))
+                results.append(result)
+                print(f"Finished {name}: {result[1]}")
+
+    # Per-job runtime and status
+    summary_path = os.path.join(output_root, 'batch_summary.csv')
+    os.makedirs(output_root, exist_ok=True)
+    folders = {name: params['output_folder'] for name, params in jobs}
+    with open(summary_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'status', 'runtime_s', 'estimated_memory_gb', 'output_folder', 'error'])
+        for name, status, runtime, error in results:
+            writer.writerow([name, status, f"{runtime:.1f}" if runtime is not None else '',
+                             f"{estimates[name] / 1024 ** 3:.2f}", folders[name], error or ''])
+    print(f"Summary written to {summary_path}")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate LOD1 for every job of a manifest')
+    parser.add_argument('--manifest', type=str, required=True, help='Job manifest (JSON, YAML or CSV)')
+    parser.add_argument('--output', type=str, required=True, help='Root directory for per-job output folders and the summary')
+    parser.add_argument('--max_jobs', type=int, help='Maximum number of jobs running at once (defaults to the CPU count)')
+    parser.add_argument('--memory_limit', type=float, help='Memory budget in GB for running jobs (defaults to the available memory)')
+    args = parser.parse_args()
+
+    memory_limit = args.memory_limit * 1024 ** 3 if args.memory_limit else None
+    results = run_batch(args.manifest, args.output, args.max_jobs, memory_limit)
+    sys.exit(0 if all(status == 'done' for _, status, _, _ in results) else 1)
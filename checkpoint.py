@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+
+# Checkpoints are kept in a hidden folder of the output directory
+CHECKPOINT_FOLDER = ".checkpoints"
+
+# Set by the worker so a running job can be cancelled at the next batch
+cancel_event = None
+
+class PipelineCancelled(Exception):
+    pass
+
+def check_cancelled():
+    if cancel_event is not None and cancel_event.is_set():
+        raise PipelineCancelled("Run cancelled by the user.")
+
+def file_signature(path):
+    # Size and modification time of an input, so a changed input invalidates checkpoints
+    if not path or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+def normalize(params):
+    # Same representation as after a JSON round trip (tuples become lists)
+    return json.loads(json.dumps(params))
+
+def write_json(path, data):
+    # Write through a temporary file so an interrupted write never leaves a partial checkpoint
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def clear_checkpoints(output_folder):
+    shutil.rmtree(os.path.join(output_folder, CHECKPOINT_FOLDER), ignore_errors=True)
+
+def is_stage_done(output_folder, stage, params):
+    # A stage is done when it completed with the same parameters and its outputs are still
+    # the files it wrote, not rewritten by another stage or run since
+    data = read_json(os.path.join(output_folder, CHECKPOINT_FOLDER, f"{stage}.json"))
+    if data is None or data.get("params") != normalize(params):
+        return False
+    if not all(os.path.exists(path) for path in data.get("outputs", [])):
+        return False
+    return data.get("signatures") == normalize([file_signature(path) for path in data.get("outputs", [])])
+
+def mark_stage_done(output_folder, stage, params, outputs):
+    os.makedirs(os.path.join(output_folder, CHECKPOINT_FOLDER), exist_ok=True)
+    write_json(os.path.join(output_folder, CHECKPOINT_FOLDER, f"{stage}.json"),
+               {"params": normalize(params), "outputs": outputs,
+                "signatures": [file_signature(path) for path in outputs]})
+
+def batch_folder(output_folder, stage, params):
+    # Folder holding the finished batches of a stage, emptied when the parameters changed
+    folder = os.path.join(output_folder, CHECKPOINT_FOLDER, stage)
+    params_path = os.path.join(folder, "params.json")
+    if read_json(params_path) != normalize(params):
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        write_json(params_path, normalize(params))
+    return folder
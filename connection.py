@@ -0,0 +1,127 @@
+import atexit
+import json
+import os
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+
+# Connection profiles are saved in the user's home directory without their passwords,
+# which go to the system keyring. Without a usable keyring a password is only kept for
+# the session and asked for again in the next one.
+PROFILES_PATH = os.path.join(os.path.expanduser("~"), ".simple3d", "profiles.json")
+KEYRING_SERVICE = "simple3d"
+
+# Pool settings of the shared engines, connections are checked on checkout
+POOL_SIZE = 5
+MAX_OVERFLOW = 5
+POOL_RECYCLE = 1800
+
+PROFILE_FIELDS = ("user", "password", "host", "port", "database")
+
+engines = {}
+engines_lock = threading.Lock()
+
+# Passwords of this session by profile name, for profiles whose password isn't in the keyring
+session_passwords = {}
+
+def connection_url(profile):
+    return URL.create("postgresql", username=profile["user"], password=profile["password"],
+                      host=profile.get("host") or "localhost", port=int(profile.get("port") or 5432),
+                      database=profile["database"])
+
+def get_engine(profile):
+    # One pooled engine per connection profile, shared by every caller in the process
+    url = connection_url(profile)
+    key = url.render_as_string(hide_password=False)
+    with engines_lock:
+        engine = engines.get(key)
+        if engine is None:
+            engine = create_engine(url, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+                                   pool_recycle=POOL_RECYCLE, pool_pre_ping=True)
+            engines[key] = engine
+    return engine
+
+def dispose_engines():
+    with engines_lock:
+        for engine in engines.values():
+            engine.dispose()
+        engines.clear()
+
+atexit.register(dispose_engines)
+
+def keyring_module():
+    try:
+        import keyring  # pip install keyring
+        return keyring
+    except ImportError:
+        return None
+
+def keyring_password(name):
+    keyring = keyring_module()
+    if keyring is None:
+        return None
+    try:
+        return keyring.get_password(KEYRING_SERVICE, name)
+    except Exception:
+        return None
+
+def store_password(name, password):
+    # Password into the keyring, False if there is no usable keyring. It is kept for the
+    # session either way.
+    session_passwords[name] = password
+    keyring = keyring_module()
+    if keyring is None:
+        return False
+    try:
+        keyring.set_password(KEYRING_SERVICE, name, password)
+        return True
+    except Exception:
+        return False
+
+def load_profiles():
+    # Saved profiles by name, with their passwords from the keyring or this session ("" if
+    # neither has one)
+    try:
+        with open(PROFILES_PATH) as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    # Profiles written by earlier versions held the password, it is moved out of the file
+    legacy = {name: profile.pop("password") for name, profile in profiles.items() if "password" in profile}
+    if legacy:
+        for name, password in legacy.items():
+            store_password(name, password)
+        write_profiles(profiles)
+
+    for name, profile in profiles.items():
+        password = session_passwords.get(name)
+        profile["password"] = password if password is not None else keyring_password(name) or ""
+    return profiles
+
+def save_profile(name, profile):
+    # Returns whether the password went to the keyring, otherwise it only lasts the session
+    profiles = load_profiles()
+    profiles[name] = {field: profile.get(field, "") for field in PROFILE_FIELDS}
+    write_profiles(profiles)
+    return store_password(name, profile.get("password", ""))
+
+def delete_profile(name):
+    profiles = load_profiles()
+    if profiles.pop(name, None) is not None:
+        session_passwords.pop(name, None)
+        keyring = keyring_module()
+        if keyring is not None:
+            try:
+                keyring.delete_password(KEYRING_SERVICE, name)
+            except Exception:
+                pass
+        write_profiles(profiles)
+
+def write_profiles(profiles):
+    # Profiles without their passwords
+    os.makedirs(os.path.dirname(PROFILES_PATH), exist_ok=True)
+    stored = {name: {field: value for field, value in profile.items() if field != "password"}
+              for name, profile in profiles.items()}
+    with open(PROFILES_PATH, "w") as f:
+        json.dump(stored, f, indent=2)
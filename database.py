@@ -1,14 +1,304 @@
 from PyQt5.QtWidgets import (
-    QApplication, QWidget, QLabel, QLineEdit, QPushButton, QVBoxLayout, QFileDialog, QMessageBox, QHBoxLayout, QTextEdit
+    QApplication, QWidget, QLabel, QLineEdit, QPushButton, QVBoxLayout, QFileDialog, QMessageBox, QHBoxLayout, QTextEdit,
+    QCheckBox, QSpinBox, QComboBox, QInputDialog
 )
 from PyQt5.QtGui import QIcon, QPixmap
-from sqlalchemy import create_engine
-import geopandas as gpd
+from PyQt5.QtCore import QThread, pyqtSignal
+from connection import PROFILE_FIELDS, get_engine, load_profiles, save_profile, delete_profile, session_passwords
+from vector_io import read_vector
+import pandas as pd
+import shapely
+import io
 import sys
+import time
+import hashlib
+import struct
+
+# Rows sent per COPY batch by default
+COPY_BATCH_SIZE = 50000
+
+# Column holding the content hash of each building, used by sync_table
+HASH_COLUMN = 'content_hash'
+
+# PostgreSQL column types of the pandas dtypes, anything else is loaded as text
+COLUMN_TYPES = {
+    'i': 'bigint',
+    'u': 'bigint',
+    'f': 'double precision',
+    'b': 'boolean',
+    'M': 'timestamp',
+}
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def copy_batches(gdf, srid, batch_size):
+    # CSV batches ready for COPY, geometries as hex EWKB which PostGIS parses directly
+    geometry_column = gdf.geometry.name
+    for start in range(0, len(gdf), batch_size):
+        batch = pd.DataFrame(gdf.iloc[start:start + batch_size].drop(columns=geometry_column))
+        geometries = shapely.set_srid(gdf.geometry.values[start:start + batch_size], srid)
+        batch[geometry_column] = shapely.to_wkb(geometries, hex=True, include_srid=True)
+        buffer = io.StringIO()
+        batch.to_csv(buffer, header=False, index=False)
+        buffer.seek(0)
+        yield len(batch), buffer
+
+def geodataframe_srid(gdf):
+    srid = gdf.crs.to_epsg() if gdf.crs is not None else 0
+    return srid or 0
+
+def copy_rows(cursor, gdf, load_table, batch_size, log=print):
+    # COPY the GeoDataFrame into an existing table in batches
+    srid = geodataframe_srid(gdf)
+    geometry_column = gdf.geometry.name
+    columns = [column for column in gdf.columns if column != geometry_column]
+    column_list = ", ".join(quote_identifier(column) for column in columns + [geometry_column])
+
+    loaded = 0
+    for count, buffer in copy_batches(gdf, srid, batch_size):
+        cursor.copy_expert(f"COPY {load_table} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+        loaded += count
+        log(f"Copied {loaded}/{len(gdf)} rows")
+    return loaded
+
+def bulk_load(gdf, engine, table='building', batch_size=COPY_BATCH_SIZE, staging=False, unlogged=False, log=print):
+    # Replace a PostGIS table with the GeoDataFrame using COPY in batches, then build
+    # the spatial index and refresh the planner statistics. With staging the rows go to a
+    # new table swapped in at the end, so the old table stays readable during the COPY. The
+    # table is created in the loading transaction, so with wal_level minimal the COPY
+    # skips the WAL either way. An unlogged table skips the WAL at any wal_level and stays
+    # unlogged, as SET LOGGED would write it all to the WAL again: it is emptied after a
+    # database crash and not replicated, which suits a table that can be loaded again.
+    srid = geodataframe_srid(gdf)
+    geometry_column = gdf.geometry.name
+    columns = [column for column in gdf.columns if column != geometry_column]
+    definitions = [f"{quote_identifier(column)} {COLUMN_TYPES.get(gdf[column].dtype.kind, 'text')}" for column in columns]
+    definitions.append(f"{quote_identifier(geometry_column)} geometry(Geometry, {srid})")
+
+    target = quote_identifier(table)
+    load_table = quote_identifier(f"{table}_staging") if staging else target
+
+    start_time = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"DROP TABLE IF EXISTS {load_table}")
+        cursor.execute(f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE {load_table} ({', '.join(definitions)})")
+
+        loaded = copy_rows(cursor, gdf, load_table, batch_size, log)
+
+        # Swap the staging table in as the target table
+        if staging:
+            cursor.execute(f"DROP TABLE IF EXISTS {target}")
+            cursor.execute(f"ALTER TABLE {load_table} RENAME TO {target}")
+
+        cursor.execute(f"CREATE INDEX {quote_identifier(f'{table}_{geometry_column}_idx')} ON {target} USING GIST ({quote_identifier(geometry_column)})")
+        connection.commit()
+
+        # ANALYZE after the commit so the statistics cover the committed rows
+        cursor.execute(f"ANALYZE {target}")
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    elapsed = time.perf_counter() - start_time
+    rate = loaded / elapsed if elapsed > 0 else 0
+    log(f"Loaded {loaded} rows in {elapsed:.1f} s ({rate:.0f} rows/s)")
+    return loaded
+
+def content_hashes(gdf, height_column='height'):
+    # Hash of the geometry and height of every building, used to find changed rows. A
+    # missing geometry hashes as empty WKB, so it still changes when a geometry is added.
+    # Geometries and heights are hashed as little-endian WKB and doubles, which don't depend
+    # on the platform or on how numpy prints floats.
+    wkbs = shapely.to_wkb(gdf.geometry.values, byte_order=1)
+    if height_column in gdf.columns:
+        heights = [struct.pack('<d', height) for height in gdf[height_column].to_numpy(dtype=float)]
+    else:
+        heights = [b''] * len(gdf)
+    return [hashlib.md5((wkb or b'') + height).hexdigest() for wkb, height in zip(wkbs, heights)]
+
+def key_column_of(gdf):
+    # Buildings are identified by their id column, as in the CityJSON output
+    for column in ('id', 'Id'):
+        if column in gdf.columns:
+            return column
+    raise ValueError("The data has no 'id' column to match buildings with.")
+
+def sync_table(gdf, engine, table='building', key_column=None, batch_size=COPY_BATCH_SIZE, log=print):
+    # Insert, update or delete only the buildings whose geometry or height changed,
+    # comparing content hashes with the ones stored in the table, in one transaction
+    key_column = key_column or key_column_of(gdf)
+    gdf = gdf.assign(**{HASH_COLUMN: content_hashes(gdf)})
+
+    target = quote_identifier(table)
+    key = quote_identifier(key_column)
+
+    start_time = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+
+        # First load of the table
+        cursor.execute("SELECT to_regclass(%s)", (target,))
+        if cursor.fetchone()[0] is None:
+            connection.close()
+            connection = None
+            bulk_load(gdf, engine, table, batch_size, log=log)
+            log(f"Table {table} did not exist, loaded all {len(gdf)} rows")
+            return len(gdf), 0, 0
+
+        # Tables loaded without hashes get the column, every row then counts as changed once
+        cursor.execute(f"ALTER TABLE {target} ADD COLUMN IF NOT EXISTS {quote_identifier(HASH_COLUMN)} text")
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s", (table,))
+        table_columns = {row[0] for row in cursor.fetchall()}
+        if table_columns != set(gdf.columns):
+            raise ValueError(f"The columns of {table} differ from the data, use a full import instead.")
+
+        # Compare the stored hashes with the new ones
+        cursor.execute(f"SELECT {key}, {quote_identifier(HASH_COLUMN)} FROM {target}")
+        stored = dict(cursor.fetchall())
+        keys = gdf[key_column].tolist()
+        changed = [stored.get(k, None) != h for k, h in zip(keys, gdf[HASH_COLUMN])]
+        deleted = list(set(stored) - set(keys))
+        changes = gdf[changed]
+        inserted = sum(1 for k in changes[key_column] if k not in stored)
+        updated = len(changes) - inserted
+
+        # Stage the changed rows and apply everything at once
+        columns = [quote_identifier(column) for column in gdf.columns]
+        cursor.execute(f"CREATE TEMP TABLE sync_staging (LIKE {target}) ON COMMIT DROP")
+        copy_rows(cursor, changes, "sync_staging", batch_size, log)
+        cursor.execute(f"UPDATE {target} AS t SET {', '.join(f'{c} = s.{c}' for c in columns)} "
+                       f"FROM sync_staging AS s WHERE t.{key} = s.{key}")
+        cursor.execute(f"INSERT INTO {target} ({', '.join(columns)}) SELECT {', '.join(f's.{c}' for c in columns)} "
+                       f"FROM sync_staging AS s WHERE NOT EXISTS (SELECT 1 FROM {target} AS t WHERE t.{key} = s.{key})")
+        if deleted:
+            cursor.execute(f"DELETE FROM {target} WHERE {key} = ANY(%s)", (deleted,))
+        connection.commit()
+    except Exception:
+        if connection is not None:
+            connection.rollback()
+        raise
+    finally:
+        if connection is not None:
+            connection.close()
+
+    elapsed = time.perf_counter() - start_time
+    log(f"Synced {table} in {elapsed:.1f} s: {inserted} inserted, {updated} updated, {len(deleted)} deleted")
+    return inserted, updated, len(deleted)
+
+class ProfileSelector(QWidget):
+    # Saved connection profiles, selecting one fills the connection fields of a tab
+    def __init__(self, user_input, password_input, host_input, port_input, database_input):
+        super().__init__()
+        self.inputs = dict(zip(PROFILE_FIELDS, (user_input, password_input, host_input, port_input, database_input)))
+
+        self.profile_label = QLabel("Connection Profile:")
+        self.profile_combo = QComboBox()
+        self.profile_combo.activated.connect(self.load_selected)
+        self.save_button = QPushButton("Save", self)
+        self.save_button.clicked.connect(self.save)
+        self.delete_button = QPushButton("Delete", self)
+        self.delete_button.clicked.connect(self.delete)
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.profile_label)
+        layout.addWidget(self.profile_combo, 1)
+        layout.addWidget(self.save_button)
+        layout.addWidget(self.delete_button)
+        self.setLayout(layout)
+        self.refresh()
+
+    def showEvent(self, event):
+        # Profiles saved from another tab show up when this tab is shown
+        self.refresh()
+        super().showEvent(event)
+
+    def refresh(self):
+        current = self.profile_combo.currentText()
+        self.profile_combo.clear()
+        self.profile_combo.addItem("")
+        self.profile_combo.addItems(sorted(load_profiles()))
+        self.profile_combo.setCurrentText(current)
+
+    def profile(self):
+        return {field: line_edit.text() for field, line_edit in self.inputs.items()}
+
+    def load_selected(self):
+        name = self.profile_combo.currentText()
+        profile = load_profiles().get(name)
+        if profile:
+            # A password outside the keyring is asked for once per session
+            if not profile["password"]:
+                password, ok = QInputDialog.getText(self, "Connection Profile", f"Password of {profile.get('user', '')} for {name}:",
+                                                    QLineEdit.Password)
+                if ok:
+                    session_passwords[name] = password
+                    profile["password"] = password
+            for field, line_edit in self.inputs.items():
+                line_edit.setText(str(profile.get(field, "")))
+
+    def save(self):
+        name, ok = QInputDialog.getText(self, "Save Connection Profile", "Profile name:", text=self.profile_combo.currentText())
+        if ok and name:
+            if not save_profile(name, self.profile()):
+                QMessageBox.warning(self, "Password Not Saved",
+                                    "No system keyring is available, so the password is not saved. It is kept until "
+                                    "Simple3D is closed and asked for when the profile is selected again.")
+            self.refresh()
+            self.profile_combo.setCurrentText(name)
+
+    def delete(self):
+        name = self.profile_combo.currentText()
+        if name:
+            delete_profile(name)
+            self.refresh()
+
+class ImportThread(QThread):
+    # Reads the buildings layer and loads or syncs it into the building table off the UI
+    # thread, log lines are passed on through output_signal and a failure is kept in error
+    output_signal = pyqtSignal(str)
+
+    def __init__(self, path, engine, sync, batch_size, staging, unlogged):
+        super().__init__()
+        self.path = path
+        self.engine = engine
+        self.sync = sync
+        self.batch_size = batch_size
+        self.staging = staging
+        self.unlogged = unlogged
+        self.error = None
+
+    def run(self):
+        try:
+            # Read GeoPackage file as GeoDataFrame
+            self.output_signal.emit(f"Reading GeoPackage file from: {self.path}")
+            gdf = read_vector(self.path, layer="buildings")
+            self.output_signal.emit("GeoPackage file successfully read.")
+
+            # Write GeoDataFrame to PostGIS table
+            self.output_signal.emit("Writing GeoDataFrame to PostGIS...")
+            if self.sync:
+                sync_table(gdf, self.engine, 'building', batch_size=self.batch_size, log=self.output_signal.emit)
+            else:
+                # Store the content hashes so later syncs only touch changed buildings
+                if 'height' in gdf.columns and ('id' in gdf.columns or 'Id' in gdf.columns):
+                    gdf[HASH_COLUMN] = content_hashes(gdf)
+                bulk_load(gdf, self.engine, 'building', self.batch_size, self.staging, self.unlogged,
+                          log=self.output_signal.emit)
+        except Exception as e:
+            self.error = str(e)
 
 class database_gui(QWidget):
     def __init__(self):
         super().__init__()
+        self.import_thread = None  # Import running in the background, None when idle
         self.init_ui()
 
     def init_ui(self):
@@ -47,6 +337,25 @@ class database_gui(QWidget):
         self.database_name_label = QLabel("Database:")
         self.database_name_input = QLineEdit()
 
+        # Saved connection profiles
+        self.profile_selector = ProfileSelector(self.user_input, self.password_input, self.host_input,
+                                                self.port_input, self.database_name_input)
+
+        # Bulk load options
+        self.batch_size_label = QLabel("Rows per COPY batch:")
+        self.batch_size_input = QSpinBox()
+        self.batch_size_input.setRange(1000, 10000000)
+        self.batch_size_input.setSingleStep(10000)
+        self.batch_size_input.setValue(COPY_BATCH_SIZE)
+        self.staging_checkbox = QCheckBox("Load through a staging table (keeps the old table readable)")
+        self.unlogged_checkbox = QCheckBox("Unlogged table (fastest, emptied after a database crash, not replicated)")
+
+        # Replace the whole table or only apply the changed buildings
+        self.mode_label = QLabel("Import Mode:")
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItem("Replace table")
+        self.mode_combo.addItem("Sync changes")
+
         # Submit Button
         self.submit_button = QPushButton("Import Data")
         self.submit_button.clicked.connect(self.import_data)
@@ -57,6 +366,7 @@ class database_gui(QWidget):
         self.log_console.setPlaceholderText("Console log...")
 
         # Add widgets to layout
+        layout.addWidget(self.profile_selector)
         layout.addWidget(self.user_label)
         layout.addWidget(self.user_input)
         layout.addWidget(self.password_label)
@@ -67,6 +377,12 @@ class database_gui(QWidget):
         layout.addWidget(self.port_input)
         layout.addWidget(self.database_name_label)
         layout.addWidget(self.database_name_input)
+        layout.addWidget(self.mode_label)
+        layout.addWidget(self.mode_combo)
+        layout.addWidget(self.batch_size_label)
+        layout.addWidget(self.batch_size_input)
+        layout.addWidget(self.staging_checkbox)
+        layout.addWidget(self.unlogged_checkbox)
         layout.addWidget(self.submit_button)
         layout.addWidget(self.log_console)
 
@@ -89,50 +405,67 @@ class database_gui(QWidget):
     def browse_geopackage(self):
         # Browse for GeoPackage file
         options = QFileDialog.Options()
-        file_path, _ = QFileDialog.getOpenFileName(self, "Select GeoPackage File", "", "GeoPackage Files (*.gpkg);;All Files (*)", options=options)
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select GeoPackage File", "", "GeoPackage Files (*.gpkg);;GeoParquet Files (*.parquet);;All Files (*)", options=options)
         if file_path:
             self.geopackage_input.setText(file_path)
 
     def import_data(self):
+        # Get user inputs
+        geopackage_path = self.geopackage_input.text()
+        user = self.user_input.text()
+        password = self.password_input.text()
+        host = self.host_input.text()
+        port = self.port_input.text()
+        database_name = self.database_name_input.text()
+
+        # Check if all inputs are provided
+        if not geopackage_path or not user or not password or not database_name:
+            self.log_console.append("Input Error: Please fill in all required fields.")
+            QMessageBox.warning(self, "Input Error", "Please fill in all required fields.")
+            return
+
+        # Shared pooled SQLAlchemy engine of the connection profile
+        self.log_console.append(f"Connecting to PostgreSQL database at {host}:{port}")
         try:
-            # Get user inputs
-            geopackage_path = self.geopackage_input.text()
-            layer_name = "buildings"
-            user = self.user_input.text()
-            password = self.password_input.text()
-            host = self.host_input.text()
-            port = self.port_input.text()
-            database_name = self.database_name_input.text()
-
-            # Check if all inputs are provided
-            if not geopackage_path or not layer_name or not user or not password or not database_name:
-                self.log_console.append("Input Error: Please fill in all required fields.")
-                QMessageBox.warning(self, "Input Error", "Please fill in all required fields.")
-                return
+            engine = get_engine(self.profile_selector.profile())
+        except Exception as e:
+            self.import_error(str(e))
+            return
 
-            # Read GeoPackage file as GeoDataFrame
-            self.log_console.append(f"Reading GeoPackage file from: {geopackage_path}")
-            gdf = gpd.read_file(geopackage_path, layer=layer_name)
-            self.log_console.append("GeoPackage file successfully read.")
+        # The import runs on its own thread, the form stays disabled until it is done so a
+        # second load can't start in the middle of the first one's transaction
+        self.import_thread = ImportThread(geopackage_path, engine, self.mode_combo.currentText() == "Sync changes",
+                                          self.batch_size_input.value(), self.staging_checkbox.isChecked(),
+                                          self.unlogged_checkbox.isChecked())
+        self.import_thread.output_signal.connect(self.log_message)
+        self.import_thread.finished.connect(self.import_finished)
+        self.set_inputs_enabled(False)
+        self.import_thread.start()
 
-            # Create an SQLAlchemy engine
-            connection_string = f'postgresql://{user}:{password}@{host}:{port}/{database_name}'
-            self.log_console.append(f"Connecting to PostgreSQL database at {host}:{port}")
-            engine = create_engine(connection_string)
+    def import_finished(self):
+        self.set_inputs_enabled(True)
+        error = self.import_thread.error
+        self.import_thread = None
+        if error is not None:
+            self.import_error(error)
+            return
+        self.log_console.append("Data successfully imported to the database!")
+        QMessageBox.information(self, "Success", "Data successfully imported to the database!")
 
-            # Write GeoDataFrame to PostGIS table
-            self.log_console.append("Writing GeoDataFrame to PostGIS...")
-            gdf.to_postgis(name='building', con=engine, if_exists='replace', index=False)
-            self.log_console.append("Data successfully imported to the database!")
+    def import_error(self, error):
+        # Log and show error message if something goes wrong
+        error_message = f"An error occurred: {error}"
+        self.log_console.append(error_message)
+        QMessageBox.critical(self, "Error", error_message)
 
-            # Show success message
-            QMessageBox.information(self, "Success", "Data successfully imported to the database!")
+    def set_inputs_enabled(self, enabled):
+        for widget in (self.profile_selector, self.geopackage_browse_button, self.user_input, self.password_input,
+                       self.host_input, self.port_input, self.database_name_input, self.mode_combo,
+                       self.batch_size_input, self.staging_checkbox, self.unlogged_checkbox, self.submit_button):
+            widget.setEnabled(enabled)
 
-        except Exception as e:
-            # Log and show error message if something goes wrong
-            error_message = f"An error occurred: {str(e)}"
-            self.log_console.append(error_message)
-            QMessageBox.critical(self, "Error", error_message)
+    def log_message(self, message):
+        self.log_console.append(message)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -1,15 +1,603 @@
 from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QAction, QFileDialog, QMessageBox, QGraphicsView, QGraphicsScene, QGraphicsLineItem, QGraphicsPolygonItem
+    QApplication, QMainWindow, QAction, QFileDialog, QMessageBox, QGraphicsView, QGraphicsScene, QGraphicsLineItem, QGraphicsPolygonItem,
+    QGraphicsPixmapItem, QGraphicsItem
 )
 from PyQt5.QtGui import (
-    QPixmap, QPolygonF, QImage, QPen, QColor, QBrush
+    QPixmap, QPolygonF, QImage, QPen, QColor, QBrush, QPainterPath
 )
-from PyQt5.QtCore import Qt, QPointF, QLineF
-from shapely.geometry import Polygon, mapping
+from PyQt5.QtCore import Qt, QPointF, QLineF, QRectF, QObject, QRunnable, QThreadPool, pyqtSignal
+from shapely.geometry import Polygon, Point
+import shapely
+import pandas as pd
+import geopandas as gpd
 import json
 import numpy as np
-from osgeo import gdal
+from osgeo import gdal, ogr, osr
 import sys
+import os
+import atexit
+import queue
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Orthophoto tiles are TILE_SIZE pixels wide at every overview level
+TILE_SIZE = 256
+
+# Threads decoding tiles and number of decoded tiles kept (about 200 KB each)
+TILE_THREADS = 4
+TILE_CACHE_SIZE = 512
+
+# Reads queued at a time while the overviews of an image are being built, when a zoomed out
+# view can cover thousands of full resolution tiles; the ones nearest the centre go first
+BUILDING_PENDING_TILES = 32
+
+# Cell size in image pixels of the outline index, and snapping distance in screen pixels
+INDEX_CELL_SIZE = 256
+SNAP_PIXELS = 8
+
+# Imported footprints are drawn in batches per render cell, RENDER_CELL_SIZE image pixels wide
+# at full detail and doubling with every coarser level along with the simplification tolerance
+RENDER_CELL_SIZE = 512
+FOOTPRINT_LEVELS = 7
+
+# Imported footprints within this many screen pixels of the cursor get editable items, once
+# zoomed in to at least EDIT_MIN_SCALE screen pixels per image pixel
+EDIT_RADIUS_PIXELS = 150
+EDIT_MIN_SCALE = 0.5
+
+# Layer of the autosave GeoPackage holding the outlines
+SESSION_LAYER = 'outlines'
+
+# Features converted and written at a time by the GeoJSON export
+GEOJSON_CHUNK_SIZE = 10000
+
+# Images larger than this (in pixels along either side) get overviews built if they have none,
+# down to a level smaller than one tile
+OVERVIEW_MIN_SIZE = 2048
+
+# Overviews built for an image are kept here, on a VRT of the image, so the image itself is
+# never written to
+OVERVIEW_CACHE = os.path.join(os.path.expanduser("~"), ".simple3d", "overviews")
+
+def level_band(dataset, number, level):
+    # Band of the full resolution image (level 0) or of overview level - 1
+    band = dataset.GetRasterBand(number)
+    return band if level == 0 else band.GetOverview(level - 1)
+
+def band_stretch(dataset):
+    # Approximate minimum and maximum of the displayed bands, used to stretch 16-bit and
+    # float images to 0-255. None for 8-bit images, which are shown as they are.
+    if dataset.GetRasterBand(1).DataType == gdal.GDT_Byte:
+        return None
+    return [dataset.GetRasterBand(number).ComputeRasterMinMax(True)
+            for number in range(1, min(dataset.RasterCount, 3) + 1)]
+
+def read_tile(dataset, level, x, y, stretch=None):
+    # RGB image of one tile, a single band is shown as grey
+    band = level_band(dataset, 1, level)
+    xoff, yoff = x * TILE_SIZE, y * TILE_SIZE
+    width, height = min(TILE_SIZE, band.XSize - xoff), min(TILE_SIZE, band.YSize - yoff)
+    bands = [level_band(dataset, number, level).ReadAsArray(xoff, yoff, width, height)
+             for number in range(1, min(dataset.RasterCount, 3) + 1)]
+    if stretch is not None:
+        bands = [np.clip((data.astype(np.float32) - low) * (255 / max(high - low, 1e-12)), 0, 255)
+                 for data, (low, high) in zip(bands, stretch)]
+    while len(bands) < 3:
+        bands.append(bands[-1])
+    rgb = np.ascontiguousarray(np.dstack(bands).astype(np.uint8))
+    return QImage(rgb.data, width, height, 3 * width, QImage.Format_RGB888).copy()
+
+# GDAL datasets can't be shared between threads, every tile thread opens its own
+thread_data = threading.local()
+
+def thread_dataset(path):
+    datasets = getattr(thread_data, 'datasets', None)
+    if datasets is None:
+        datasets = thread_data.datasets = {}
+    if path not in datasets:
+        datasets[path] = gdal.Open(path)
+    return datasets[path]
+
+class TileSignals(QObject):
+    # Key, decoded image (None if reading failed) and generation of a finished tile
+    loaded = pyqtSignal(object, object, int)
+
+class TileTask(QRunnable):
+    # Reads and decodes one tile on a pool thread
+    def __init__(self, path, key, generation, signals, stretch=None):
+        super().__init__()
+        self.path = path
+        self.key = key
+        self.stretch = stretch
+        self.generation = generation
+        self.signals = signals
+        self.setAutoDelete(False)
+
+    def run(self):
+        try:
+            image = read_tile(thread_dataset(self.path), *self.key, self.stretch)
+        except Exception:
+            image = None
+        self.signals.loaded.emit(self.key, image, self.generation)
+
+class TileLayer:
+    # Shows an orthophoto as tiles of the overview level matching the current zoom, reading only
+    # the tiles in view with windowed reads. Scene coordinates are full resolution pixels.
+    # Tiles are decoded on a thread pool and kept in an LRU cache of decoded images, and the
+    # tiles a pan is heading towards are read ahead. With max_pending, at most that many reads
+    # are queued at a time and more are queued as they finish.
+    def __init__(self, path, dataset, scene, max_pending=None):
+        self.path = path
+        self.scene = scene
+        self.max_pending = max_pending
+        self.width = dataset.RasterXSize
+        self.height = dataset.RasterYSize
+        self.stretch = band_stretch(dataset)
+        self.items = {}
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.needed = set()
+        self.queue = []
+        self.last_center = None
+        self.last_level = None
+        self.generation = 0
+
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(TILE_THREADS)
+        self.signals = TileSignals()
+        self.signals.loaded.connect(self.tile_loaded)
+
+        # Level 0 is the full resolution, level i the overview i - 1, each with its size
+        band = dataset.GetRasterBand(1)
+        self.levels = [(self.width, self.height)]
+        for index in range(band.GetOverviewCount()):
+            overview = band.GetOverview(index)
+            self.levels.append((overview.XSize, overview.YSize))
+
+    def level_for_scale(self, scale):
+        # Coarsest level that still has at least one image pixel per screen pixel
+        best = 0
+        for level, (width, height) in enumerate(self.levels):
+            if self.width / width <= 1 / scale:
+                best = level
+        return best
+
+    def visible_tiles(self, rect, level):
+        # Tile keys of a level covering a scene rectangle
+        level_width, level_height = self.levels[level]
+        factor_x, factor_y = self.width / level_width, self.height / level_height
+        rect = rect.intersected(QRectF(0, 0, self.width, self.height))
+        if rect.isEmpty():
+            return []
+        x0 = max(int(rect.left() / factor_x // TILE_SIZE), 0)
+        y0 = max(int(rect.top() / factor_y // TILE_SIZE), 0)
+        x1 = min(int(math.ceil(rect.right() / factor_x / TILE_SIZE)), int(math.ceil(level_width / TILE_SIZE)))
+        y1 = min(int(math.ceil(rect.bottom() / factor_y / TILE_SIZE)), int(math.ceil(level_height / TILE_SIZE)))
+        return [(level, x, y) for y in range(y0, y1) for x in range(x0, x1)]
+
+    def tile_rect(self, key):
+        level, x, y = key
+        level_width, level_height = self.levels[level]
+        factor_x, factor_y = self.width / level_width, self.height / level_height
+        return QRectF(x * TILE_SIZE * factor_x, y * TILE_SIZE * factor_y, TILE_SIZE * factor_x, TILE_SIZE * factor_y)
+
+    def add_tile(self, key, image):
+        level, x, y = key
+        level_width, level_height = self.levels[level]
+        item = QGraphicsPixmapItem(QPixmap.fromImage(image))
+        item.setPos(self.tile_rect(key).topLeft())
+        item.setTransform(item.transform().scale(self.width / level_width, self.height / level_height))
+        item.setZValue(-1 - level)  # Under the outlines, finer levels on top
+        self.scene.addItem(item)
+        self.items[key] = item
+
+    def request(self, key, priority):
+        if key in self.pending:
+            return
+        if self.max_pending is not None and len(self.pending) >= self.max_pending:
+            return
+        task = TileTask(self.path, key, self.generation, self.signals, self.stretch)
+        self.pending[key] = task
+        self.pool.start(task, priority)
+
+    def update(self, rect, scale):
+        # Show the tiles in view at the level of the zoom, from the cache or the thread pool
+        level = self.level_for_scale(scale)
+        keys = self.visible_tiles(rect, level)
+        self.needed = set(keys)
+        if self.max_pending is not None:
+            center = rect.center()
+            keys.sort(key=lambda key: (self.tile_rect(key).center() - center).manhattanLength())
+        self.queue = []
+        for key in keys:
+            if key in self.items:
+                continue
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.add_tile(key, self.cache[key])
+            else:
+                self.queue.append(key)
+        self.request_queued()
+
+        # Read ahead one screen in the direction of the pan, unless the reads are capped
+        center = rect.center()
+        wanted = set(self.needed)
+        if self.last_center is not None and level == self.last_level and self.max_pending is None:
+            dx, dy = center.x() - self.last_center.x(), center.y() - self.last_center.y()
+            if dx or dy:
+                ahead = rect.translated(math.copysign(rect.width(), dx) if dx else 0,
+                                        math.copysign(rect.height(), dy) if dy else 0)
+                for key in self.visible_tiles(ahead, level):
+                    wanted.add(key)
+                    if key not in self.cache and key not in self.items:
+                        self.request(key, 0)
+        self.last_center = center
+        self.last_level = level
+
+        # Reads that haven't started and are no longer wanted are dropped
+        for key in [key for key in self.pending if key not in wanted]:
+            if self.pool.tryTake(self.pending[key]):
+                del self.pending[key]
+
+        self.drop_stale_items(rect)
+
+    def request_queued(self):
+        # Queue reads of the tiles in view that are neither shown nor read yet
+        self.queue = [key for key in self.queue if key in self.needed and key not in self.items]
+        for key in self.queue:
+            if self.max_pending is not None and len(self.pending) >= self.max_pending:
+                break
+            self.request(key, 1)
+
+    def drop_stale_items(self, rect):
+        # Tiles out of view go at once, tiles of another level stay under the view until
+        # every tile of the current level has arrived
+        complete = all(key in self.items for key in self.needed)
+        for key in [key for key in self.items if key not in self.needed]:
+            if complete or not self.tile_rect(key).intersects(rect):
+                self.scene.removeItem(self.items.pop(key))
+
+    def tile_loaded(self, key, image, generation):
+        if generation != self.generation:
+            return
+        self.pending.pop(key, None)
+        if self.max_pending is not None:
+            self.request_queued()
+        if image is None:
+            return
+        self.cache[key] = image
+        self.cache.move_to_end(key)
+        while len(self.cache) > TILE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        if key in self.needed and key not in self.items:
+            self.add_tile(key, image)
+            if all(key in self.items for key in self.needed):
+                self.drop_stale_items(QRectF(0, 0, self.width, self.height))
+
+    def clear(self):
+        # Results of reads still running are ignored through the generation
+        self.generation += 1
+        self.pool.clear()
+        self.pending = {}
+        self.queue = []
+        self.cache.clear()
+        for item in self.items.values():
+            self.scene.removeItem(item)
+        self.items = {}
+
+class GridIndex:
+    # Dynamic spatial index of outline bounds in scene pixels: a hash grid of cells to ids, so
+    # inserts, deletes and point or box queries only touch the cells involved
+    def __init__(self, cell_size=INDEX_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.bounds = {}
+
+    def cell_range(self, minx, miny, maxx, maxy):
+        size = self.cell_size
+        for cx in range(int(minx // size), int(maxx // size) + 1):
+            for cy in range(int(miny // size), int(maxy // size) + 1):
+                yield cx, cy
+
+    def insert(self, item_id, bounds):
+        self.bounds[item_id] = bounds
+        for cell in self.cell_range(*bounds):
+            self.cells.setdefault(cell, set()).add(item_id)
+
+    def remove(self, item_id):
+        bounds = self.bounds.pop(item_id, None)
+        if bounds is None:
+            return
+        for cell in self.cell_range(*bounds):
+            ids = self.cells.get(cell)
+            if ids is not None:
+                ids.discard(item_id)
+                if not ids:
+                    del self.cells[cell]
+
+    def query(self, minx, miny, maxx, maxy):
+        # Ids whose bounds intersect the box
+        found = set()
+        for cell in self.cell_range(minx, miny, maxx, maxy):
+            found.update(self.cells.get(cell, ()))
+        return [item_id for item_id in found
+                if self.bounds[item_id][0] <= maxx and self.bounds[item_id][2] >= minx
+                and self.bounds[item_id][1] <= maxy and self.bounds[item_id][3] >= miny]
+
+class FootprintLayer(QGraphicsItem):
+    # Draws imported footprints as one cached QPainterPath per render cell and level of detail,
+    # only for the cells in view. Footprints are assigned to the cell holding their centre, the
+    # ones with an editable item of their own are left out.
+    def __init__(self, geometries, index, rect, editable_ids):
+        super().__init__()
+        self.geometries = geometries
+        self.index = index
+        self.editable_ids = editable_ids
+        self.rect = rect
+        self.paths = {}
+        self.pen = QPen(QColor(255, 0, 0), 0)
+        self.brush = QBrush(QColor(255, 0, 0, 60))
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.setZValue(-0.5)  # Over the orthophoto, under the editable outlines
+
+    def boundingRect(self):
+        return self.rect
+
+    def extend(self, rect):
+        self.prepareGeometryChange()
+        self.rect = self.rect.united(rect)
+
+    def level_for_scale(self, scale):
+        # Simplification tolerance of 2 ** level image pixels stays around one screen pixel
+        if scale >= 1:
+            return 0
+        return min(int(math.log2(1 / scale)), FOOTPRINT_LEVELS - 1)
+
+    def cell_path(self, level, cx, cy):
+        key = (level, cx, cy)
+        if key in self.paths:
+            return self.paths[key]
+        size = RENDER_CELL_SIZE * 2 ** level
+        minx, miny = cx * size, cy * size
+        ids = []
+        for polygon_id in self.index.query(minx, miny, minx + size, miny + size):
+            if not self.geometries[polygon_id].get("imported") or polygon_id in self.editable_ids:
+                continue
+            bounds = self.index.bounds[polygon_id]
+            centre_x, centre_y = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
+            if minx <= centre_x < minx + size and miny <= centre_y < miny + size:
+                ids.append(polygon_id)
+
+        pixels = np.array([self.geometries[polygon_id]["pixels"] for polygon_id in ids], dtype=object)
+        if level and len(pixels):
+            pixels = shapely.simplify(pixels, 2 ** level, preserve_topology=False)
+        # Exterior rings of the whole cell in one go, one subpath per footprint
+        path = QPainterPath()
+        pixels = pixels[shapely.get_type_id(pixels) == 3] if len(pixels) else pixels
+        if len(pixels):
+            coords, ring = shapely.get_coordinates(shapely.get_exterior_ring(pixels), return_index=True)
+            ends = np.cumsum(np.bincount(ring, minlength=len(pixels))).tolist()
+            points = [QPointF(x, y) for x, y in coords.tolist()]
+            start = 0
+            for end in ends:
+                if end - start > 2:
+                    path.addPolygon(QPolygonF(points[start:end]))
+                    path.closeSubpath()
+                start = end
+        self.paths[key] = path
+        return path
+
+    def paint(self, painter, option, widget=None):
+        transform = painter.worldTransform()
+        level = self.level_for_scale(transform.m11())
+        size = RENDER_CELL_SIZE * 2 ** level
+        # Exposed part of the layer that is also on the painted device
+        visible = transform.inverted()[0].mapRect(QRectF(painter.viewport()))
+        exposed = option.exposedRect.intersected(self.rect).intersected(visible)
+        if exposed.isEmpty():
+            return
+        painter.setPen(self.pen)
+        painter.setBrush(self.brush)
+        for cx in range(int(exposed.left() // size), int(exposed.right() // size) + 1):
+            for cy in range(int(exposed.top() // size), int(exposed.bottom() // size) + 1):
+                painter.drawPath(self.cell_path(level, cx, cy))
+
+    def invalidate(self, bounds):
+        # Drop the cached paths holding a footprint at every level
+        centre_x, centre_y = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
+        for level in range(FOOTPRINT_LEVELS):
+            size = RENDER_CELL_SIZE * 2 ** level
+            self.paths.pop((level, int(centre_x // size), int(centre_y // size)), None)
+        self.update(QRectF(bounds[0], bounds[1], bounds[2] - bounds[0], bounds[3] - bounds[1]))
+
+def bounds_rect(bounds):
+    # Scene rectangle around an array of minx, miny, maxx, maxy rows
+    return QRectF(bounds[:, 0].min(), bounds[:, 1].min(),
+                  bounds[:, 2].max() - bounds[:, 0].min(), bounds[:, 3].max() - bounds[:, 1].min())
+
+def same_projection(first, second):
+    # Whether two WKT projections are the same SRS, images without one only match each other
+    if not first or not second:
+        return not first and not second
+    first_srs, second_srs = osr.SpatialReference(), osr.SpatialReference()
+    first_srs.ImportFromWkt(first)
+    second_srs.ImportFromWkt(second)
+    return bool(first_srs.IsSame(second_srs))
+
+def open_session_layer(path, projection):
+    # Outline layer of a session GeoPackage, created with the image SRS if missing
+    datasource = ogr.Open(path, 1) if os.path.exists(path) else ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    if datasource is None:
+        raise RuntimeError(f"Can't open {path} for writing")
+    layer = datasource.GetLayerByName(SESSION_LAYER)
+    if layer is None:
+        srs = None
+        if projection:
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(projection)
+        layer = datasource.CreateLayer(SESSION_LAYER, srs, ogr.wkbUnknown, options=['FID=id'])
+        layer.CreateField(ogr.FieldDefn('properties', ogr.OFTString))
+    return datasource, layer
+
+class SessionSignals(QObject):
+    # Error of a failed autosave write, after which the session is paused
+    failed = pyqtSignal(str)
+
+class GeoPackageSession:
+    # Keeps a GeoPackage layer in step with the outlines. Inserts and deletes are queued and
+    # committed as their own transactions by a background thread that owns the OGR datasource,
+    # so the UI never waits on the disk. A failed write pauses the session: it and the changes
+    # queued after it are held, in order, until retry() writes them again.
+    def __init__(self, path, projection):
+        self.path = path
+        self.projection = projection
+        self.error = None
+        self.held = []
+        self.signals = SessionSignals()
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def insert(self, rows):
+        # Rows of id, geometry in map coordinates and properties, written in one transaction
+        if rows:
+            self.tasks.put(('insert', [(polygon_id, shapely.to_wkb(geometry), json.dumps(properties))
+                                       for polygon_id, geometry, properties in rows]))
+
+    def delete(self, polygon_id):
+        self.tasks.put(('delete', polygon_id))
+
+    def retry(self):
+        self.tasks.put(('retry', None))
+
+    def close(self):
+        # Waits for the queued changes to be written
+        if self.thread.is_alive():
+            self.tasks.put(None)
+            self.thread.join()
+
+    def write(self, layer, task):
+        kind, payload = task
+        layer.StartTransaction()
+        try:
+            if kind == 'insert':
+                for polygon_id, wkb, properties in payload:
+                    feature = ogr.Feature(layer.GetLayerDefn())
+                    feature.SetFID(polygon_id)
+                    feature.SetField('properties', properties)
+                    feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
+                    if layer.CreateFeature(feature) != 0:
+                        raise RuntimeError(f"Can't insert outline {polygon_id}")
+            elif layer.DeleteFeature(payload) != 0:
+                raise RuntimeError(f"Can't delete outline {payload}")
+            layer.CommitTransaction()
+        except Exception:
+            layer.RollbackTransaction()
+            raise
+
+    def run(self):
+        # The datasource is opened again on retry when opening it failed
+        datasource, layer = None, None
+        paused = False
+        try:
+            datasource, layer = open_session_layer(self.path, self.projection)
+        except Exception as e:
+            paused = True
+            self.error = str(e)
+            self.signals.failed.emit(self.error)
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            if task[0] == 'retry':
+                batch, self.held, paused = self.held, [], False
+            elif paused:
+                self.held.append(task)
+                continue
+            else:
+                batch = [task]
+            for index, task in enumerate(batch):
+                try:
+                    if layer is None:
+                        datasource, layer = open_session_layer(self.path, self.projection)
+                    self.write(layer, task)
+                except Exception as e:
+                    self.held, paused = batch[index:], True
+                    self.error = str(e)
+                    self.signals.failed.emit(self.error)
+                    break
+        layer = None
+        datasource = None
+
+def overview_path(path):
+    # Cached VRT of an image, named after its path, size and modification time
+    stat = os.stat(path)
+    key = hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_size}|{int(stat.st_mtime)}".encode()).hexdigest()
+    return os.path.join(OVERVIEW_CACHE, f"{key}.vrt")
+
+def build_overviews(path, vrt_path, callback=None):
+    # Average overviews halving the size down to one tile, written next to a VRT of the image
+    # under temporary names of this thread and renamed once complete. Compression is passed to
+    # this build only, the global GDAL configuration is left alone.
+    os.makedirs(os.path.dirname(vrt_path), exist_ok=True)
+    tmp_path = f"{vrt_path[:-len('.vrt')]}.{threading.get_ident()}.tmp.vrt"
+    try:
+        gdal.Translate(tmp_path, os.path.abspath(path), format="VRT")
+        dataset = gdal.Open(tmp_path)
+        factors = []
+        factor = 2
+        while max(dataset.RasterXSize, dataset.RasterYSize) / factor >= TILE_SIZE:
+            factors.append(factor)
+            factor *= 2
+        if dataset.BuildOverviews('AVERAGE', factors, callback, options=['COMPRESS_OVERVIEW=DEFLATE']) != 0:
+            raise RuntimeError("Building the overviews failed or was cancelled")
+        dataset = None
+        os.replace(tmp_path + ".ovr", vrt_path + ".ovr")
+        os.replace(tmp_path, vrt_path)
+    finally:
+        for leftover in (tmp_path, tmp_path + ".ovr"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+class OverviewSignals(QObject):
+    # Progress of a build in whole percent, and the VRT path (empty with an error) once finished
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(str, str)
+
+class OverviewBuilder:
+    # Builds the overviews of an image on a background thread, the UI shows the full resolution
+    # tiles meanwhile. A build is cancelled through its progress callback.
+    def __init__(self, path, vrt_path):
+        self.path = path
+        self.vrt_path = vrt_path
+        self.cancelled = False
+        self.percent = -1
+        self.signals = OverviewSignals()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, complete, message, data):
+        # GDAL progress callback, called for every block
+        percent = int(complete * 100)
+        if percent != self.percent:
+            self.percent = percent
+            self.signals.progress.emit(percent)
+        return 0 if self.cancelled else 1
+
+    def run(self):
+        try:
+            build_overviews(self.path, self.vrt_path, self.progress)
+            self.signals.finished.emit(self.vrt_path, "")
+        except Exception as e:
+            self.signals.finished.emit("", str(e))
 
 class DigitizerApp(QMainWindow):
     def __init__(self):
@@ -23,6 +611,8 @@ class DigitizerApp(QMainWindow):
         self.panning = False  # Variable to track panning state
         self.temp_points = []  # Temporary points for the polygon being drawn
         self.temp_item = None  # Temporary QGraphicsPolygonItem for visualization
+        self.tile_layer = None  # Tiled orthophoto, None until an image is opened
+        self.overview_builder = None  # Overviews being built for the open image
         self.resize(800, 800)
 
     def initUI(self):
@@ -30,7 +620,13 @@ class DigitizerApp(QMainWindow):
         open_action = QAction('Open Image', self)
         open_action.triggered.connect(self.open_image)
 
-        save_action = QAction('Save GeoJSON', self)
+        import_action = QAction('Import Footprints', self)
+        import_action.triggered.connect(self.import_footprints)
+
+        session_action = QAction('Autosave Session...', self)
+        session_action.triggered.connect(self.start_session)
+
+        save_action = QAction('Export GeoJSON', self)
         save_action.triggered.connect(self.save_geojson)
 
         start_digitizing_action = QAction('Start Digitizing', self)
@@ -46,6 +642,8 @@ class DigitizerApp(QMainWindow):
         menubar = self.menuBar()
         file_menu = menubar.addMenu('File')
         file_menu.addAction(open_action)
+        file_menu.addAction(import_action)
+        file_menu.addAction(session_action)
         file_menu.addAction(save_action)
 
         edit_menu = menubar.addMenu('Edit')
@@ -59,8 +657,18 @@ class DigitizerApp(QMainWindow):
         self.view.setScene(self.scene)
         self.setCentralWidget(self.view)
 
-        # Store digitized geometries
-        self.geometries = []
+        # Store digitized geometries by id, with their outlines in scene pixels indexed for
+        # selection and snapping
+        self.geometries = {}
+        self.index = GridIndex()
+
+        # Imported footprints are drawn by one layer item, with editable items only near the cursor
+        self.footprint_layer = None
+        self.editable_ids = set()
+        self.temp_lines = []
+
+        # GeoPackage the outlines are autosaved to, None until a session is started
+        self.session = None
 
         # Enable mouse tracking and set mouse events
         self.view.setMouseTracking(True)
@@ -68,6 +676,21 @@ class DigitizerApp(QMainWindow):
         self.view.mouseMoveEvent = self.mouse_move_event
         self.view.mouseReleaseEvent = self.mouse_release_event
 
+        # Load the orthophoto tiles in view whenever it scrolls, zooms or resizes
+        self.view.horizontalScrollBar().valueChanged.connect(self.update_tiles)
+        self.view.verticalScrollBar().valueChanged.connect(self.update_tiles)
+        self.view.resizeEvent = self.view_resize_event
+
+    def view_resize_event(self, event):
+        QGraphicsView.resizeEvent(self.view, event)
+        self.update_tiles()
+
+    def update_tiles(self):
+        if self.tile_layer is None:
+            return
+        rect = self.view.mapToScene(self.view.viewport().rect()).boundingRect()
+        self.tile_layer.update(rect, self.view.transform().m11())
+
     def wheelEvent(self, event):
         zoom_in_factor = 1.25
         zoom_out_factor = 1 / zoom_in_factor
@@ -79,6 +702,7 @@ class DigitizerApp(QMainWindow):
         else:
             # Zoom out
             self.view.scale(zoom_out_factor, zoom_out_factor)
+        self.update_tiles()
     
     def mouse_press_event(self, event):
         if not self.image_loaded:
@@ -87,7 +711,7 @@ class DigitizerApp(QMainWindow):
         if self.digitizing_mode:  # Only allow digitizing when in digitizing mode
             if event.button() == Qt.LeftButton:
                 pos = self.view.mapToScene(event.pos())
-                x, y = pos.x(), pos.y()
+                x, y = self.snap(pos.x(), pos.y())
 
                 # Convert screen coordinates to geospatial coordinates
                 geo_x, geo_y = self.screen_to_geo(x, y)
@@ -106,6 +730,7 @@ class DigitizerApp(QMainWindow):
                 if len(self.temp_points) > 1:
                     line = QGraphicsLineItem(QLineF(QPointF(*self.temp_points[-2]), QPointF(*self.temp_points[-1])))
                     self.scene.addItem(line)
+                    self.temp_lines.append(line)
 
             elif event.button() == Qt.RightButton and len(self.temp_points) > 2:
                 # Close the polygon by connecting the last point to the first
@@ -120,12 +745,17 @@ class DigitizerApp(QMainWindow):
                 polygon_item.setBrush(QBrush(QColor(255, 0, 0, 100)))  # Semi-transparent fill
                 polygon_item.setData(0, self.polygon_id_counter)  # Store the ID in the polygon item
 
-                self.geometries.append({
+                pixels = Polygon(self.temp_points)
+                self.geometries[self.polygon_id_counter] = {
                     "id": self.polygon_id_counter,
                     "geometry": polygon,
-                    "graphics_item": polygon_item
-                })
+                    "graphics_item": polygon_item,
+                    "pixels": pixels
+                }
+                self.index.insert(self.polygon_id_counter, pixels.bounds)
                 self.scene.addItem(polygon_item)
+                if self.session is not None:
+                    self.session.insert([(self.polygon_id_counter, polygon, {})])
 
                 # Increment the polygon ID counter for the next polygon
                 self.polygon_id_counter += 1
@@ -142,25 +772,283 @@ class DigitizerApp(QMainWindow):
                     self.selected_polygon_item.setPen(QPen(Qt.red, 2))  # Revert to the original color
                     self.selected_polygon_item = None
 
-                # Detect polygon under mouse for selection
+                # Detect polygon under mouse for selection, the latest one if they overlap
                 pos = self.view.mapToScene(event.pos())
-                items = self.scene.items(pos)
-                for item in items:
-                    if isinstance(item, QGraphicsPolygonItem):
-                        item.setPen(QPen(Qt.blue, 2))  # Highlight the selected polygon
-                        self.selected_polygon_item = item
-                        break
+                polygon_id = self.polygon_at(pos.x(), pos.y())
+                if polygon_id is not None:
+                    item = self.editable_item(polygon_id)
+                    item.setPen(QPen(Qt.blue, 2))  # Highlight the selected polygon
+                    self.selected_polygon_item = item
 
             if event.button() == Qt.MiddleButton:  # Start panning when the middle mouse button is pressed
                 self.panning = True
                 self.pan_start = event.pos()  # Store the starting point for panning
 
+    def polygon_at(self, x, y):
+        # Id of the topmost polygon containing a scene point
+        hits = [polygon_id for polygon_id in self.index.query(x, y, x, y)
+                if shapely.intersects_xy(self.geometries[polygon_id]["pixels"], x, y)]
+        return max(hits) if hits else None
+
+    def snap(self, x, y):
+        # Nearest vertex, or else nearest point on an edge, of the neighbouring polygons within
+        # SNAP_PIXELS on screen
+        tolerance = SNAP_PIXELS / self.view.transform().m11()
+        neighbours = self.index.query(x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+        if not neighbours:
+            return x, y
+        rings = [self.geometries[polygon_id]["pixels"].exterior for polygon_id in neighbours]
+
+        vertices = shapely.get_coordinates(rings)
+        distances = np.hypot(vertices[:, 0] - x, vertices[:, 1] - y)
+        nearest = np.argmin(distances)
+        if distances[nearest] <= tolerance:
+            return float(vertices[nearest, 0]), float(vertices[nearest, 1])
+
+        point = Point(x, y)
+        distances = shapely.distance(rings, point)
+        nearest = np.argmin(distances)
+        if distances[nearest] <= tolerance:
+            snapped = rings[nearest].interpolate(rings[nearest].project(point))
+            return snapped.x, snapped.y
+        return x, y
+
     def mouse_move_event(self, event):
         if self.panning:
             delta = event.pos() - self.pan_start  # Calculate the difference between the current and starting positions
             self.view.horizontalScrollBar().setValue(self.view.horizontalScrollBar().value() - delta.x())
             self.view.verticalScrollBar().setValue(self.view.verticalScrollBar().value() - delta.y())
             self.pan_start = event.pos()  # Update the starting point for panning
+        elif self.footprint_layer is not None:
+            pos = self.view.mapToScene(event.pos())
+            self.update_editable_items(pos.x(), pos.y())
+
+    def editable_item(self, polygon_id):
+        # Graphics item of a polygon, created on demand for imported footprints
+        geom_data = self.geometries[polygon_id]
+        if geom_data["graphics_item"] is None:
+            polygon_item = QGraphicsPolygonItem(QPolygonF([QPointF(x, y) for x, y in geom_data["pixels"].exterior.coords]))
+            polygon_item.setPen(QPen(Qt.red, 2))
+            polygon_item.setData(0, polygon_id)
+            self.scene.addItem(polygon_item)
+            geom_data["graphics_item"] = polygon_item
+            self.editable_ids.add(polygon_id)
+            self.footprint_layer.invalidate(self.index.bounds[polygon_id])
+        return geom_data["graphics_item"]
+
+    def update_editable_items(self, x, y):
+        # Editable items for the imported footprints near the cursor, released again further away
+        scale = self.view.transform().m11()
+        near = set()
+        if scale >= EDIT_MIN_SCALE:
+            radius = EDIT_RADIUS_PIXELS / scale
+            near = {polygon_id for polygon_id in self.index.query(x - radius, y - radius, x + radius, y + radius)
+                    if self.geometries[polygon_id].get("imported")}
+        for polygon_id in near - self.editable_ids:
+            self.editable_item(polygon_id)
+        for polygon_id in self.editable_ids - near:
+            geom_data = self.geometries[polygon_id]
+            if geom_data["graphics_item"] is self.selected_polygon_item:
+                continue
+            self.scene.removeItem(geom_data["graphics_item"])
+            geom_data["graphics_item"] = None
+            self.editable_ids.discard(polygon_id)
+            self.footprint_layer.invalidate(self.index.bounds[polygon_id])
+
+    def geo_to_screen(self, coords):
+        # Inverse of screen_to_geo for an array of coordinates
+        gt = self.geotransform
+        det = gt[1] * gt[5] - gt[2] * gt[4]
+        dx, dy = coords[:, 0] - gt[0], coords[:, 1] - gt[3]
+        return np.column_stack([(gt[5] * dx - gt[2] * dy) / det, (gt[1] * dy - gt[4] * dx) / det])
+
+    def import_footprints(self):
+        if not self.image_loaded:
+            QMessageBox.warning(self, "No Image", "Open the orthophoto before importing footprints.")
+            return
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "Import Footprints", "", "Vector Files (*.geojson *.json *.gpkg *.shp)"
+        )
+        if not file_path:
+            return
+
+        self.statusBar().showMessage("Importing footprints...")
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        error = None
+        try:
+            gdf = gpd.read_file(file_path)
+            if gdf.crs is not None and self.projection:
+                gdf = gdf.to_crs(self.projection)
+            gdf = gdf[gdf.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])].explode(index_parts=False)
+            properties = json.loads(pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).to_json(orient='records', date_format='iso'))
+            ids = self.add_footprints(gdf.geometry.values, properties)
+            if self.session is not None:
+                self.session.insert([(polygon_id, self.geometries[polygon_id]["geometry"], self.geometries[polygon_id]["properties"])
+                                     for polygon_id in ids])
+        except Exception as e:
+            error = e
+        finally:
+            QApplication.restoreOverrideCursor()
+            self.statusBar().clearMessage()
+        if error is not None:
+            QMessageBox.critical(self, "Error", f"Failed to import the footprints: {error}")
+            return
+        QMessageBox.information(self, "Footprints Imported", f"{len(ids)} footprints imported.")
+
+    def add_footprints(self, geometries, properties, ids=None):
+        # Index footprints given in map coordinates and draw them through the footprint layer,
+        # every footprint is indexed but gets no graphics item of its own
+        if ids is None:
+            ids = list(range(self.polygon_id_counter, self.polygon_id_counter + len(geometries)))
+        pixels = shapely.transform(geometries, self.geo_to_screen)
+        bounds = shapely.bounds(pixels)
+        for polygon_id, geometry, pixel_polygon, polygon_bounds, record in zip(ids, geometries, pixels, bounds.tolist(), properties):
+            self.geometries[polygon_id] = {
+                "id": polygon_id,
+                "geometry": geometry,
+                "graphics_item": None,
+                "pixels": pixel_polygon,
+                "imported": True,
+                "properties": record
+            }
+            self.index.insert(polygon_id, tuple(polygon_bounds))
+        if ids:
+            self.polygon_id_counter = max(self.polygon_id_counter, max(ids) + 1)
+
+        if len(bounds):
+            rect = bounds_rect(bounds)
+            if self.footprint_layer is None:
+                self.footprint_layer = FootprintLayer(self.geometries, self.index, rect, self.editable_ids)
+                self.scene.addItem(self.footprint_layer)
+            else:
+                self.footprint_layer.extend(rect)
+                self.footprint_layer.paths.clear()
+                self.footprint_layer.update()
+        return ids
+
+    def refresh_outlines(self):
+        # Pixel outlines, their index, the footprint layer and the editable items again from
+        # the map coordinates, after an image with another geotransform was opened
+        if self.selected_polygon_item is not None:
+            self.selected_polygon_item.setPen(QPen(Qt.red, 2))
+            self.selected_polygon_item = None
+        if self.footprint_layer is not None:
+            self.scene.removeItem(self.footprint_layer)
+            self.footprint_layer = None
+        self.editable_ids.clear()
+        self.index = GridIndex()
+
+        ids = list(self.geometries)
+        pixels = shapely.transform(np.array([self.geometries[polygon_id]["geometry"] for polygon_id in ids], dtype=object),
+                                   self.geo_to_screen)
+        bounds = shapely.bounds(pixels)
+        imported = []
+        for polygon_id, pixel_polygon, polygon_bounds in zip(ids, pixels, bounds):
+            geom_data = self.geometries[polygon_id]
+            geom_data["pixels"] = pixel_polygon
+            self.index.insert(polygon_id, tuple(polygon_bounds.tolist()))
+            item = geom_data["graphics_item"]
+            if geom_data.get("imported"):
+                # Editable items are created again near the cursor
+                if item is not None:
+                    self.scene.removeItem(item)
+                    geom_data["graphics_item"] = None
+                imported.append(polygon_bounds)
+            else:
+                item.setPolygon(QPolygonF([QPointF(x, y) for x, y in pixel_polygon.exterior.coords]))
+        if imported:
+            self.footprint_layer = FootprintLayer(self.geometries, self.index, bounds_rect(np.array(imported)), self.editable_ids)
+            self.scene.addItem(self.footprint_layer)
+
+    def clear_outlines(self):
+        # Drop every outline and end the session, whose layer has the SRS of the old image
+        for geom_data in self.geometries.values():
+            if geom_data["graphics_item"] is not None:
+                self.scene.removeItem(geom_data["graphics_item"])
+        if self.footprint_layer is not None:
+            self.scene.removeItem(self.footprint_layer)
+            self.footprint_layer = None
+        self.geometries.clear()
+        self.editable_ids.clear()
+        self.index = GridIndex()
+        self.selected_polygon_item = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def start_session(self):
+        # Autosave to a GeoPackage layer, an existing session is loaded first
+        if not self.image_loaded:
+            QMessageBox.warning(self, "No Image", "Open the orthophoto before starting a session.")
+            return
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "Autosave Session", "", "GeoPackage Files (*.gpkg)",
+            options=QFileDialog.DontConfirmOverwrite
+        )
+        if not file_path:
+            return
+
+        # Ids of a saved session are kept, so it can only be resumed into an empty workspace
+        try:
+            resume = os.path.exists(file_path) and SESSION_LAYER in gpd.list_layers(file_path)['name'].tolist()
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to read the session file: {e}")
+            return
+        if resume and self.geometries:
+            QMessageBox.warning(self, "Session Exists",
+                                "This file holds an earlier session, which can only be resumed before any outlines are added.")
+            return
+
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        error = None
+        try:
+            loaded = 0
+            if resume:
+                saved = gpd.read_file(file_path, layer=SESSION_LAYER, fid_as_index=True)
+                properties = [json.loads(value) if value else {} for value in saved['properties']]
+                loaded = len(self.add_footprints(saved.geometry.values, properties, saved.index.tolist()))
+
+            # Outlines digitized or imported before the session started are written at once
+            self.session = GeoPackageSession(file_path, self.projection)
+            self.session.signals.failed.connect(self.autosave_error)
+            if not resume:
+                self.session.insert([(polygon_id, geom_data["geometry"], geom_data.get("properties", {}))
+                                     for polygon_id, geom_data in self.geometries.items()])
+        except Exception as e:
+            error = e
+        finally:
+            QApplication.restoreOverrideCursor()
+        if error is not None:
+            QMessageBox.critical(self, "Error", f"Failed to start the session: {error}")
+            return
+        self.statusBar().showMessage(f"Autosaving to {file_path}, {loaded} outlines loaded")
+
+    def autosave_error(self, error):
+        # The session holds the failed changes and everything queued after them until the
+        # user retries, or ends the session keeping the outlines in the workspace
+        session = self.session
+        if session is None or self.sender() is not session.signals:
+            return
+        path = session.path
+        self.statusBar().showMessage(f"Autosave to {path} paused: {error}")
+        answer = QMessageBox.critical(
+            self, "Autosave Failed",
+            f"Writing to {path} failed:\n{error}\n\nAutosave is paused and the unsaved changes are kept. "
+            "Retry once the file is writable, or end the session and export the outlines.",
+            QMessageBox.Retry | QMessageBox.Abort, QMessageBox.Retry)
+        if self.session is not session:
+            return
+        if answer == QMessageBox.Retry:
+            self.statusBar().showMessage(f"Autosaving to {path}")
+            session.retry()
+        else:
+            session.close()
+            self.session = None
+            self.statusBar().showMessage(f"Autosave to {path} ended, the unsaved changes were not written")
 
     def mouse_release_event(self, event):
         if event.button() == Qt.MiddleButton:
@@ -184,32 +1072,79 @@ class DigitizerApp(QMainWindow):
                 QMessageBox.critical(self, "Error", "Failed to load the image.")
                 return
 
-            # Get geotransform and projection
-            self.geotransform = dataset.GetGeoTransform()
-            self.projection = dataset.GetProjection()
-
-            # Read the RGB bands
-            r_band = dataset.GetRasterBand(1).ReadAsArray()
-            g_band = dataset.GetRasterBand(2).ReadAsArray()
-            b_band = dataset.GetRasterBand(3).ReadAsArray()
+            # Outlines are kept in map coordinates, their pixels follow a new geotransform. In
+            # another SRS they can't be placed, so they are cleared or the image isn't opened.
+            geotransform = dataset.GetGeoTransform()
+            projection = dataset.GetProjection()
+            if self.geometries and self.image_loaded and not same_projection(self.projection, projection):
+                answer = QMessageBox.question(
+                    self, "Different Coordinate System",
+                    "This image has another coordinate system than the outlines. Clear the outlines"
+                    " and end the autosave session to open it?", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+                if answer != QMessageBox.Yes:
+                    return
+                self.clear_outlines()
+            self.geotransform = geotransform
+            self.projection = projection
 
-            # Combine into an RGB array
-            rgb_array = np.dstack((r_band, g_band, b_band))
+            # Overviews let zoomed out views read a few small tiles instead of the full image.
+            # Images without them are shown through a cached VRT with overviews, which are
+            # built in the background the first time.
+            if self.overview_builder is not None:
+                self.overview_builder.cancel()
+                self.overview_builder = None
+            build = False
+            if (dataset.GetRasterBand(1).GetOverviewCount() == 0
+                    and max(dataset.RasterXSize, dataset.RasterYSize) > OVERVIEW_MIN_SIZE):
+                vrt_path = overview_path(file_path)
+                if os.path.exists(vrt_path):
+                    file_path, dataset = vrt_path, gdal.Open(vrt_path)
+                else:
+                    build = True
 
-            # Convert the RGB array into QImage
-            height, width, _ = rgb_array.shape
-            bytes_per_line = 3 * width
-            image = QImage(rgb_array.data, width, height, bytes_per_line, QImage.Format_RGB888)
+            # Display the image as tiles, only the ones in view are read
+            if self.tile_layer is not None:
+                self.tile_layer.clear()
 
-            # Convert QImage to QPixmap
-            pixmap = QPixmap.fromImage(image)
-
-            # Display the image in the scene
-            self.scene.clear()
-            self.scene.addPixmap(pixmap)  # Use the pixmap here
-            self.view.fitInView(self.scene.itemsBoundingRect(), Qt.KeepAspectRatio)
+            # Outlines and imported footprints are kept, only the polygon being drawn goes
+            for item in self.temp_lines + ([self.temp_item] if self.temp_item else []):
+                self.scene.removeItem(item)
+            self.temp_lines = []
+            self.temp_points = []
+            self.temp_item = None
+            if self.geometries:
+                self.refresh_outlines()
+            self.tile_layer = TileLayer(file_path, dataset, self.scene,
+                                        BUILDING_PENDING_TILES if build else None)
+            self.scene.setSceneRect(QRectF(0, 0, dataset.RasterXSize, dataset.RasterYSize))
+            if build:
+                # Full resolution around the centre until the overviews are ready
+                self.view.resetTransform()
+                self.view.centerOn(self.scene.sceneRect().center())
+                self.overview_builder = OverviewBuilder(file_path, vrt_path)
+                self.overview_builder.signals.progress.connect(
+                    lambda percent: self.statusBar().showMessage(f"Building overviews... {percent}%"))
+                self.overview_builder.signals.finished.connect(self.overviews_built)
+                self.overview_builder.start()
+            else:
+                self.view.fitInView(self.scene.sceneRect(), Qt.KeepAspectRatio)
+            self.update_tiles()
             self.image_loaded = True
 
+    def overviews_built(self, vrt_path, error):
+        # Switch the open image to the VRT with overviews, unless the build was cancelled since
+        if self.overview_builder is None or self.sender() is not self.overview_builder.signals:
+            return
+        self.overview_builder = None
+        if error:
+            self.statusBar().showMessage(f"Overviews not built: {error}")
+            return
+        self.statusBar().clearMessage()
+        dataset = gdal.Open(vrt_path)
+        self.tile_layer.clear()
+        self.tile_layer = TileLayer(vrt_path, dataset, self.scene)
+        self.update_tiles()
+
     def start_digitizing(self):
         self.digitizing_mode = True
         QMessageBox.information(self, "Digitizing Mode", "Digitizing mode activated. Click to start drawing polygons.")
@@ -222,7 +1157,13 @@ class DigitizerApp(QMainWindow):
         if self.selected_polygon_item:
             # Find the corresponding geometry in the geometries list
             polygon_id = self.selected_polygon_item.data(0)
-            self.geometries = [geom for geom in self.geometries if geom["id"] != polygon_id]
+            geom_data = self.geometries.pop(polygon_id, None)
+            if geom_data is not None and geom_data.get("imported"):
+                self.footprint_layer.invalidate(self.index.bounds[polygon_id])
+                self.editable_ids.discard(polygon_id)
+            self.index.remove(polygon_id)
+            if self.session is not None:
+                self.session.delete(polygon_id)
             self.scene.removeItem(self.selected_polygon_item)  # Remove the selected polygon from the scene
             self.selected_polygon_item = None  # Clear the selected polygon
             QMessageBox.information(self, "Polygon Deleted", "The selected polygon has been deleted.")
@@ -238,22 +1179,23 @@ class DigitizerApp(QMainWindow):
             self, "Save GeoJSON", "", "GeoJSON Files (*.geojson)"
         )
         if file_path:
-            features = []
-            for geom_data in self.geometries:
-                geom = geom_data["geometry"]
-                features.append({
-                    "type": "Feature",
-                    "properties": {
-                        "id": geom_data["id"]  # Include the ID in properties
-                    },
-                    "geometry": mapping(geom)  # Convert to GeoJSON format using mapping
-                })
-            geojson_data = {
-                "type": "FeatureCollection",
-                "features": features
-            }
+            # Features are written a chunk at a time instead of building the whole collection, with
+            # the geometries of a chunk converted to GeoJSON in one go
+            entries = list(self.geometries.values())
             with open(file_path, 'w') as f:
-                json.dump(geojson_data, f)
+                f.write('{"type": "FeatureCollection", "features": [\n')
+                for start in range(0, len(entries), GEOJSON_CHUNK_SIZE):
+                    chunk = entries[start:start + GEOJSON_CHUNK_SIZE]
+                    geometries = shapely.to_geojson(np.array([geom_data["geometry"] for geom_data in chunk], dtype=object))
+                    features = []
+                    for geom_data, geometry in zip(chunk, geometries.tolist()):
+                        properties = {
+                            **geom_data.get("properties", {}),  # Attributes of imported footprints
+                            "id": geom_data["id"]  # Include the ID in properties
+                        }
+                        features.append(f'{{"type": "Feature", "properties": {json.dumps(properties)}, "geometry": {geometry}}}')
+                    f.write((',\n' if start else '') + ',\n'.join(features))
+                f.write('\n]}\n')
             QMessageBox.information(self, "Success", "GeoJSON file saved successfully.")
 
 if __name__ == '__main__':
@@ -1,15 +1,446 @@
 import sys
 from PyQt5 import QtWidgets
-from PyQt5.QtWidgets import QLabel, QLineEdit, QPushButton, QVBoxLayout, QFileDialog, QMessageBox, QHBoxLayout, QTextEdit
+from PyQt5.QtWidgets import QLabel, QLineEdit, QPushButton, QVBoxLayout, QFileDialog, QMessageBox, QHBoxLayout, QTextEdit, QCheckBox
 from PyQt5.QtGui import QIcon, QPixmap
+from PyQt5.QtCore import QThread, pyqtSignal
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
 import geopandas as gpd
-from sqlalchemy import create_engine
-from simplekml import Kml, AltitudeMode
-from shapely.geometry import Polygon
+import shapely
+from xml.sax.saxutils import escape, quoteattr
+from sqlalchemy import text
+from connection import get_engine
+from database import ProfileSelector, quote_identifier
+
+# KML coordinates are always WGS 84 longitude/latitude
+KML_EPSG = 4326
+
+# Rows fetched from the server-side cursor and written out at a time
+KML_CHUNK_SIZE = 5000
+
+# Shared style of all buildings, red with transparency
+KML_STYLE = 'building'
+KML_COLOR = '7d0000ff'
+
+# Regionated export: buildings per tile before it is split, deepest quadtree level,
+# tile size in pixels used for simplification and on-screen size at which a tile loads
+TILE_MAX_FEATURES = 2000
+TILE_MAX_DEPTH = 12
+TILE_PIXELS = 256
+LOD_MIN_PIXELS = 128
+
+# Shapely type ids of Polygon and MultiPolygon
+POLYGON_TYPES = [3, 6]
+
+def split_table_name(table):
+    # Schema (empty for the search path) and name of a possibly qualified table
+    schema, _, name = table.rpartition('.')
+    return schema, name
+
+def qualified_table(table):
+    return '.'.join(quote_identifier(part) for part in table.split('.'))
+
+def table_geometry(engine, table):
+    # Geometry column and SRID of a table from the PostGIS catalogue
+    schema, name = split_table_name(table)
+    query = text("SELECT f_geometry_column, srid FROM geometry_columns "
+                 "WHERE f_table_name = :name AND f_table_schema = COALESCE(NULLIF(:schema, ''), current_schema())")
+    with engine.connect() as connection:
+        row = connection.execute(query, {'name': name, 'schema': schema}).first()
+    if row is None:
+        raise ValueError(f"Table {table} has no registered geometry column.")
+    if not row[1]:
+        raise ValueError(f"Geometry column {row[0]} of table {table} has no SRID.")
+    return row[0], row[1]
+
+def table_columns(engine, table):
+    # Non-geometry columns of a table in their defined order
+    schema, name = split_table_name(table)
+    query = text("SELECT column_name FROM information_schema.columns "
+                 "WHERE table_name = :name AND table_schema = COALESCE(NULLIF(:schema, ''), current_schema()) "
+                 "AND udt_name NOT IN ('geometry', 'geography') ORDER BY ordinal_position")
+    with engine.connect() as connection:
+        return [row[0] for row in connection.execute(query, {'name': name, 'schema': schema})]
+
+def parse_filter(value, filter_epsg):
+    # WKT of the export area: a "minx, miny, maxx, maxy" bounding box or a vector
+    # file whose polygons are merged, both in filter_epsg
+    value = value.strip()
+    if not value:
+        return None
+    parts = value.split(',')
+    if len(parts) == 4:
+        try:
+            return shapely.box(*[float(part) for part in parts]).wkt
+        except ValueError:
+            pass
+    area = gpd.read_file(value)
+    if area.crs is not None:
+        area = area.to_crs(epsg=filter_epsg)
+    return shapely.union_all(area.geometry.values).wkt
+
+# Column with a stable key of every row, its physical position (block << 16 | offset),
+# read with the centroids and again with the rows of a regionated export
+KML_ROW_KEY = 'kml_row'
+ROW_KEY_SQL = "(((ctid::text::point)[0])::bigint << 16) + ((ctid::text::point)[1])::bigint"
+
+def filter_clause(geometry_column, srid, filter_wkt=None, filter_epsg=KML_EPSG):
+    # Spatial filter transformed into the table SRID so ST_Intersects can use the GiST index
+    if not filter_wkt:
+        return "", {}
+    geometry = quote_identifier(geometry_column)
+    sql = f" WHERE ST_Intersects({geometry}, ST_Transform(ST_GeomFromText(%(filter)s, %(filter_srid)s), {int(srid)}))"
+    return sql, {'filter': filter_wkt, 'filter_srid': int(filter_epsg)}
+
+def export_query(table, geometry_column, srid, columns, filter_wkt=None, filter_epsg=KML_EPSG, row_key=False):
+    # Column selection, spatial filter and reprojection to WGS 84 all run in PostGIS. The
+    # geometry comes last as WKB, after the row key if requested.
+    geometry = quote_identifier(geometry_column)
+    select = [quote_identifier(column) for column in columns]
+    if row_key:
+        select.append(f"{ROW_KEY_SQL} AS {KML_ROW_KEY}")
+    select.append(f"ST_AsBinary(ST_Transform({geometry}, {KML_EPSG})) AS geometry")
+    where, params = filter_clause(geometry_column, srid, filter_wkt, filter_epsg)
+    return f"SELECT {', '.join(select)} FROM {qualified_table(table)}{where}", params
+
+def centroid_query(table, geometry_column, srid, filter_wkt=None, filter_epsg=KML_EPSG):
+    # Row key, WGS 84 centroid and area of the same rows as export_query, without the
+    # attributes or the geometry itself. Missing and empty geometries are left out.
+    geometry = quote_identifier(geometry_column)
+    where, params = filter_clause(geometry_column, srid, filter_wkt, filter_epsg)
+    sql = (f"SELECT row_key, ST_X(ST_Centroid(shape)), ST_Y(ST_Centroid(shape)), ST_Area(shape) FROM "
+           f"(SELECT {ROW_KEY_SQL} AS row_key, ST_Transform({geometry}, {KML_EPSG}) AS shape FROM {qualified_table(table)}{where}) AS shapes "
+           f"WHERE shape IS NOT NULL AND NOT ST_IsEmpty(shape)")
+    return sql, params
+
+def fetch_rows(connection, sql, params, chunk_size=KML_CHUNK_SIZE):
+    # Lists of at most chunk_size rows from a named (server-side) cursor, so only one chunk
+    # of the result is ever held on this side, with the column names
+    cursor = connection.cursor(name='kml_export')
+    try:
+        cursor.itersize = chunk_size
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows, [description[0] for description in cursor.description]
+    finally:
+        cursor.close()
+
+def read_chunks(connection, sql, params, chunk_size=KML_CHUNK_SIZE):
+    # GeoDataFrames of the rows of export_query, chunk by chunk. Rows are numbered across
+    # chunks by the index.
+    start = 0
+    for rows, columns in fetch_rows(connection, sql, params, chunk_size):
+        geometries = shapely.from_wkb([bytes(row[-1]) if row[-1] is not None else None for row in rows])
+        data = pd.DataFrame([row[:-1] for row in rows], columns=columns[:-1], index=range(start, start + len(rows)))
+        start += len(rows)
+        yield gpd.GeoDataFrame(data, geometry=geometries, crs=KML_EPSG)
+
+def read_centroids(connection, sql, params, chunk_size=KML_CHUNK_SIZE):
+    # Row keys, centroids and areas of centroid_query as arrays, a few dozen bytes per row
+    keys, centroids, areas = [], [], []
+    for rows, _ in fetch_rows(connection, sql, params, chunk_size):
+        values = np.array(rows, dtype=float).reshape(-1, 4)
+        keys.append(np.array([row[0] for row in rows], dtype=np.int64))
+        centroids.append(values[:, 1:3])
+        areas.append(values[:, 3])
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 2)), np.zeros(0)
+    return np.concatenate(keys), np.concatenate(centroids), np.concatenate(areas)
+
+def building_markup(gdf, columns, default_height=10):
+    # Extruded placemarks for the polygons and multipolygons of a chunk and how many there
+    # are. Rings of all buildings are pulled out in bulk and only the markup is assembled
+    # per building.
+    geometries = gdf.geometry.values
+    keep = np.isin(shapely.get_type_id(geometries), POLYGON_TYPES) & ~shapely.is_empty(geometries)
+    rows = np.flatnonzero(keep)
+    if len(rows) == 0:
+        return '', 0
+    heights = gdf['height'].to_numpy(dtype=float) if 'height' in gdf else np.full(len(gdf), float(default_height))
+    heights = np.where(np.isnan(heights), default_height, heights)
+
+    # Polygons of every building, rings of every polygon and coordinates of every ring
+    parts, part_row = shapely.get_parts(geometries[rows], return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    z = heights[rows][part_row[ring_part[coord_ring]]]
+    points = [f"{x:.7f},{y:.7f},{h:.2f}" for x, y, h in zip(coords[:, 0].tolist(), coords[:, 1].tolist(), z.tolist())]
+    ring_ends = np.cumsum(np.bincount(coord_ring, minlength=len(rings))).tolist()
+    ring_starts = [0] + ring_ends[:-1]
+    exterior = np.r_[True, ring_part[1:] != ring_part[:-1]].tolist()
+
+    # Markup of each polygon, the first ring is the exterior
+    polygons = [[] for _ in range(len(parts))]
+    for ring, part in enumerate(ring_part.tolist()):
+        coordinates = ' '.join(points[ring_starts[ring]:ring_ends[ring]])
+        boundary = 'outerBoundaryIs' if exterior[ring] else 'innerBoundaryIs'
+        polygons[part].append(f"<{boundary}><LinearRing><coordinates>{coordinates}</coordinates></LinearRing></{boundary}>")
+    polygons = [f"<Polygon><extrude>1</extrude><altitudeMode>relativeToGround</altitudeMode>{''.join(boundaries)}</Polygon>"
+                for boundaries in polygons]
+
+    # Selected columns as placemark data
+    data = [[f"<Data name={quoteattr(str(column))}><value>{escape(str(value))}</value></Data>" for value in gdf[column].iloc[rows].tolist()]
+            for column in columns]
+    data = [''.join(values) for values in zip(*data)] if data else [''] * len(rows)
+
+    names = gdf.index[rows].tolist()
+    building_parts = np.bincount(part_row, minlength=len(rows)).tolist()
+    part_start = 0
+    placemarks = []
+    for i in range(len(rows)):
+        geometry = ''.join(polygons[part_start:part_start + building_parts[i]])
+        part_start += building_parts[i]
+        if building_parts[i] > 1:
+            geometry = f"<MultiGeometry>{geometry}</MultiGeometry>"
+        placemarks.append(f"<Placemark><name>Polygon {names[i]}</name><styleUrl>#{KML_STYLE}</styleUrl>"
+                          f"<ExtendedData>{data[i]}</ExtendedData>{geometry}</Placemark>\n")
+    return ''.join(placemarks), len(rows)
+
+class KMLWriter:
+    # Writes placemarks straight to a KML file, or to doc.kml inside a KMZ archive, instead
+    # of building the document in memory. All placemarks share one style.
+    def __init__(self, path, color=KML_COLOR):
+        if path.lower().endswith('.kmz'):
+            self.archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+            self.file = io.TextIOWrapper(self.archive.open('doc.kml', 'w'), encoding='utf-8')
+        else:
+            self.archive = None
+            self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.file.write('<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n')
+        self.file.write(f'<Style id="{KML_STYLE}"><PolyStyle><color>{color}</color><fill>1</fill></PolyStyle></Style>\n')
+
+    def write(self, markup):
+        self.file.write(markup)
+
+    def write_buildings(self, gdf, columns, default_height=10):
+        # Placemarks of a chunk, returns how many were written
+        markup, count = building_markup(gdf, columns, default_height)
+        self.file.write(markup)
+        return count
+
+    def close(self):
+        self.file.write('</Document>\n</kml>\n')
+        self.file.close()
+        if self.archive is not None:
+            self.archive.close()
+
+def region_markup(bounds, min_lod, max_lod=-1):
+    # Region of a tile, active while it covers between min_lod and max_lod pixels
+    west, south, east, north = bounds
+    return (f"<Region><LatLonAltBox><north>{north:.7f}</north><south>{south:.7f}</south>"
+            f"<east>{east:.7f}</east><west>{west:.7f}</west></LatLonAltBox>"
+            f"<Lod><minLodPixels>{min_lod}</minLodPixels><maxLodPixels>{max_lod}</maxLodPixels></Lod></Region>")
+
+def network_link_markup(name, href, bounds, min_lod):
+    # Link loaded by the client only once the region of the tile is active
+    return (f"<NetworkLink><name>{name}</name>{region_markup(bounds, min_lod)}"
+            f"<Link><href>{href}</href><viewRefreshMode>onRegion</viewRefreshMode></Link></NetworkLink>\n")
+
+def plan_superoverlay(centroids, areas, max_features=TILE_MAX_FEATURES, max_depth=TILE_MAX_DEPTH):
+    # Quadtree of a regionated export from the centroids and areas alone. A tile with at
+    # most max_features buildings holds all of them. A larger tile shows its largest
+    # buildings, simplified to its pixel size, until it is big enough on screen for its
+    # children to load, and links to its four quadrants, each holding the buildings whose
+    # centroid falls in it. Returns the bounds of the root tile, the tiles (name, bounds,
+    # minimum LOD, simplification tolerance or None, child links) and the tile of every
+    # building shown, as parallel arrays of building positions and tile numbers.
+    west, south = centroids.min(axis=0) if len(centroids) else (0, 0)
+    east, north = centroids.max(axis=0) if len(centroids) else (0, 0)
+    # Square root tile so that children stay square in degrees
+    size = max(east - west, north - south) or 1e-6
+    root_bounds = (west, south, west + size, south + size)
+
+    tiles = []
+    member_positions = []
+    member_tiles = []
+    # Tiles still to plan: level, column, row and positions of their buildings
+    stack = [(0, 0, 0, np.arange(len(centroids)))]
+    while stack:
+        z, x, y, positions = stack.pop()
+        tile_size = size / 2 ** z
+        bounds = (west + x * tile_size, south + y * tile_size, west + (x + 1) * tile_size, south + (y + 1) * tile_size)
+        min_lod = 0 if z == 0 else LOD_MIN_PIXELS
+        links = []
+        if len(positions) <= max_features or z >= max_depth:
+            tolerance = None
+            shown = positions
+        else:
+            # Largest buildings at the detail of one tile pixel
+            tolerance = tile_size / TILE_PIXELS
+            shown = positions[np.argsort(-areas[positions], kind='stable')[:max_features]]
+
+            # Quadrant of every building by its centroid
+            column = np.clip(((centroids[positions, 0] - bounds[0]) / tile_size * 2).astype(int), 0, 1)
+            row = np.clip(((centroids[positions, 1] - bounds[1]) / tile_size * 2).astype(int), 0, 1)
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    child = positions[(column == dx) & (row == dy)]
+                    if len(child) == 0:
+                        continue
+                    cx, cy = 2 * x + dx, 2 * y + dy
+                    child_size = tile_size / 2
+                    child_bounds = (west + cx * child_size, south + cy * child_size,
+                                    west + (cx + 1) * child_size, south + (cy + 1) * child_size)
+                    name = f"{z + 1}_{cx}_{cy}"
+                    links.append(network_link_markup(name, f"{name}.kmz", child_bounds, LOD_MIN_PIXELS))
+                    stack.append((z + 1, cx, cy, child))
+        member_positions.append(shown)
+        member_tiles.append(np.full(len(shown), len(tiles)))
+        tiles.append((f"{z}_{x}_{y}", bounds, min_lod, tolerance, links))
+    return root_bounds, tiles, np.concatenate(member_positions), np.concatenate(member_tiles)
+
+def write_superoverlay(keys, centroids, areas, chunks, columns, kml_path, max_features=TILE_MAX_FEATURES,
+                       max_depth=TILE_MAX_DEPTH, log=print):
+    # Regionated export: a root document linking to a quadtree of KMZ tiles in a folder
+    # next to it. The quadtree is planned from the row keys, centroids and areas of a first
+    # pass (read_centroids), then the chunks of a second pass, carrying the KML_ROW_KEY
+    # column, are appended to the tiles they belong to one at a time. Tile placemarks are
+    # collected in plain files and packed into the KMZ tiles at the end.
+    tiles_name = os.path.splitext(os.path.basename(kml_path))[0] + '_tiles'
+    tiles_folder = os.path.join(os.path.dirname(kml_path), tiles_name)
+    os.makedirs(tiles_folder, exist_ok=True)
+    root_bounds, tiles, member_positions, member_tiles = plan_superoverlay(centroids, areas, max_features, max_depth)
+
+    # Tiles of every building, sorted by its row key
+    member_keys = keys[member_positions]
+    member_order = np.argsort(member_keys, kind='stable')
+    member_keys = member_keys[member_order]
+    member_tiles = member_tiles[member_order]
+
+    with tempfile.TemporaryDirectory(dir=tiles_folder) as parts_folder:
+        count = 0
+        for gdf in chunks:
+            # Tiles of the rows of the chunk, rows the first pass left out have none
+            chunk_keys = gdf[KML_ROW_KEY].to_numpy(dtype=np.int64)
+            first = np.searchsorted(member_keys, chunk_keys, side='left')
+            counts = np.searchsorted(member_keys, chunk_keys, side='right') - first
+            chunk_rows = np.repeat(np.arange(len(gdf)), counts)
+            members = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            row_tiles = member_tiles[members]
+
+            by_tile = np.argsort(row_tiles, kind='stable')
+            row_tiles = row_tiles[by_tile]
+            chunk_rows = chunk_rows[by_tile]
+            groups = np.flatnonzero(np.r_[True, row_tiles[1:] != row_tiles[:-1], True]) if len(row_tiles) else []
+            for start, end in zip(groups[:-1], groups[1:]):
+                name, _, _, tolerance, _ = tiles[row_tiles[start]]
+                buildings = gdf.iloc[chunk_rows[start:end]]
+                if tolerance is not None:
+                    buildings = buildings.copy()
+                    buildings.geometry = shapely.simplify(buildings.geometry.values, tolerance, preserve_topology=True)
+                markup, _ = building_markup(buildings, columns)
+                with open(os.path.join(parts_folder, name), 'a', encoding='utf-8') as part:
+                    part.write(markup)
+            count += len(gdf)
+            log(f"{count} features distributed over {len(tiles)} tiles")
+
+        for name, bounds, min_lod, tolerance, links in tiles:
+            writer = KMLWriter(os.path.join(tiles_folder, f"{name}.kmz"))
+            writer.write(region_markup(bounds, min_lod))
+            if tolerance is not None:
+                # Simplified buildings, hidden once the children, a quarter of the size,
+                # reach LOD_MIN_PIXELS
+                writer.write(f"<Folder>{region_markup(bounds, min_lod, 2 * LOD_MIN_PIXELS)}")
+            part_path = os.path.join(parts_folder, name)
+            if os.path.exists(part_path):
+                with open(part_path, encoding='utf-8') as part:
+                    shutil.copyfileobj(part, writer.file)
+            if tolerance is not None:
+                writer.write("</Folder>\n")
+            writer.write(''.join(links))
+            writer.close()
+
+    # Root document linking to the top tile
+    root = KMLWriter(kml_path)
+    root.write(network_link_markup("0_0_0", f"{tiles_name}/0_0_0.kmz", root_bounds, 0))
+    root.close()
+    log(f"{len(tiles)} tiles written to {tiles_folder}")
+    return len(tiles)
+
+
+def export_kml(engine, table_name, columns_text, filter_text, filter_epsg_text, kml_path, regionate=False, log=print):
+    # Requested columns, plus height which drives the extrusion
+    geometry_column, srid = table_geometry(engine, table_name)
+    available = table_columns(engine, table_name)
+    columns = [column.strip() for column in columns_text.split(',') if column.strip()] or available
+    missing = [column for column in columns if column not in available]
+    if missing:
+        raise ValueError(f"Unknown columns: {', '.join(missing)}")
+    if 'height' in available and 'height' not in columns:
+        columns.append('height')
+
+    # Filtered rows, already reprojected to WGS 84 (EPSG: 4326) by PostGIS, streamed
+    # in chunks from the server and written out before the next chunk is fetched
+    filter_epsg = int(filter_epsg_text or KML_EPSG)
+    filter_wkt = parse_filter(filter_text, filter_epsg)
+    sql_query, params = export_query(table_name, geometry_column, srid, columns, filter_wkt, filter_epsg, row_key=regionate)
+    log(f"Query executed: {sql_query}")
+
+    connection = engine.raw_connection()
+    try:
+        # Read only, and both passes of a regionated export see the same rows
+        cursor = connection.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.close()
+        if regionate:
+            # Tiles are planned from the centroids of every building first, then the
+            # rows are read again and appended to their tiles chunk by chunk
+            centroid_sql, centroid_params = centroid_query(table_name, geometry_column, srid, filter_wkt, filter_epsg)
+            keys, centroids, areas = read_centroids(connection, centroid_sql, centroid_params)
+            log(f"{len(keys)} centroids read")
+            write_superoverlay(keys, centroids, areas, read_chunks(connection, sql_query, params), columns, kml_path, log=log)
+        else:
+            writer = KMLWriter(kml_path)
+            try:
+                count = 0
+                written = 0
+                for gdf in read_chunks(connection, sql_query, params):
+                    written += writer.write_buildings(gdf, columns)
+                    count += len(gdf)
+                    log(f"{count} features read, {written} buildings written")
+            finally:
+                writer.close()
+    finally:
+        # End the transaction before the connection goes back to the pool
+        connection.rollback()
+        connection.close()
+
+class ExportThread(QThread):
+    # Runs export_kml off the UI thread, its log lines are passed on through output_signal and
+    # a failure is kept in error
+    output_signal = pyqtSignal(str)
+
+    def __init__(self, engine, table_name, columns_text, filter_text, filter_epsg_text, kml_path, regionate):
+        super().__init__()
+        self.engine = engine
+        self.table_name = table_name
+        self.columns_text = columns_text
+        self.filter_text = filter_text
+        self.filter_epsg_text = filter_epsg_text
+        self.kml_path = kml_path
+        self.regionate = regionate
+        self.error = None
+
+    def run(self):
+        try:
+            export_kml(self.engine, self.table_name, self.columns_text, self.filter_text, self.filter_epsg_text,
+                       self.kml_path, self.regionate, log=self.output_signal.emit)
+        except Exception as e:
+            self.error = str(e)
 
 class KMLGeneratorApp(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
+        self.export_thread = None  # Export running in the background, None when idle
         self.init_ui()
 
     def init_ui(self):
@@ -30,12 +461,34 @@ class KMLGeneratorApp(QtWidgets.QWidget):
         self.database_label = QLabel('Database:')
         self.database_input = QLineEdit()
 
+        # Saved connection profiles
+        self.profile_selector = ProfileSelector(self.user_input, self.password_input, self.host_input,
+                                                self.port_input, self.database_input)
+
         self.table_label = QLabel('Table:')
         self.table_input = QLineEdit()
 
+        # Optional column list and export area, applied in the database
+        self.columns_label = QLabel('Columns (comma separated, empty for all):')
+        self.columns_input = QLineEdit()
+
+        filter_layout = QHBoxLayout()
+        self.filter_label = QLabel('Export Area (minx, miny, maxx, maxy or polygon file, empty for all):')
+        self.filter_input = QLineEdit()
+        self.filter_button = QPushButton('...', self)
+        self.filter_button.clicked.connect(self.browse_filter)
+        self.filter_epsg_input = QLineEdit(str(KML_EPSG))
+        self.filter_epsg_input.setMaximumWidth(80)
+        self.filter_epsg_input.setToolTip('EPSG code of the bounding box or polygon file')
+
+        filter_layout.addWidget(self.filter_input)
+        filter_layout.addWidget(self.filter_button)
+        filter_layout.addWidget(QLabel('EPSG:'))
+        filter_layout.addWidget(self.filter_epsg_input)
+
         # File path selection button
         file_layout = QHBoxLayout()
-        self.file_label = QLabel('Save KML File Path:')
+        self.file_label = QLabel('Save KML/KMZ File Path:')
         self.file_input = QLineEdit(self)
         self.file_input.setReadOnly(True)
         self.file_button = QPushButton('...', self)
@@ -44,6 +497,9 @@ class KMLGeneratorApp(QtWidgets.QWidget):
         file_layout.addWidget(self.file_input)
         file_layout.addWidget(self.file_button)
 
+        # Regionated export for city-scale tables
+        self.regionate_checkbox = QCheckBox("Regionated export (quadtree of KMZ tiles in a folder next to the file)")
+
         # Generate button
         self.generate_button = QPushButton('Generate KML')
         self.generate_button.clicked.connect(self.generate_kml)
@@ -55,6 +511,7 @@ class KMLGeneratorApp(QtWidgets.QWidget):
         
         # Layout
         layout = QVBoxLayout()
+        layout.addWidget(self.profile_selector)
         layout.addWidget(self.user_label)
         layout.addWidget(self.user_input)
         layout.addWidget(self.password_label)
@@ -67,8 +524,13 @@ class KMLGeneratorApp(QtWidgets.QWidget):
         layout.addWidget(self.database_input)
         layout.addWidget(self.table_label)
         layout.addWidget(self.table_input)
+        layout.addWidget(self.columns_label)
+        layout.addWidget(self.columns_input)
+        layout.addWidget(self.filter_label)
+        layout.addLayout(filter_layout)
         layout.addWidget(self.file_label)
         layout.addLayout(file_layout)  # Add the entire file layout
+        layout.addWidget(self.regionate_checkbox)
         layout.addWidget(self.generate_button)
         layout.addWidget(self.console_log)
 
@@ -88,11 +550,17 @@ class KMLGeneratorApp(QtWidgets.QWidget):
         self.setGeometry(100, 100, 800, 600)
 
     def browse_file(self):
-        file_path, _ = QFileDialog.getSaveFileName(self, "Select File", "", "KML Files (*.kml)")
+        file_path, _ = QFileDialog.getSaveFileName(self, "Select File", "", "KMZ Files (*.kmz);;KML Files (*.kml)")
         if file_path:
             self.file_input.setText(file_path)
             self.log_message(f"Selected KML file path: {file_path}")
 
+    def browse_filter(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Export Area", "", "Vector Files (*.gpkg *.geojson *.shp);;All Files (*)")
+        if file_path:
+            self.filter_input.setText(file_path)
+            self.log_message(f"Selected export area: {file_path}")
+
     def generate_kml(self):
         # Get user inputs
         user = self.user_input.text()
@@ -110,52 +578,39 @@ class KMLGeneratorApp(QtWidgets.QWidget):
 
         self.log_message("Starting KML generation...")
 
-        # Create SQLAlchemy engine for PostgreSQL
+        # The export runs on its own thread, the form stays disabled until it is done so a
+        # second export can't start on top of it
         try:
-            engine = create_engine(f'postgresql://{user}:{password}@{host}:{port}/{database}')
-            self.log_message("Connecting to the database...")
-
-            # Query the table and load it into a GeoDataFrame
-            sql_query = f'SELECT * FROM {table_name}'
-            gdf = gpd.read_postgis(sql_query, engine, geom_col='geometry')  # Assuming geometry column is named 'geometry'
-            self.log_message(f"Query executed: {sql_query}")
-
-            # Reproject to geographic coordinates (lat/lon, WGS 84)
-            gdf = gdf.to_crs(epsg=4326)
-            self.log_message("Reprojected GeoDataFrame to WGS 84 (EPSG: 4326)")
-
-            # Initialize KML object
-            kml = Kml()
-
-            # Loop through GeoDataFrame and create KML with extrusion
-            for idx, row in gdf.iterrows():
-                polygon = row['geometry']
-                height = row.get('height', 10)  # Default height to 10 if not present
-
-                if isinstance(polygon, Polygon):  # Check if geometry is a polygon
-                    # Get exterior coordinates (lat/lon)
-                    exterior_coords = [(coord[0], coord[1], 0) for coord in polygon.exterior.coords]
-
-                    # Create a KML polygon with extrusion
-                    pol = kml.newpolygon(name=f'Polygon {idx}',
-                                         outerboundaryis=exterior_coords)
-
-                    pol.extrude = 1  # Enable extrusion
-                    pol.altitudemode = AltitudeMode.relativetoground  # Altitude relative to ground
-                    pol.outerboundaryis = [(coord[0], coord[1], height) for coord in polygon.exterior.coords]  # Add height to each point
-
-                    # Optionally style the polygon
-                    pol.style.polystyle.color = '7d0000ff'  # Red color with transparency
-                    pol.style.polystyle.fill = 1
-
-            # Save KML file
-            kml.save(kml_path)
-            QMessageBox.information(self, 'Success', f'KML file saved at {kml_path}')
-            self.log_message(f"KML file saved at {kml_path}")
-
+            engine = get_engine(self.profile_selector.profile())
         except Exception as e:
             QMessageBox.critical(self, 'Error', f'An error occurred: {str(e)}')
             self.log_message(f"Error: {str(e)}")
+            return
+        self.log_message("Connecting to the database...")
+        self.export_thread = ExportThread(engine, table_name, self.columns_input.text(), self.filter_input.text(),
+                                          self.filter_epsg_input.text(), kml_path, self.regionate_checkbox.isChecked())
+        self.export_thread.output_signal.connect(self.log_message)
+        self.export_thread.finished.connect(self.export_finished)
+        self.set_inputs_enabled(False)
+        self.export_thread.start()
+
+    def export_finished(self):
+        self.set_inputs_enabled(True)
+        error = self.export_thread.error
+        kml_path = self.export_thread.kml_path
+        self.export_thread = None
+        if error is not None:
+            QMessageBox.critical(self, 'Error', f'An error occurred: {error}')
+            self.log_message(f"Error: {error}")
+            return
+        QMessageBox.information(self, 'Success', f'KML file saved at {kml_path}')
+        self.log_message(f"KML file saved at {kml_path}")
+
+    def set_inputs_enabled(self, enabled):
+        for widget in (self.profile_selector, self.user_input, self.password_input, self.host_input, self.port_input,
+                       self.database_input, self.table_input, self.columns_input, self.filter_input, self.filter_button,
+                       self.filter_epsg_input, self.file_button, self.regionate_checkbox, self.generate_button):
+            widget.setEnabled(enabled)
 
     def log_message(self, message):
         self.console_log.append(message)
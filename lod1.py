@@ -1,18 +1,35 @@
 import sys
-import subprocess
 from PyQt5.QtWidgets import (QApplication, QWidget, QPushButton, QVBoxLayout, 
                              QFileDialog, QTextEdit, QLabel, QHBoxLayout, QLineEdit, 
-                             QWidget, QComboBox, QDoubleSpinBox, QCheckBox)
-from PyQt5.QtCore import QThread, pyqtSignal
+                             QWidget, QComboBox, QDoubleSpinBox, QCheckBox, QProgressBar)
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
 from PyQt5.QtGui import QIcon, QPixmap
+from worker import PipelineWorker
 
 # pip install PyQt5
 
+# Titles of the progress bars of each pipeline stage
+STAGE_TITLES = {
+    'filter': 'Filtering Point Cloud',
+    'preprocess': 'Preprocess Footprints',
+    'dtm': 'Generate DTM',
+    'dsm': 'Generate DSM',
+    'ohm': 'OHM Calculation',
+    'zonal': 'Zonal Statistics',
+    'heights': 'Point Heights',
+    'lod1': 'Create 3D City LOD1',
+}
+
+# Interval in milliseconds between two updates of the console log
+LOG_FLUSH_INTERVAL = 200
+
 class ProcessThread(QThread):
     output_signal = pyqtSignal(str)
+    progress_signal = pyqtSignal(object)
 
-    def __init__(self, building_outline, point_cloud, dsm, dtm, epsg_code, output_dir, cloth_resolution, slope, cell_size):
+    def __init__(self, worker, building_outline, point_cloud, dsm, dtm, epsg_code, output_dir, cloth_resolution, slope, cell_size, output_format=None, compress=None, resume=False, height_method=None):
         super().__init__()
+        self.worker = worker
         self.building_outline = building_outline
         self.point_cloud = point_cloud
         self.dsm = dsm
@@ -22,42 +39,69 @@ class ProcessThread(QThread):
         self.cloth_resolution = cloth_resolution
         self.slope = slope
         self.cell_size = cell_size
+        self.output_format = output_format
+        self.compress = compress
+        self.resume = resume
+        self.height_method = height_method
 
     def run(self):
-        # Run the process and capture output
-        command = ['python', 'main.py', '--building_outline', self.building_outline, '--epsg', self.epsg_code, '--output', self.output_dir]
-        
+        # Build the job parameters
+        try:
+            params = {'building_outline': self.building_outline, 'epsg': int(self.epsg_code), 'output_folder': self.output_dir}
+        except ValueError:
+            self.output_signal.emit(f"Error: Invalid EPSG code: {self.epsg_code}")
+            return
+
         if self.point_cloud:
-            command.extend(['--point_cloud', self.point_cloud])
+            params['point_cloud'] = self.point_cloud
             if self.cloth_resolution is not None:
-                command.extend(['--cloth_resolution', str(self.cloth_resolution)])
+                params['cloth_resolution'] = self.cloth_resolution
             if self.slope is not None:
-                command.extend(['--slope', str(self.slope)])
+                params['slope'] = self.slope == "True"
             if self.cell_size is not None:
-                command.extend(['--cell_size', str(self.cell_size)])
+                params['cell_size'] = self.cell_size
         if self.dsm and self.dtm:
-            command.extend(['--dsm', self.dsm, '--dtm', self.dtm])
-        
-        # Run the process and capture output
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
-        
-        # Capture stdout
-        for line in process.stdout:
-            self.output_signal.emit(line.strip())
-
-        # Capture stderr (in case there are errors)
-        for line in process.stderr:
-            self.output_signal.emit(f"Error: {line.strip()}")
-
-        process.stdout.close()
-        process.stderr.close()
-        process.wait()
+            params['dsm'] = self.dsm
+            params['dtm'] = self.dtm
+        # Raster outputs, the OHM is written with given DSM and DTM too
+        if self.output_format:
+            params['output_format'] = self.output_format
+        if self.compress:
+            params['compress'] = self.compress
+        if self.height_method:
+            params['height_method'] = self.height_method
+        if self.resume:
+            params['resume'] = True
+
+        # Run the job in the warm worker process and capture its output
+        job_id = self.worker.submit(params)
+        for kind, message in self.worker.job_events(job_id):
+            if kind == 'progress':
+                self.progress_signal.emit(message)
+            elif kind == 'log':
+                self.output_signal.emit(message)
+            elif kind in ('stderr', 'error'):
+                for line in message.splitlines():
+                    self.output_signal.emit(f"Error: {line.strip()}")
+            elif kind == 'cancelled':
+                self.output_signal.emit(message)
 
 class CityModelGUI(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.initUI()
 
+        # Worker process shared by all runs of this window, so the pipeline modules are only
+        # imported once per session. It is warmed up in the background while the user fills
+        # the form and stopped with the window, or with the application when this is a tab.
+        self.pipeline_worker = PipelineWorker()
+        self.pipeline_worker.start()
+        QApplication.instance().aboutToQuit.connect(self.pipeline_worker.stop)
+
+    def closeEvent(self, event):
+        self.pipeline_worker.stop()
+        super().closeEvent(event)
+
     def initUI(self):
         # Main layout
         layout = QVBoxLayout()
@@ -148,6 +192,21 @@ class CityModelGUI(QWidget):
         self.cell_size = QDoubleSpinBox(self)
         self.cell_size.setValue(1.0)
 
+        self.output_format_label = QLabel('Raster Output Format:')
+        self.output_format_combo = QComboBox()
+        self.output_format_combo.addItem("GTiff")
+        self.output_format_combo.addItem("COG")
+
+        self.compress_label = QLabel('Raster Compression:')
+        self.compress_combo = QComboBox()
+        self.compress_combo.addItem("DEFLATE")
+        self.compress_combo.addItem("ZSTD")
+
+        self.height_method_label = QLabel('Height Method:')
+        self.height_method_combo = QComboBox()
+        self.height_method_combo.addItem("Rasters (DSM/DTM)", "raster")
+        self.height_method_combo.addItem("Points (skip DEMs)", "points")
+
         # Advanced Options Layout
         advanced_layout = QVBoxLayout()
         advanced_layout.addWidget(self.advanced_options_label)
@@ -157,6 +216,12 @@ class CityModelGUI(QWidget):
         advanced_layout.addWidget(self.slope_combo)
         advanced_layout.addWidget(self.cell_size_label)
         advanced_layout.addWidget(self.cell_size)
+        advanced_layout.addWidget(self.output_format_label)
+        advanced_layout.addWidget(self.output_format_combo)
+        advanced_layout.addWidget(self.compress_label)
+        advanced_layout.addWidget(self.compress_combo)
+        advanced_layout.addWidget(self.height_method_label)
+        advanced_layout.addWidget(self.height_method_combo)
 
         # Buttons (Start and Replay)
         buttons_layout = QHBoxLayout()
@@ -166,6 +231,14 @@ class CityModelGUI(QWidget):
         self.start_btn.setMinimumWidth(150)
         self.start_btn.clicked.connect(self.start_process)
 
+        # Cancel Button (stops the running job at its next batch)
+        self.cancel_btn = QPushButton('Cancel', self)
+        self.cancel_btn.setEnabled(False)
+        self.cancel_btn.clicked.connect(self.cancel_process)
+
+        # Resume a previous run in the same output directory
+        self.resume_check = QCheckBox('Resume', self)
+
         # Replay Button (Clear input fields)
         self.replay_btn = QPushButton(self)
         self.replay_btn.setIcon(QIcon("ui/replay.png"))  # Add your replay icon image here
@@ -174,6 +247,8 @@ class CityModelGUI(QWidget):
 
         # Add Start and Replay buttons to layout
         buttons_layout.addWidget(self.start_btn)
+        buttons_layout.addWidget(self.cancel_btn)
+        buttons_layout.addWidget(self.resume_check)
         buttons_layout.addWidget(self.replay_btn)
 
         # Console log
@@ -197,6 +272,18 @@ class CityModelGUI(QWidget):
         layout.addLayout(output_layout)
         layout.addLayout(advanced_layout)
         layout.addLayout(buttons_layout)
+        # Progress bars of the running stages, added as the stages start
+        self.progress_layout = QVBoxLayout()
+        self.progress_bars = {}
+
+        # Log lines are buffered and appended together on a timer
+        self.log_buffer = []
+        self.log_timer = QTimer(self)
+        self.log_timer.setInterval(LOG_FLUSH_INTERVAL)
+        self.log_timer.timeout.connect(self.flush_console_log)
+        self.log_timer.start()
+
+        layout.addLayout(self.progress_layout)
         layout.addWidget(QLabel('Console Log:'))
         layout.addWidget(self.log_console)
 
@@ -224,6 +311,12 @@ class CityModelGUI(QWidget):
         self.slope_combo.setVisible(False)
         self.cell_size_label.setVisible(False)
         self.cell_size.setVisible(False)
+        self.output_format_label.setVisible(False)
+        self.output_format_combo.setVisible(False)
+        self.compress_label.setVisible(False)
+        self.compress_combo.setVisible(False)
+        self.height_method_label.setVisible(False)
+        self.height_method_combo.setVisible(False)
 
         # Set the window icon
         self.setWindowIcon(QIcon("ui/logo.png"))  # Replace with the path to your logo image
@@ -236,12 +329,21 @@ class CityModelGUI(QWidget):
 
     def toggle_advanced_options(self):
         is_visible = self.advanced_options_label.isChecked()
-        self.cloth_resolution_label.setVisible(is_visible)
-        self.cloth_resolution.setVisible(is_visible)
-        self.slope_label.setVisible(is_visible)
-        self.slope_combo.setVisible(is_visible)
-        self.cell_size_label.setVisible(is_visible)
-        self.cell_size.setVisible(is_visible)
+        # Filtering, gridding and height options only apply to a point cloud, the raster
+        # output options to the OHM as well
+        point_options = is_visible and self.method_combo.currentText() == "Use Point Cloud"
+        self.cloth_resolution_label.setVisible(point_options)
+        self.cloth_resolution.setVisible(point_options)
+        self.slope_label.setVisible(point_options)
+        self.slope_combo.setVisible(point_options)
+        self.cell_size_label.setVisible(point_options)
+        self.cell_size.setVisible(point_options)
+        self.output_format_label.setVisible(is_visible)
+        self.output_format_combo.setVisible(is_visible)
+        self.compress_label.setVisible(is_visible)
+        self.compress_combo.setVisible(is_visible)
+        self.height_method_label.setVisible(point_options)
+        self.height_method_combo.setVisible(point_options)
 
         # Update the button label to reflect current state
         self.advanced_options_label.setText('Advanced Options ▼' if not is_visible else 'Advanced Options ▲')
@@ -261,6 +363,7 @@ class CityModelGUI(QWidget):
 
             # Show advanced options button
             self.advanced_options_label.setVisible(True)
+            self.toggle_advanced_options()
 
         elif self.method_combo.currentText() == "Use DSM & DTM":
             self.las_label.setVisible(False)
@@ -274,9 +377,9 @@ class CityModelGUI(QWidget):
             self.dtm_path.setVisible(True)
             self.dtm_btn.setVisible(True)
 
-            # Hide advanced options button and advanced options themselves
-            self.advanced_options_label.setVisible(False)
-            self.toggle_advanced_options()  # Ensure options are hidden
+            # Only the raster output options apply
+            self.advanced_options_label.setVisible(True)
+            self.toggle_advanced_options()
 
     # Functions for selecting files/directories
     def select_geojson_or_shp(self):
@@ -321,6 +424,9 @@ class CityModelGUI(QWidget):
         cloth_resolution = self.cloth_resolution.value() if point_cloud else None
         slope = self.slope_combo.currentText() if point_cloud else None
         cell_size = self.cell_size.value() if point_cloud else None
+        output_format = self.output_format_combo.currentText()
+        compress = self.compress_combo.currentText()
+        height_method = self.height_method_combo.currentData() if point_cloud else None
 
         if not building_outline or not epsg_code or not output_dir:
             self.log_console.append("Error: Please fill all required fields.")
@@ -335,12 +441,57 @@ class CityModelGUI(QWidget):
             return
 
         # Start the process in a separate thread
-        self.process_thread = ProcessThread(building_outline, point_cloud, dsm, dtm, epsg_code, output_dir, cloth_resolution, slope, cell_size)
+        self.process_thread = ProcessThread(self.pipeline_worker, building_outline, point_cloud, dsm, dtm, epsg_code, output_dir, cloth_resolution, slope, cell_size, output_format, compress, self.resume_check.isChecked(), height_method)
         self.process_thread.output_signal.connect(self.update_console_log)
+        self.process_thread.progress_signal.connect(self.update_progress)
+        self.process_thread.finished.connect(self.process_finished)
+        self.start_btn.setEnabled(False)
+        self.cancel_btn.setEnabled(True)
+        self.clear_progress()
         self.process_thread.start()
 
+    def cancel_process(self):
+        self.update_console_log("Cancelling, the job stops at the next batch...")
+        self.cancel_btn.setEnabled(False)
+        self.pipeline_worker.cancel()
+
+    def process_finished(self):
+        self.start_btn.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
+
     def update_console_log(self, message):
-        self.log_console.append(message)
+        self.log_buffer.append(message)
+
+    def flush_console_log(self):
+        if self.log_buffer:
+            self.log_console.append("\n".join(self.log_buffer))
+            self.log_buffer = []
+
+    def update_progress(self, event):
+        stage = event['stage']
+        if stage not in self.progress_bars:
+            label = QLabel(STAGE_TITLES.get(stage, stage))
+            bar = QProgressBar()
+            bar.setRange(0, 1000)
+            self.progress_layout.addWidget(label)
+            self.progress_layout.addWidget(bar)
+            self.progress_bars[stage] = (label, bar)
+
+        # Fraction done, throughput and remaining time of the stage
+        label, bar = self.progress_bars[stage]
+        bar.setValue(int(event['fraction'] * 1000))
+        text = f"{STAGE_TITLES.get(stage, stage)}: {event['done']}/{event['total']} {event['unit']}, {event['rate']:.1f} {event['unit']}/s"
+        if event['eta'] is not None and event['fraction'] < 1:
+            text += f", ETA {event['eta']:.0f} s"
+        label.setText(text)
+
+    def clear_progress(self):
+        for label, bar in self.progress_bars.values():
+            self.progress_layout.removeWidget(label)
+            self.progress_layout.removeWidget(bar)
+            label.deleteLater()
+            bar.deleteLater()
+        self.progress_bars = {}
 
     def clear_inputs(self):
         # Clear all the input fields
@@ -350,7 +501,9 @@ class CityModelGUI(QWidget):
         self.dtm_path.clear()
         self.epsg_code.clear()
         self.output_path.clear()
+        self.log_buffer = []
         self.log_console.clear()
+        self.clear_progress()
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -6,19 +6,61 @@ from osgeo import gdal, gdalconst, osr, ogr #conda install gdal
 import rasterio #pip install rasterio
 import geopandas as gpd #pip install geopandas
 from rasterstats import zonal_stats #pip install rasterstats
-import fiona
+import shapely
 import shapely.geometry as sg
+import pyproj
 import json
 import copy
 import os
 from rasterio.features import geometry_mask
+from rasterio.windows import Window
 from scipy import ndimage
 import sys
+import shutil
+import progress
+import checkpoint
+import vector_io
+from progress import Progress
+import tempfile
+import csv
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import multiprocessing as mp
+import threading
+from resources import available_memory, estimate_job_memory, point_cloud_size, stage_memory, BYTES_PER_POINT, BASE_JOB_BYTES, LAS_CHUNK_SIZE, RASTER_BLOCK_SIZE, FILL_ITERATIONS, FILL_HALO
 gdal.UseExceptions()
 gdal.DontUseExceptions()
 
 dir = os.path.dirname(os.path.abspath(__file__))
 
+# NoData value used for raster outputs
+NODATA = -9999.0
+
+# Buildings per checkpointed batch of zonal statistics and extrusion
+ZONAL_BATCH_SIZE = 1000
+
+# Point-based heights: points tested against the footprints at a time, width in map units
+# of the ring around each footprint whose ground points give its ground level, and
+# percentile of the non-ground points inside a footprint taken as its roof level
+POINT_QUERY_CHUNK_SIZE = 1_000_000
+GROUND_RING_WIDTH = 5.0
+ROOF_PERCENTILE = 50
+
+# Footprint preprocessing: vertices closer than the tolerance (map units, metres for a
+# projected CRS) are merged and vertices within it of a straight line removed, footprints
+# smaller than the minimum area or less compact than the sliver ratio (4 pi A / P^2) dropped.
+# A sliver ratio of 0 keeps every footprint regardless of its shape.
+SIMPLIFY_TOLERANCE = 0.1
+MIN_FOOTPRINT_AREA = 1.0
+SLIVER_RATIO = 0.05
+
+# Metres per degree, to apply the tolerances to footprints in a geographic CRS
+METRES_PER_DEGREE = 111320.0
+
+# Ids of dropped footprints listed on the console, the report holds all of them
+DROPPED_IDS_SHOWN = 20
+LOD1_BATCH_SIZE = 1000
+
 def read_las(input_file):  
     # Read ground point cloud data from the input file
     lasfile = laspy.read(input_file)
@@ -36,7 +78,7 @@ def read_las(input_file):
 
     return data
 
-def save_las(result):
+def save_las(result, output_folder, file_name="ground.las"):
     header = laspy.LasHeader(point_format=2, version="1.2")
     las = laspy.LasData(header)
     las.x = result[:, 0]
@@ -45,13 +87,10 @@ def save_las(result):
     las.red = result[:, 3]
     las.green = result[:, 4]
     las.blue = result[:, 5]
-    las.write(os.path.join(output_folder, "ground.las"))
-
-def csf_filter(input_file, cloth_resolution, slope):
-    # read las file
-    data = read_las(input_file)
-    xyz = data[:, :3]
+    las.write(os.path.join(output_folder, file_name))
 
+def csf_ground(xyz, cloth_resolution, slope):
+    # Boolean mask of the ground points of a cloud
     csf = CSF.CSF()
 
     # prameter settings
@@ -68,157 +107,552 @@ def csf_filter(input_file, cloth_resolution, slope):
     non_ground = CSF.VecInt() # a list to indicate the index of non-ground points after calculation
     csf.do_filtering(ground, non_ground) # do actual filtering.
 
-    # Convert filtering result to array
-    ground_arr = np.array(ground)
-    non_ground_arr = np.array(non_ground)
-
-    # Create an array for classification with zeros for non-ground points and ones for ground points
-    classification_ground = np.ones_like(ground_arr)
-    classification_non_ground = np.zeros_like(non_ground_arr)
+    mask = np.zeros(len(xyz), dtype=bool)
+    mask[np.array(ground, dtype=np.int64)] = True
+    return mask
 
-    # Combine the ground and non-ground classification arrays
-    classification = np.concatenate((classification_non_ground, classification_ground), axis=0)
-
-    # Combine the X, Y, Z, R, G, B, and classification arrays for ground and non-ground
-    ground_data = np.column_stack((ground_arr, classification_ground))
-    non_ground_data = np.column_stack((non_ground_arr, classification_non_ground))
+def csf_filter(input_file, cloth_resolution, slope, output_folder, save_non_ground=False):
+    # read las file
+    data = read_las(input_file)
+    xyz = data[:, :3]
 
-    # Combine the ground and non-ground data arrays
-    result = np.concatenate((ground_data, non_ground_data), axis=0)
+    stage = Progress("filter", len(xyz), "points")
+    ground = csf_ground(xyz, cloth_resolution, slope)
+    stage.update(len(xyz))
 
-    # Sort the result array based on the original point IDs
-    result = result[result[:, 0].argsort()]
+    # Add the classification column (1 for ground, 0 for non-ground) to the original data array
+    result = np.column_stack((data, ground))
 
-    # Extract the second column (classification) from the result array
-    classification_column = result[:, 1]
+    # Non-ground points are kept too for point-based building heights
+    if save_non_ground:
+        save_las(result[result[:, -1] == 0], output_folder, "non_ground.las")
 
-    # Add the classification column to the original data array
-    result = np.column_stack((data, classification_column))
-    
     # Filter to store ground only
     result = result[result[:, -1] == 1] # -1 for last column, 1 for ground label
 
-    save_las(result)
-
-def create_dem(input_file, output_file, cell_size, epsg, dem_type):
-    # Read point cloud data
+    save_las(result, output_folder)
+
+def sweep_worker(shm_name, count, cloth_resolution, slope, xmin, ymin, cell_size, height, width, output_file, mask_file=None):
+    # Ground points of one CSF setting on the shared cloud, gridded and gap-filled into a
+    # DTM saved as .npy, and the ground mask too if mask_file is given
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        xyz = np.ndarray((count, 3), dtype=np.float64, buffer=shm.buf)
+        ground = csf_ground(xyz, cloth_resolution, slope)
+        if mask_file:
+            np.save(mask_file, ground)
+        rows, cols, z = grid_points(xyz[ground, 0], xyz[ground, 1], xyz[ground, 2], xmin, ymin, cell_size, height, width)
+        del xyz
+    finally:
+        shm.close()
+    np.save(output_file, build_dem_strip(rows, cols, z, 0, height, height, width, "DTM"))
+    return int(ground.sum())
+
+def csf_sweep(input_file, epsg, output_folder, cloth_resolutions, slopes, cloth_resolution=2.0, slope=True, cell_size=1.0,
+              output_format="GTiff", compress="DEFLATE", workers=0, scratch_dir=None):
+    # Run CSF for every combination of cloth resolution and slope on one loaded cloud,
+    # shared with the worker processes, and compare the DTMs with the one of the chosen
+    # setting. By default (workers 0) as many processes run as there are cores and their
+    # estimated memory fits next to the shared cloud.
+    combinations = [(float(resolution), bool(smooth)) for resolution in cloth_resolutions for smooth in slopes]
+    chosen = (float(cloth_resolution), bool(slope))
+    if chosen not in combinations:
+        combinations.append(chosen)
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Load the cloud once into shared memory, every DTM uses the grid of the whole cloud
+    xyz = read_las(input_file)[:, :3]
+    count = len(xyz)
+    shm = shared_memory.SharedMemory(create=True, size=max(xyz.nbytes, 1))
+    shared = np.ndarray((count, 3), dtype=np.float64, buffer=shm.buf)
+    shared[:] = xyz
+    del xyz
+    xmin, xmax, ymin, ymax = shared[:, 0].min(), shared[:, 0].max(), shared[:, 1].min(), shared[:, 1].max()
+    width, height = len(np.arange(xmin, xmax, cell_size)), len(np.arange(ymin, ymax, cell_size))
+    if workers is None or workers <= 0:
+        worker_memory = estimate_job_memory({"point_cloud": input_file, "cell_size": cell_size, "stage_jobs": 1})
+        workers = max(1, min(os.cpu_count() or 1, len(combinations), available_memory() // worker_memory))
+        print(f"Sweeping {len(combinations)} settings in {workers} processes")
+
+    sweep_dir = tempfile.mkdtemp(prefix="sweep_", dir=scratch_dir or output_folder)
+    paths = [os.path.join(sweep_dir, f"dtm_{index}.npy") for index in range(len(combinations))]
+    mask_path = os.path.join(sweep_dir, "ground.npy")
+    ground_points = [0] * len(combinations)
+    stage = Progress("sweep", len(combinations), "settings")
+    try:
+        args = [(shm.name, count, resolution, smooth, xmin, ymin, cell_size, height, width, path,
+                 mask_path if (resolution, smooth) == chosen else None)
+                for (resolution, smooth), path in zip(combinations, paths)]
+        if workers == 1:
+            for index, task in enumerate(args):
+                checkpoint.check_cancelled()
+                ground_points[index] = sweep_worker(*task)
+                stage.advance()
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(combinations))) as executor:
+                futures = {executor.submit(sweep_worker, *task): index for index, task in enumerate(args)}
+                for future in as_completed(futures):
+                    checkpoint.check_cancelled()
+                    ground_points[futures[future]] = future.result()
+                    stage.advance()
+
+        # Differences of every DTM to the one of the chosen setting, over the cells both have
+        # on the common grid of the whole cloud
+        reference = np.load(paths[combinations.index(chosen)])
+        rows = []
+        for (resolution, smooth), path, points in zip(combinations, paths, ground_points):
+            diff = np.load(path, mmap_mode="r") - reference
+            diff = diff[~np.isnan(diff)]
+            rows.append({
+                "cloth_resolution": resolution,
+                "slope": smooth,
+                "chosen": (resolution, smooth) == chosen,
+                "ground_points": points,
+                "ground_fraction": round(points / count, 4) if count else 0.0,
+                "dtm_mean_diff": round(float(diff.mean()), 3) if diff.size else None,
+                "dtm_mean_abs_diff": round(float(np.abs(diff).mean()), 3) if diff.size else None,
+                "dtm_rmse": round(float(np.sqrt(np.mean(diff ** 2))), 3) if diff.size else None,
+                "dtm_max_abs_diff": round(float(np.abs(diff).max()), 3) if diff.size else None,
+            })
+            print(f"cloth_resolution {resolution}, slope {smooth}: {points} ground points ({rows[-1]['ground_fraction']:.1%}), "
+                  f"DTM RMSE {rows[-1]['dtm_rmse']} to the chosen setting")
+
+        del reference
+        ground = np.load(mask_path)
+    finally:
+        shared = None
+        shm.close()
+        shm.unlink()
+        shutil.rmtree(sweep_dir, ignore_errors=True)
+
+    # The kept DTM is built like the DTM stage of run_pipeline, from ground.las of the chosen
+    # setting on the grid of its ground points
     data = read_las(input_file)
+    save_las(data[ground], output_folder)
+    del data, ground
+    create_dem(os.path.join(output_folder, "ground.las"), os.path.join(output_folder, "dtm.tif"), cell_size, epsg, "DTM",
+               output_format, compress, workers, scratch_dir=scratch_dir)
+
+    report_path = os.path.join(output_folder, "csf_sweep.csv")
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Sweep report written to {report_path}")
+    return rows
+
+def create_dem(input_file, output_file, cell_size, epsg, dem_type, output_format="GTiff", compress="DEFLATE", workers=1,
+               workspace="memory", scratch_dir=None):
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
+
+    if workspace == "memmap":
+        # Stream the point cloud in chunks instead of holding it in memory
+        xmin, xmax, ymin, ymax = las_extent(input_file)
+        point_chunks = read_las_chunks(input_file)
+    else:
+        # Read point cloud data
+        data = read_las(input_file)
 
-    # Extract x, y, and z coordinates
-    x = data[:, 0]
-    y = data[:, 1]
-    z = data[:, 2]
-    
-    # Define the extent of the DTM
-    xmin, xmax, ymin, ymax = min(x), max(x), min(y), max(y)
+        # Extract x, y, and z coordinates
+        x = data[:, 0]
+        y = data[:, 1]
+        z = data[:, 2]
+        del data
+
+        # Define the extent of the DTM
+        xmin, xmax, ymin, ymax = min(x), max(x), min(y), max(y)
+        point_chunks = [(x, y, z)]
 
     # Create a grid based on the specified cell size
     x_grid = np.arange(xmin, xmax, cell_size)
     y_grid = np.arange(ymin, ymax, cell_size)
+    height, width = len(y_grid), len(x_grid)
 
-    # Create a meshgrid
-    X, Y = np.meshgrid(x_grid, y_grid)
-
-    # Initialize Z array with NaN values and a count array
-    Z = np.full_like(X, fill_value=np.nan, dtype=np.float32)  # Initialize with NaN
-    count = np.zeros_like(X, dtype=int)  # Count of points contributing to each cell
-    
-    for i in range(len(x)):
-        # Find the corresponding grid cell
-        col = int((x[i] - xmin) / cell_size)
-        row = int((y[i] - ymin) / cell_size)
-    
-        # Ensure that the point is within the valid range of the grid
-        if 0 <= row < Z.shape[0] and 0 <= col < Z.shape[1]:
-            # Update the Z value and count for each grid cell
-            if dem_type == "DTM":
-                # Use minimum value for DTM
-                if np.isnan(Z[row, col]) or z[i] < Z[row, col]:
-                    Z[row, col] = z[i]
-            elif dem_type == "DSM":
-                # Use maximum value for DSM
-                if np.isnan(Z[row, col]) or z[i] > Z[row, col]:
-                    Z[row, col] = z[i]
-            count[row, col] += 1
-    
-    # Interpolate NoData values by averaging neighboring cells
-    no_data_mask = np.isnan(Z)
-    
-    # Number of iterations for interpolation
-    num_iterations = 15
-    
-    for iteration in range(num_iterations):
-        for row in range(Z.shape[0]):
-            for col in range(Z.shape[1]):
-                if no_data_mask[row, col]:
-                    # Define the neighborhood of the current cell, enlarging at each iteration
-                    neighborhood = Z[max(0, row - iteration):min(Z.shape[0], row + iteration + 1),
-                                      max(0, col - iteration):min(Z.shape[1], col + iteration + 1)]
-    
-                    # Exclude NaN values from the neighborhood
-                    valid_neighbors = neighborhood[~np.isnan(neighborhood)]
-    
-                    # Interpolate the NoData value by averaging valid neighbors
-                    if len(valid_neighbors) > 0:
-                        Z[row, col] = np.mean(valid_neighbors)
-    
     # # Apply Gaussian smoothing to the resulting DTM
     # sigma = 15.0  # Adjust the standard deviation based on your requirements
     # Z = ndimage.gaussian_filter(Z, sigma=sigma)
 
-    # Set up the GeoTIFF driver
-    driver = gdal.GetDriverByName("GTiff")
-
-    # Create the output GeoTIFF file
-    dtm_ds = driver.Create(output_file, len(x_grid), len(y_grid), 1, gdal.GDT_Float32)
+    # Bin and gap-fill the whole grid in one piece
+    if workspace != "memmap" and workers == 1:
+        stage = Progress(dem_type.lower(), 1, "grids")
+        rows, cols, z = grid_points(x, y, z, xmin, ymin, cell_size, height, width)
+        Z = build_dem_strip(rows, cols, z, 0, height, height, width, dem_type)
+        stage.advance()
+        write_dem(Z, output_file, xmin, ymin, cell_size, epsg, output_format, compress)
+        return
+
+    # Or in row strips backed by scratch files, about two strips per worker in memory
+    # and one raster block per strip when the grid may not fit in memory
+    if workspace == "memmap":
+        strip_rows = RASTER_BLOCK_SIZE
+    else:
+        strip_rows = -(-height // (workers * 2))
+        strip_rows = max(RASTER_BLOCK_SIZE, -(-strip_rows // RASTER_BLOCK_SIZE) * RASTER_BLOCK_SIZE)
+
+    scratch_dir = tempfile.mkdtemp(prefix="dem_", dir=scratch_dir or os.path.dirname(os.path.abspath(output_file)))
+    try:
+        Z = build_dem_strips(point_chunks, xmin, ymin, cell_size, height, width, dem_type, workers, strip_rows, scratch_dir)
+        write_dem(Z, output_file, xmin, ymin, cell_size, epsg, output_format, compress)
+        del Z
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def read_las_chunks(input_file, chunk_size=LAS_CHUNK_SIZE):
+    # Yield x, y, z coordinates of the point cloud chunk by chunk
+    with laspy.open(input_file) as reader:
+        for points in reader.chunk_iterator(chunk_size):
+            yield np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+
+def las_extent(input_file):
+    # Exact extent of the points, the header bounds can be rounded
+    xmin = ymin = np.inf
+    xmax = ymax = -np.inf
+    for x, y, z in read_las_chunks(input_file):
+        if len(x) == 0:
+            continue
+        xmin, xmax = min(xmin, x.min()), max(xmax, x.max())
+        ymin, ymax = min(ymin, y.min()), max(ymax, y.max())
+    return xmin, xmax, ymin, ymax
+
+def grid_points(x, y, z, xmin, ymin, cell_size, height, width):
+    # Find the corresponding grid cell of every point and keep the ones inside the grid
+    cols = ((x - xmin) / cell_size).astype(np.int64)
+    rows = ((y - ymin) / cell_size).astype(np.int64)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return rows[inside], cols[inside], np.asarray(z[inside], dtype=np.float32)
+
+def bin_points(rows, cols, z, shape, dem_type):
+    # Initialize Z array with NaN values
+    Z = np.full(shape, fill_value=np.nan, dtype=np.float32)
+
+    # Use minimum value for DTM and maximum value for DSM (fmin/fmax ignore the NaN start value)
+    reduce = np.fmin if dem_type == "DTM" else np.fmax
+    reduce.at(Z.reshape(-1), rows * shape[1] + cols, z)
+
+    return Z
+
+def box_sum(a, radius):
+    # Sum over a (2 * radius + 1) square window clipped at the array edges. The terms
+    # are always added in the same order, so a cell gets the same result whether it
+    # is computed on the full grid or on a strip holding its whole neighbourhood.
+    for axis in (0, 1):
+        out = a.copy()
+        n = a.shape[axis]
+        for shift in range(1, min(radius, n - 1) + 1):
+            if axis == 0:
+                out[shift:] += a[:-shift]
+                out[:-shift] += a[shift:]
+            else:
+                out[:, shift:] += a[:, :-shift]
+                out[:, :-shift] += a[:, shift:]
+        a = out
+    return a
+
+def fill_nodata(Z, num_iterations=FILL_ITERATIONS):
+    # Interpolate NoData values by averaging neighboring cells
+    no_data_mask = np.isnan(Z)
+    if not no_data_mask.any():
+        return Z
 
+    for iteration in range(num_iterations):
+        # Average the valid cells of a neighborhood enlarging at each iteration
+        valid = ~np.isnan(Z)
+        total = box_sum(np.where(valid, Z, 0).astype(np.float64), iteration)
+        n = box_sum(valid.astype(np.int32), iteration)
+
+        # Interpolate the NoData cells that have valid neighbors
+        fill = no_data_mask & (n > 0)
+        Z = np.where(fill, total / np.maximum(n, 1), Z).astype(np.float32)
+
+    return Z
+
+def build_dem_strip(rows, cols, z, row_start, row_stop, height, width, dem_type):
+    # Rows [row_start, row_stop) plus a halo deep enough for the gap-fill to see every
+    # neighbour it would see on the full grid. Points are expected to be limited to the
+    # haloed rows already.
+    halo_start = max(0, row_start - FILL_HALO)
+    halo_stop = min(height, row_stop + FILL_HALO)
+
+    Z = bin_points(rows - halo_start, cols, z, (halo_stop - halo_start, width), dem_type)
+    Z = fill_nodata(Z)
+
+    return Z[row_start - halo_start:row_stop - halo_start]
+
+def build_dem_strips(point_chunks, xmin, ymin, cell_size, height, width, dem_type, workers, strip_rows, scratch_dir):
+    strips = [(start, min(start + strip_rows, height)) for start in range(0, height, strip_rows)]
+
+    # Distribute the points to the strip files
+    for x, y, z in point_chunks:
+        rows, cols, z = grid_points(x, y, z, xmin, ymin, cell_size, height, width)
+        partition_points(rows, cols, z, strip_rows, len(strips), scratch_dir)
+
+    # Output grid shared by all strips, each one writes its own rows
+    Z = np.lib.format.open_memmap(os.path.join(scratch_dir, "dem.npy"), mode="w+", dtype=np.float32, shape=(height, width))
+    del Z
+
+    stage = Progress(dem_type.lower(), len(strips), "strips")
+    if workers == 1:
+        for index, (start, stop) in enumerate(strips):
+            checkpoint.check_cancelled()
+            dem_strip_worker(scratch_dir, index, start, stop, height, width, dem_type)
+            stage.advance()
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(strips))) as executor:
+            futures = [executor.submit(dem_strip_worker, scratch_dir, index, start, stop, height, width, dem_type)
+                       for index, (start, stop) in enumerate(strips)]
+            for future in as_completed(futures):
+                future.result()
+                stage.advance()
+
+    return np.load(os.path.join(scratch_dir, "dem.npy"), mmap_mode="r")
+
+def partition_points(rows, cols, z, strip_rows, num_strips, scratch_dir):
+    # Every point goes to its own strip, and to the neighbouring strip when it lies in
+    # that strip's halo (strips are always taller than the halo)
+    core = rows // strip_rows
+    offset = rows - core * strip_rows
+    for strip, mask in ((core, None), (core - 1, offset < FILL_HALO), (core + 1, offset >= strip_rows - FILL_HALO)):
+        if mask is not None:
+            strip, point_rows, point_cols, point_z = strip[mask], rows[mask], cols[mask], z[mask]
+        else:
+            point_rows, point_cols, point_z = rows, cols, z
+
+        # Append each strip's points to its files
+        order = np.argsort(strip, kind="stable")
+        strip = strip[order]
+        bounds = np.searchsorted(strip, np.arange(num_strips + 1))
+        for index in range(num_strips):
+            first, last = bounds[index], bounds[index + 1]
+            if first == last:
+                continue
+            selection = order[first:last]
+            for name, values in (("rows", point_rows), ("cols", point_cols), ("z", point_z)):
+                with open(os.path.join(scratch_dir, f"strip_{index}.{name}"), "ab") as f:
+                    values[selection].tofile(f)
+
+def read_strip_points(scratch_dir, index):
+    points = []
+    for name, dtype in (("rows", np.int64), ("cols", np.int64), ("z", np.float32)):
+        path = os.path.join(scratch_dir, f"strip_{index}.{name}")
+        points.append(np.fromfile(path, dtype=dtype) if os.path.exists(path) else np.empty(0, dtype=dtype))
+    return points
+
+def dem_strip_worker(scratch_dir, index, row_start, row_stop, height, width, dem_type):
+    # Points falling into the strip and its halo
+    rows, cols, z = read_strip_points(scratch_dir, index)
+    strip = build_dem_strip(rows, cols, z, row_start, row_stop, height, width, dem_type)
+
+    Z = np.load(os.path.join(scratch_dir, "dem.npy"), mmap_mode="r+")
+    Z[row_start:row_stop] = strip
+    Z.flush()
+
+def write_dem(Z, output_file, xmin, ymin, cell_size, epsg, output_format="GTiff", compress="DEFLATE"):
     # Define the spatial reference system
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(epsg)  # Assuming WGS84
 
-    # Set the geotransform (origin and pixel size)
-    dtm_ds.SetGeoTransform((xmin, cell_size, 0, ymin, 0, cell_size))
-
-    # Set the spatial reference
-    dtm_ds.SetProjection(srs.ExportToWkt())
+    # Create the output raster (origin and pixel size) and write it block by block
+    dem_ds = open_raster_writer(output_file, Z.shape[1], Z.shape[0], (xmin, cell_size, 0, ymin, 0, cell_size),
+                                srs.ExportToWkt(), output_format, compress)
+    for row in range(0, Z.shape[0], RASTER_BLOCK_SIZE):
+        write_raster_block(dem_ds, Z[row:row + RASTER_BLOCK_SIZE], row)
 
-    # Write the DTM data to the GeoTIFF
-    dtm_ds.GetRasterBand(1).WriteArray(Z)
+    # Close the dataset (and convert it to COG if requested)
+    dem_ds = None
+    finalize_raster(output_file, output_format, compress)
 
-    # Close the GeoTIFF dataset
-    dtm_ds = None
+def open_raster_writer(output_file, width, height, geotransform, projection, output_format="GTiff", compress="DEFLATE"):
+    driver = gdal.GetDriverByName("GTiff")
 
-def create_ohm(dsm_path, dtm_path, output_path):
+    if output_format == "COG":
+        # COG driver only supports CreateCopy, so write a tiled and compressed
+        # temporary GeoTIFF first and copy it into the final layout on close
+        options = ["TILED=YES", f"BLOCKXSIZE={RASTER_BLOCK_SIZE}", f"BLOCKYSIZE={RASTER_BLOCK_SIZE}",
+                   f"COMPRESS={compress}", "PREDICTOR=3", "BIGTIFF=IF_SAFER"]
+        ds = driver.Create(output_file + ".tmp.tif", width, height, 1, gdal.GDT_Float32, options=options)
+    else:
+        # Plain striped GeoTIFF
+        ds = driver.Create(output_file, width, height, 1, gdal.GDT_Float32)
+
+    if ds is None:
+        raise RuntimeError(f"Failed to create raster: {output_file}")
+
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(projection)
+    ds.GetRasterBand(1).SetNoDataValue(NODATA)
+
+    return ds
+
+def write_raster_block(ds, block, row_offset):
+    # Replace empty cells (NaN or masked) with the NoData value before writing
+    if np.ma.isMaskedArray(block):
+        block = block.filled(np.nan)
+    block = np.where(np.isnan(block), NODATA, block).astype(np.float32)
+    ds.GetRasterBand(1).WriteArray(block, 0, row_offset)
+
+def finalize_raster(output_file, output_format="GTiff", compress="DEFLATE"):
+    if output_format != "COG":
+        return
+
+    # Copy the temporary tiled GeoTIFF into a COG with overviews
+    tmp_file = output_file + ".tmp.tif"
+    tmp_ds = gdal.Open(tmp_file)
+    options = [f"COMPRESS={compress}", "PREDICTOR=YES", f"BLOCKSIZE={RASTER_BLOCK_SIZE}",
+               "OVERVIEWS=AUTO", "RESAMPLING=AVERAGE", "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS"]
+    cog_ds = gdal.GetDriverByName("COG").CreateCopy(output_file, tmp_ds, options=options)
+    tmp_ds = None
+    gdal.GetDriverByName("GTiff").Delete(tmp_file)
+
+    if cog_ds is None:
+        raise RuntimeError(f"Failed to write COG: {output_file}")
+    cog_ds = None
+
+def create_ohm(dsm_path, dtm_path, output_path, output_format="GTiff", compress="DEFLATE"):
     # Open DSM and DTM raster files
     with rasterio.open(dsm_path) as dsm_src, rasterio.open(dtm_path) as dtm_src:
-        # Read raster data as numpy arrays
-        dsm = dsm_src.read(1, masked=True)
-        dtm = dtm_src.read(1, masked=True)
-
-        # Check dimensions and adjust if necessary
-        if dsm.shape != dtm.shape:
-            # Calculate new dimensions
-            min_height = min(dsm.shape[0], dtm.shape[0])
-            min_width = min(dsm.shape[1], dtm.shape[1])
-            
-            # Crop both arrays to the minimum dimensions
-            dsm = dsm[:min_height, :min_width]
-            dtm = dtm[:min_height, :min_width]
-        
-        # Subtract DTM from DSM to create OHM
-        ohm = dsm - dtm
-
-        # Update the metadata for the output file
-        meta = dsm_src.meta.copy()
-        meta.update(dtype=rasterio.float32, count=1)
-
-        # Write the OHM to a new raster file
-        with rasterio.open(output_path, 'w', **meta) as dst:
-            dst.write(ohm.astype(rasterio.float32), 1)
-
-def zonal_statistics(vector_path, ohm, epsg):
+        # Check dimensions and crop both rasters to the minimum dimensions if necessary
+        height = min(dsm_src.height, dtm_src.height)
+        width = min(dsm_src.width, dtm_src.width)
+
+        # Create the output raster with the DSM georeference
+        ohm_ds = open_raster_writer(output_path, width, height, dsm_src.transform.to_gdal(),
+                                    dsm_src.crs.to_wkt() if dsm_src.crs else "", output_format, compress)
+
+        # Subtract DTM from DSM block by block to create OHM
+        stage = Progress("ohm", -(-height // RASTER_BLOCK_SIZE), "blocks")
+        for row in range(0, height, RASTER_BLOCK_SIZE):
+            window = Window(0, row, width, min(RASTER_BLOCK_SIZE, height - row))
+            dsm = dsm_src.read(1, window=window, masked=True)
+            dtm = dtm_src.read(1, window=window, masked=True)
+            ohm = dsm.astype(np.float32) - dtm.astype(np.float32)
+            write_raster_block(ohm_ds, ohm, row)
+            stage.advance()
+
+    # Close the dataset (and convert it to COG if requested)
+    ohm_ds = None
+    finalize_raster(output_path, output_format, compress)
+
+def orient_footprints(geometries):
+    # Exterior rings counter-clockwise and holes clockwise
+    if hasattr(shapely, "orient_polygons"):  # shapely >= 2.1
+        return shapely.orient_polygons(geometries)
+    def orient(geometry):
+        if isinstance(geometry, sg.MultiPolygon):
+            return sg.MultiPolygon([sg.polygon.orient(part) for part in geometry.geoms])
+        return sg.polygon.orient(geometry) if isinstance(geometry, sg.Polygon) else geometry
+    return np.array([orient(geometry) for geometry in geometries], dtype=object)
+
+def polygonal_parts(geometries):
+    # Polygon or MultiPolygon made of the polygons of every geometry, None if it has none
+    parts, index = shapely.get_parts(geometries, return_index=True)
+    polygons = shapely.get_type_id(parts) == 3
+    parts, index = parts[polygons], index[polygons]
+    result = np.full(len(geometries), None, dtype=object)
+    if len(parts):
+        counts = np.bincount(index, minlength=len(geometries))
+        single = counts[index] == 1
+        result[index[single]] = parts[single]
+        if not single.all():
+            multi_index = index[~single]
+            owners = np.unique(multi_index)
+            result[owners] = shapely.multipolygons(parts[~single], indices=np.searchsorted(owners, multi_index))
+    return result
+
+def footprint_vertices(geometries):
+    # Vertices of all rings without their closing points, a ring extrudes one wall per vertex
+    rings = shapely.get_rings(shapely.get_parts(geometries))
+    return int(shapely.get_num_coordinates(rings).sum()) - len(rings)
+
+def preprocess_footprints(vector_path, output_path, epsg, tolerance=SIMPLIFY_TOLERANCE, min_area=MIN_FOOTPRINT_AREA,
+                          sliver_ratio=SLIVER_RATIO):
+    # Validate, orient, simplify and deduplicate all footprints with array operations, and
+    # report how much the extrusion is spared
+    gdf = vector_io.read_vector(vector_path)
+    stage = Progress("preprocess", 4, "steps")
+    if pyproj.CRS.from_epsg(epsg).is_geographic:
+        tolerance, min_area = tolerance / METRES_PER_DEGREE, min_area / METRES_PER_DEGREE ** 2
+    count = len(gdf)
+    vertices_before = footprint_vertices(gdf.geometry.values)
+
+    # Repair invalid geometries and keep their polygons only
+    geometries = gdf.geometry.values
+    invalid = ~shapely.is_valid(geometries) & ~shapely.is_missing(geometries)
+    geometries = np.asarray(geometries, dtype=object).copy()
+    geometries[invalid] = shapely.make_valid(geometries[invalid])
+    geometries = polygonal_parts(geometries)
+    stage.advance()
+
+    # Merge repeated vertices and drop the ones within the tolerance of a straight line
+    geometries = shapely.remove_repeated_points(geometries, tolerance)
+    geometries = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    geometries = polygonal_parts(geometries)
+    stage.advance()
+
+    # Same ring orientation everywhere
+    keep = ~shapely.is_missing(geometries) & ~shapely.is_empty(geometries)
+    geometries[keep] = orient_footprints(geometries[keep])
+    stage.advance()
+
+    # Every polygon of a multipart footprint (given so or split by the repair) is kept as a
+    # footprint of its own, as the LOD1 model holds one building per id. Tiny and sliver
+    # polygons are dropped.
+    parts, owner = shapely.get_parts(np.where(keep, geometries, None), return_index=True)
+    area = shapely.area(parts)
+    perimeter = shapely.length(parts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        compactness = 4 * np.pi * area / perimeter ** 2
+    keep_part = area >= min_area
+    if sliver_ratio > 0:
+        keep_part &= compactness >= sliver_ratio
+    parts, owner = parts[keep_part], owner[keep_part]
+    id_column = next((column for column in ("id", "Id") if column in gdf.columns), None)
+    source_ids = gdf[id_column].to_numpy(dtype=object) if id_column is not None else np.arange(count)
+    gdf = gdf.iloc[owner].reset_index(drop=True)
+    gdf = gdf.set_geometry(gpd.GeoSeries(parts, index=gdf.index, crs=gdf.crs))
+
+    # Parts of one footprint share its attributes, their ids get the part number as suffix
+    part_counts = np.bincount(owner, minlength=count)
+    split = part_counts[owner] > 1
+    if id_column is not None and split.any():
+        part_number = np.arange(len(owner)) - np.searchsorted(owner, owner)
+        ids = gdf[id_column].astype(str).to_numpy(dtype=object)
+        ids[split] = [f"{value}-{number + 1}" for value, number in zip(ids[split], part_number[split])]
+        gdf[id_column] = ids
+    stage.advance()
+
+    # Footprints of the input left out of the model entirely, by id or else by row
+    dropped = np.flatnonzero(part_counts == 0)
+    dropped_ids = [value.item() if hasattr(value, "item") else value for value in source_ids[dropped]]
+
+    removed = vertices_before - footprint_vertices(gdf.geometry.values)
+    report = {
+        "footprints": count,
+        "repaired": int(invalid.sum()),
+        "dropped": len(dropped),
+        "dropped_ids": dropped_ids,
+        "split": int((part_counts > 1).sum()),
+        "vertices_before": vertices_before,
+        "vertices_removed": removed,
+        "walls_removed": removed,
+    }
+    print(f"Footprints: {report['repaired']} repaired, {report['split']} split into parts, {report['dropped']} dropped, "
+          f"{removed} of {vertices_before} vertices removed ({removed} fewer walls)")
+    if dropped_ids:
+        shown = ", ".join(str(value) for value in dropped_ids[:DROPPED_IDS_SHOWN])
+        more = f" and {len(dropped_ids) - DROPPED_IDS_SHOWN} more" if len(dropped_ids) > DROPPED_IDS_SHOWN else ""
+        print(f"Dropped footprints (empty, too small or sliver-shaped) with {id_column or 'row'}: {shown}{more}")
+    checkpoint.write_json(os.path.join(os.path.dirname(output_path), "preprocess_report.json"), report)
+    vector_io.write_vector(gdf, output_path)
+    return report
+
+def zonal_statistics(vector_path, ohm, epsg, output_folder, output_path=None):
     # Load vector data
-    gdf = gpd.read_file(vector_path)
+    gdf = vector_io.read_vector(vector_path)
+
+    # Finished batches of a previous run with the same inputs are reused
+    batches = checkpoint.batch_folder(output_folder, "zonal", {"vector": checkpoint.file_signature(vector_path),
+                                                               "ohm": checkpoint.file_signature(ohm)})
 
     # Load raster data
     with rasterio.open(ohm) as raster:
@@ -252,8 +686,21 @@ def zonal_statistics(vector_path, ohm, epsg):
 
             return mean_values
 
-        # Compute zonal statistics
-        mean_values = compute_zonal_statistics(gdf, raster)
+        # Compute zonal statistics in batches of buildings, saving each finished batch
+        mean_values = []
+        stage = Progress("zonal", len(gdf), "buildings")
+        for start in range(0, len(gdf), ZONAL_BATCH_SIZE):
+            checkpoint.check_cancelled()
+            batch_path = os.path.join(batches, f"{start}.npy")
+            if os.path.exists(batch_path):
+                batch_values = np.load(batch_path)
+            else:
+                batch_values = np.array(compute_zonal_statistics(gdf.iloc[start:start + ZONAL_BATCH_SIZE], raster), dtype=np.float64)
+                with open(batch_path + ".tmp", "wb") as f:
+                    np.save(f, batch_values)
+                os.replace(batch_path + ".tmp", batch_path)
+            mean_values.extend(batch_values)
+            stage.advance(len(batch_values))
 
         # Add the results to the GeoDataFrame
         gdf['height'] = mean_values
@@ -262,32 +709,115 @@ def zonal_statistics(vector_path, ohm, epsg):
         gdf.crs = epsg
 
         # Specify the GeoPackage path
-        geopackage_path = os.path.join(output_folder,'zonal stat.gpkg')
+        output_path = output_path or os.path.join(output_folder,'zonal stat.gpkg')
         # geojson_path = os.path.join(output_folder,'zonal stat.geojson')
 
         # Clean up the data by replacing masked values (NaN) with None
         # gdf = gdf.applymap(lambda x: None if isinstance(x, np.ma.core.MaskedConstant) else x)
 
-        # Save the GeoDataFrame to GeoPackage
-        gdf.to_file(geopackage_path, layer='buildings', driver='GPKG')
-
-def generate_lod1(output):
-    #-- read the input footprints
-    c = fiona.open(os.path.join(output_folder,'zonal stat.gpkg'))
-    print("Number of buildings: ", len(c))
-    lsgeom = [] #-- list of the geometries
-    lsattributes = [] #-- list of the attributes
-    for each in c:
-        lsgeom.append(sg.shape(each['geometry'])) #-- geom are casted to Fiona's 
-        lsattributes.append(each['properties'])
-    #-- extrude to CityJSON
-    cm = output_citysjon(lsgeom, lsattributes)
+        # Save the GeoDataFrame to GeoPackage or GeoParquet
+        vector_io.write_vector(gdf, output_path)
+
+def group_percentile(groups, values, count, q):
+    # q-th percentile (linear interpolation) of the values of every group in 0..count - 1,
+    # NaN for groups without values, and the number of values in every group
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    starts = np.searchsorted(groups, np.arange(count), 'left')
+    sizes = np.searchsorted(groups, np.arange(count), 'right') - starts
+    result = np.full(count, np.nan)
+    filled = sizes > 0
+    position = starts[filled] + (sizes[filled] - 1) * q / 100
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    result[filled] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    return result, sizes
+
+def points_in_polygons(input_file, tree, stage):
+    # Polygon index and z of every point of a cloud falling in a polygon of the tree
+    polygon_index, z_values = [], []
+    for x, y, z in read_las_chunks(input_file, POINT_QUERY_CHUNK_SIZE):
+        checkpoint.check_cancelled()
+        point_index, polygons = tree.query(shapely.points(x, y), predicate="intersects")
+        polygon_index.append(polygons)
+        z_values.append(z[point_index])
+        stage.advance(len(x))
+    return np.concatenate(polygon_index or [np.zeros(0, np.int64)]), np.concatenate(z_values or [np.zeros(0)])
+
+def point_heights(vector_path, ground_las, non_ground_las, epsg, output_folder, output_path=None):
+    # Building heights straight from the classified points: the roof level is a percentile of
+    # the non-ground points inside the footprint, the ground level the median of the ground
+    # points in a ring around it
+    gdf = vector_io.read_vector(vector_path)
+    footprints = gdf.geometry.values
+    rings = shapely.difference(shapely.buffer(footprints, GROUND_RING_WIDTH), footprints)
+
+    point_count = 0
+    for path in (ground_las, non_ground_las):
+        with laspy.open(path) as reader:
+            point_count += reader.header.point_count
+    stage = Progress("heights", point_count, "points")
+
+    roof_index, roof_z = points_in_polygons(non_ground_las, shapely.STRtree(footprints), stage)
+    ground_index, ground_z = points_in_polygons(ground_las, shapely.STRtree(rings), stage)
+    roof, roof_points = group_percentile(roof_index, roof_z, len(gdf), ROOF_PERCENTILE)
+    ground, ground_points = group_percentile(ground_index, ground_z, len(gdf), 50)
+
+    # Add the results to the GeoDataFrame, NaN where a building has no roof or ground points
+    gdf['height'] = roof - ground
+    gdf['ground_z'] = ground
+    gdf['roof_points'] = roof_points
+    gdf.crs = epsg
+    print(f"{int(np.sum(roof_points == 0))} buildings without roof points, {int(np.sum(ground_points == 0))} without ground points")
+
+    # Same output as the zonal statistics, so the LOD1 stage reads it either way
+    vector_io.write_vector(gdf, output_path or os.path.join(output_folder, 'zonal stat.gpkg'))
+
+def generate_lod1(output, output_folder, geopackage_path=None):
+    #-- read the input footprints as columns, missing values as None
+    geopackage_path = geopackage_path or os.path.join(output_folder,'zonal stat.gpkg')
+    gdf = vector_io.read_vector(geopackage_path)
+    print("Number of buildings: ", len(gdf))
+    lsgeom = list(gdf.geometry.values) #-- list of the geometries
+    attributes = gdf.drop(columns=gdf.geometry.name)
+    lsattributes = attributes.astype(object).where(attributes.notna(), None).to_dict('records') #-- list of the attributes
+    #-- extrude to CityJSON in batches of buildings, saving each finished batch
+    batches = checkpoint.batch_folder(output_folder, "lod1", {"footprints": checkpoint.file_signature(geopackage_path)})
+    parts = []
+    stage = Progress("lod1", len(lsgeom), "buildings")
+    for start in range(0, len(lsgeom), LOD1_BATCH_SIZE):
+        checkpoint.check_cancelled()
+        batch_path = os.path.join(batches, f"{start}.json")
+        part = checkpoint.read_json(batch_path)
+        if part is None:
+            part = output_citysjon(lsgeom[start:start + LOD1_BATCH_SIZE], lsattributes[start:start + LOD1_BATCH_SIZE])
+            checkpoint.write_json(batch_path, part)
+        parts.append(part)
+        stage.advance(len(lsgeom[start:start + LOD1_BATCH_SIZE]))
+    cm = merge_citymodels(parts)
     #-- save the file to disk 'mycitymodel.json'
     json_str = json.dumps(cm, indent=2)
-    fout = open(output, "w")
-    fout.write(json_str)
+    with open(output, "w") as fout:
+        fout.write(json_str)
     print("LOD1 City Model Generation Complete!")
 
+def merge_citymodels(parts):
+    #-- join city models built separately, shifting the vertex indices of each part
+    cm = output_citysjon([], [])
+    for part in parts:
+        offset = len(cm["vertices"])
+        for key, cityobject in part["CityObjects"].items():
+            for g in cityobject["geometry"]:
+                g["boundaries"] = shift_indices(g["boundaries"], offset)
+            cm["CityObjects"][key] = cityobject
+        cm["vertices"].extend(part["vertices"])
+    return cm
+
+def shift_indices(boundaries, offset):
+    if isinstance(boundaries, list):
+        return [shift_indices(each, offset) for each in boundaries]
+    return boundaries + offset
+
 def output_citysjon(lsgeom, lsattributes):
     #-- create the JSON data structure for the City Model
     cm = {}
@@ -397,6 +927,21 @@ def extrude_walls(ring, height, allsurfaces, cm):
     allsurfaces.append([[t-4, t-3, t-2, t-1]])
 
 def check_args(args):
+    # A CSF sweep only needs the point cloud
+    if args.sweep_cloth_resolution or args.sweep_slope:
+        if not args.point_cloud:
+            print("Error: A CSF sweep requires --point_cloud.")
+            sys.exit(1)
+        return
+    if not args.building_outline:
+        print("Error: --building_outline is required.")
+        sys.exit(1)
+
+    # Point-based heights need the point cloud
+    if args.height_method == "points" and not args.point_cloud:
+        print("Error: --height_method points requires --point_cloud.")
+        sys.exit(1)
+
     # Ensure that either --point_cloud is provided or both --dsm and --dtm
     if args.point_cloud:
         if args.dsm or args.dtm:
@@ -409,57 +954,275 @@ def check_args(args):
         print("Error: You must provide either --point_cloud or both --dsm and --dtm.")
         sys.exit(1)
 
+def run_pipeline(building_outline, epsg, output_folder, point_cloud=None, dsm=None, dtm=None, cell_size=1.0,
+                 cloth_resolution=2.0, slope=True, output_format="GTiff", compress="DEFLATE", workers=1,
+                 workspace="memory", scratch_dir=None, resume=False, height_method="raster",
+                 simplify_tolerance=SIMPLIFY_TOLERANCE, min_area=MIN_FOOTPRINT_AREA, sliver_ratio=SLIVER_RATIO,
+                 stage_jobs=0, intermediate_format="gpkg", memory_limit=None, max_cores=None):
+    # Ensure that either point_cloud is provided or both dsm and dtm
+    if point_cloud and (dsm or dtm):
+        raise ValueError("If point_cloud is provided, dsm and dtm must not be specified.")
+    if not point_cloud and not (dsm and dtm):
+        raise ValueError("You must provide either point_cloud or both dsm and dtm.")
+    if height_method == "points" and not point_cloud:
+        raise ValueError("Point-based heights require point_cloud.")
+
+    # Create the output folder if it doesn't exist
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    # A fresh run starts without checkpoints, a resumed run skips the stages that
+    # completed with the same parameters
+    if not resume:
+        checkpoint.clear_checkpoints(output_folder)
+
+    # Output directory
+    ground = os.path.join(output_folder, "ground.las")
+    non_ground = os.path.join(output_folder, "non_ground.las")
+    footprints = vector_io.intermediate_path(output_folder, "footprints", intermediate_format)
+    ohm = os.path.join(output_folder, "ohm.tif")
+    lod1 = os.path.join(output_folder, "lod1.json")
+    zonal = vector_io.intermediate_path(output_folder, "zonal stat", intermediate_format)
+    if point_cloud:
+        dtm = os.path.join(output_folder, "dtm.tif")
+        dsm = os.path.join(output_folder, "dsm.tif")
+
+    # Resource hints: memory of the stages holding a point cloud or a DEM grid, and the
+    # processes of the DEM stages
+    cores = workers if workers and workers > 0 else os.cpu_count() or 1
+    filter_memory, dem_memory = stage_memory(*point_cloud_size(point_cloud, cell_size), workspace, cores) if point_cloud else (0, 0)
+
+    # Every stage declares the files it reads and writes, a stage runs once the stages
+    # writing its inputs are done
+    raster_params = {"cell_size": cell_size, "output_format": output_format, "compress": compress}
+    stages = []
+    if point_cloud:
+        points = height_method == "points"
+        stages += [
+            dict(name="filter", title="Filtering Point Cloud",
+                 params={"point_cloud": checkpoint.file_signature(point_cloud), "cloth_resolution": cloth_resolution, "slope": slope, "non_ground": points},
+                 inputs=[point_cloud], outputs=[ground, non_ground] if points else [ground], memory=filter_memory,
+                 run=(csf_filter, (point_cloud, cloth_resolution, slope, output_folder, points))),
+        ]
+    else:
+        print(f"Using provided DSM: {dsm} and DTM: {dtm}")
+
+    # Cleaned footprints feed the heights and the extrusion
+    stages += [
+        dict(name="preprocess", title="Preprocess Footprints",
+             params={"building_outline": checkpoint.file_signature(building_outline), "epsg": epsg,
+                     "tolerance": simplify_tolerance, "min_area": min_area, "sliver_ratio": sliver_ratio},
+             inputs=[building_outline], outputs=[footprints],
+             run=(preprocess_footprints, (building_outline, footprints, epsg, simplify_tolerance, min_area, sliver_ratio))),
+    ]
+
+    if height_method == "points":
+        # Heights from the classified points, without any raster
+        stages += [
+            dict(name="heights", title="Calculate Point Heights",
+                 params={"building_outline": checkpoint.file_signature(building_outline), "epsg": epsg,
+                         "ring_width": GROUND_RING_WIDTH, "roof_percentile": ROOF_PERCENTILE, "height_method": height_method},
+                 inputs=[footprints, ground, non_ground], outputs=[zonal],
+                 memory=BASE_JOB_BYTES + POINT_QUERY_CHUNK_SIZE * BYTES_PER_POINT,
+                 run=(point_heights, (footprints, ground, non_ground, epsg, output_folder, zonal))),
+        ]
+    else:
+        if point_cloud:
+            stages += [
+                dict(name="dtm", title="Generate DTM", params=dict(raster_params, epsg=epsg),
+                     inputs=[ground], outputs=[dtm], memory=dem_memory, cores=cores,
+                     run=(create_dem, (ground, dtm, cell_size, epsg, "DTM", output_format, compress, workers, workspace, scratch_dir))),
+                dict(name="dsm", title="Generate DSM", params=dict(raster_params, epsg=epsg, point_cloud=checkpoint.file_signature(point_cloud)),
+                     inputs=[point_cloud], outputs=[dsm], memory=dem_memory, cores=cores,
+                     run=(create_dem, (point_cloud, dsm, cell_size, epsg, "DSM", output_format, compress, workers, workspace, scratch_dir))),
+            ]
+        stages += [
+            dict(name="ohm", title="OHM Calculation",
+                 params={"dsm": checkpoint.file_signature(dsm), "dtm": checkpoint.file_signature(dtm), "output_format": output_format, "compress": compress},
+                 inputs=[dsm, dtm], outputs=[ohm],
+                 run=(create_ohm, (dsm, dtm, ohm, output_format, compress))),
+            dict(name="zonal", title="Calculate Zonal Statistics",
+                 params={"building_outline": checkpoint.file_signature(building_outline), "epsg": epsg, "height_method": height_method},
+                 inputs=[footprints, ohm], outputs=[zonal],
+                 run=(zonal_statistics, (footprints, ohm, epsg, output_folder, zonal))),
+        ]
+    stages += [
+        dict(name="lod1", title="Create 3D City LOD1", params={"height_method": height_method},
+             inputs=[zonal], outputs=[lod1],
+             run=(generate_lod1, (lod1, output_folder, zonal))),
+    ]
+
+    run_stages(stages, output_folder, resume, stage_jobs, memory_limit, max_cores)
+
+def stage_dependencies(stages):
+    # Names of the stages writing the inputs of every stage
+    producers = {output: stage["name"] for stage in stages for output in stage["outputs"]}
+    return {stage["name"]: {producers[path] for path in stage["inputs"] if path in producers} for stage in stages}
+
+class QueueWriter:
+    # File-like object sending the printed lines of a stage process to the parent
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = ''
+
+    def write(self, text):
+        self.buffer += text
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.lines.put(line + '\n')
+        return len(text)
+
+    def flush(self):
+        pass
+
+def stage_process_init(lines, cancel_event, progress_enabled):
+    # Stage processes print through the parent and share its cancel event
+    sys.stdout = QueueWriter(lines)
+    checkpoint.cancel_event = cancel_event
+    progress.enabled = progress_enabled
+
+def forward_lines(lines):
+    # Print the lines of the stage processes in the parent until None arrives
+    for line in iter(lines.get, None):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+def run_stages(stages, output_folder, resume=False, stage_jobs=0, memory_limit=None, max_cores=None):
+    # Run the stages as a DAG: a stage starts once the stages it depends on are done and it
+    # fits next to the running ones in the cores and memory budget, so independent stages
+    # overlap. A stage whose dependency ran is rerun as well. With stage_jobs 1 the stages
+    # run one after another in this process.
+    dependencies = stage_dependencies(stages)
+    for stage in stages:
+        stage.setdefault("memory", BASE_JOB_BYTES)
+        stage.setdefault("cores", 1)
+    stage_jobs = stage_jobs if stage_jobs and stage_jobs > 0 else min(len(stages), os.cpu_count() or 1)
+    max_cores = max_cores or os.cpu_count() or 1
+    memory_limit = memory_limit or available_memory()
+
+    done, rerun = set(), set()
+    pending = list(stages)
+
+    def skip_finished():
+        # Stages whose dependencies are all done, none of them rerun, and that completed
+        # with the same parameters before
+        skipped = True
+        while skipped:
+            skipped = False
+            for stage in list(pending):
+                name = stage["name"]
+                if (dependencies[name] <= done and resume and not dependencies[name] & rerun
+                        and checkpoint.is_stage_done(output_folder, name, stage["params"])):
+                    print(f"{stage['title']}: already done, skipping")
+                    pending.remove(stage)
+                    done.add(name)
+                    skipped = True
+
+    def finish(stage):
+        checkpoint.mark_stage_done(output_folder, stage["name"], stage["params"], stage["outputs"])
+        done.add(stage["name"])
+        rerun.add(stage["name"])
+
+    if stage_jobs == 1:
+        while pending:
+            skip_finished()
+            ready = [stage for stage in pending if dependencies[stage["name"]] <= done]
+            if not ready:
+                break
+            checkpoint.check_cancelled()
+            stage = ready[0]
+            pending.remove(stage)
+            print(stage["title"])
+            function, args = stage["run"]
+            function(*args)
+            finish(stage)
+        return
+
+    lines = mp.Queue()
+    forwarder = threading.Thread(target=forward_lines, args=(lines,), daemon=True)
+    forwarder.start()
+    running = {}
+    error = None
+    try:
+        with ProcessPoolExecutor(max_workers=stage_jobs, initializer=stage_process_init,
+                                 initargs=(lines, checkpoint.cancel_event, progress.enabled)) as executor:
+            while pending or running:
+                # Start every ready stage that fits, a stage larger than the budget still
+                # runs once nothing else is running
+                if error is None:
+                    skip_finished()
+                    checkpoint.check_cancelled()
+                    for stage in [stage for stage in pending if dependencies[stage["name"]] <= done]:
+                        used_cores = sum(running_stage["cores"] for running_stage in running.values())
+                        used_memory = sum(running_stage["memory"] for running_stage in running.values())
+                        if len(running) >= stage_jobs:
+                            break
+                        if running and (used_cores + stage["cores"] > max_cores or used_memory + stage["memory"] > memory_limit):
+                            continue
+                        pending.remove(stage)
+                        print(stage["title"])
+                        function, args = stage["run"]
+                        running[executor.submit(function, *args)] = stage
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                        finish(stage)
+                    except Exception as e:
+                        # No new stages after a failure, the running ones are waited for
+                        if error is None:
+                            error = e
+    finally:
+        lines.put(None)
+        forwarder.join()
+    if error is not None:
+        raise error
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate LOD1')
     parser.add_argument('--point_cloud', type=str, help='Directory for point cloud data')
     parser.add_argument('--dsm', type=str, help='File path for DSM (Digital Surface Model)')
     parser.add_argument('--dtm', type=str, help='File path for DTM (Digital Terrain Model)')
-    parser.add_argument('--building_outline', type=str, required=True, help='Directory for building vector data')
+    parser.add_argument('--building_outline', type=str, help='Directory for building vector data')
     parser.add_argument('--cell_size', type=float, default=1.0, help='Cell Size for creating DSM and DTM')
     parser.add_argument('--cloth_resolution', type=float, default=2.0, help='Grid size to cover the terrain')
     parser.add_argument('--slope', type=bool, default=True, help='Option to process steep slopes')
+    parser.add_argument('--output_format', type=str, default='GTiff', choices=['GTiff', 'COG'], help='Raster format for DTM, DSM and OHM outputs')
+    parser.add_argument('--compress', type=str, default='DEFLATE', choices=['DEFLATE', 'ZSTD'], help='Compression used for COG outputs')
+    parser.add_argument('--workers', type=int, help='Processes used to build DTM and DSM in row strips (0 for all cores, default 1) or to run a sweep (default as many as cores and memory allow)')
+    parser.add_argument('--workspace', type=str, default='memory', choices=['memory', 'memmap'], help='Keep DEM working grids in memory or in memory-mapped scratch files')
+    parser.add_argument('--scratch_dir', type=str, help='Directory for scratch files (defaults to the output directory)')
+    parser.add_argument('--progress_events', action='store_true', help='Print machine-readable progress lines for each stage')
+    parser.add_argument('--height_method', type=str, default='raster', choices=['raster', 'points'], help='Building heights from DSM/DTM rasters or directly from the classified points')
+    parser.add_argument('--simplify_tolerance', type=float, default=SIMPLIFY_TOLERANCE, help='Distance in map units within which footprint vertices are merged or removed as collinear')
+    parser.add_argument('--min_area', type=float, default=MIN_FOOTPRINT_AREA, help='Footprints smaller than this area are dropped')
+    parser.add_argument('--sliver_ratio', type=float, default=SLIVER_RATIO, help='Footprints less compact than this (4 pi area / perimeter^2) are dropped, 0 keeps all shapes')
+    parser.add_argument('--stage_jobs', type=int, default=0, help='Independent stages run at once in separate processes (0 for as many as fit, 1 runs them in order in this process)')
+    parser.add_argument('--intermediate_format', type=str, default='gpkg', choices=list(vector_io.INTERMEDIATE_FORMATS), help='Format of the footprint and height tables between stages (parquet for GeoParquet)')
+    parser.add_argument('--sweep_cloth_resolution', type=float, nargs='+', help='Only run CSF for every combination of these cloth resolutions and the sweep slopes, keeping the DTM of --cloth_resolution and --slope')
+    parser.add_argument('--sweep_slope', type=lambda value: value.lower() in ('true', '1', 'yes'), nargs='+', help='Slope options of the sweep (true/false, defaults to --slope)')
+    parser.add_argument('--resume', action='store_true', help='Skip stages and batches finished by a previous run with the same parameters')
     parser.add_argument('--epsg', type=int, required=True, help='EPSG code for the data reference system')
     parser.add_argument('--output', type=str, required=True, help='Output directory to save results')
     args = parser.parse_args()
 
     # Validate arguments
     check_args(args)
-    
-    # Define the output folder path
-    output_folder = args.output
-
-    # Create the output folder if it doesn't exist
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    else:
-        pass
-
-    # Output directory
-    ground = os.path.join(output_folder, "ground.las")
-    dtm = os.path.join(output_folder, "dtm.tif")
-    dsm = os.path.join(output_folder, "dsm.tif")
-    ohm = os.path.join(output_folder, "ohm.tif")
-    lod1 = os.path.join(output_folder, "lod1.json")
-
-    if args.point_cloud:
-        print("Filtering Point Cloud")
-        csf_filter(args.point_cloud, args.cloth_resolution, args.slope)
-
-        print("Generate DTM")
-        create_dem(ground, dtm, args.cell_size, args.epsg, "DTM")
-
-        print("Generate DSM")
-        create_dem(args.point_cloud, dsm, args.cell_size, args.epsg, "DSM")
-    else:
-        print(f"Using provided DSM: {args.dsm} and DTM: {args.dtm}")
-        dsm = args.dsm
-        dtm = args.dtm
-    
-    print("OHM Calculation")
-    create_ohm(dsm, dtm, ohm)
-
-    print("Calculate Zonal Statistics")
-    zonal_statistics(args.building_outline, ohm, args.epsg)
-    
-    print("Create 3D City LOD1")
-    generate_lod1(lod1)
\ No newline at end of file
+    progress.enabled = args.progress_events
+
+    if args.sweep_cloth_resolution or args.sweep_slope:
+        csf_sweep(args.point_cloud, args.epsg, args.output, args.sweep_cloth_resolution or [args.cloth_resolution],
+                  args.sweep_slope or [args.slope], args.cloth_resolution, args.slope, args.cell_size,
+                  args.output_format, args.compress, args.workers or 0, args.scratch_dir)
+        sys.exit(0)
+
+    run_pipeline(args.building_outline, args.epsg, args.output, point_cloud=args.point_cloud, dsm=args.dsm, dtm=args.dtm,
+                 cell_size=args.cell_size, cloth_resolution=args.cloth_resolution, slope=args.slope,
+                 output_format=args.output_format, compress=args.compress, workers=1 if args.workers is None else args.workers,
+                 workspace=args.workspace, scratch_dir=args.scratch_dir, resume=args.resume,
+                 height_method=args.height_method, simplify_tolerance=args.simplify_tolerance, min_area=args.min_area,
+                 sliver_ratio=args.sliver_ratio, stage_jobs=args.stage_jobs, intermediate_format=args.intermediate_format)
@@ -0,0 +1,58 @@
+import json
+import time
+
+# Machine-readable progress lines are printed on stdout with this prefix, one JSON
+# object per line, so they pass through the same stream as the log messages
+PROGRESS_PREFIX = "@progress "
+
+# Minimum seconds between two progress lines of the same stage
+PROGRESS_INTERVAL = 0.5
+
+# Progress lines are only printed when enabled, by --progress_events or the worker
+enabled = False
+
+class Progress:
+    # Progress of one stage: fraction done, items per second and ETA
+    def __init__(self, stage, total, unit="items"):
+        self.stage = stage
+        self.total = max(int(total), 1)
+        self.unit = unit
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last = None
+        self.update(0)
+
+    def advance(self, count=1):
+        self.update(self.done + count)
+
+    def update(self, done):
+        self.done = done
+        now = time.perf_counter()
+        if not enabled:
+            return
+        if self.last is not None and done < self.total and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+
+        elapsed = now - self.start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - done) / rate if rate > 0 else None
+        event = {
+            "stage": self.stage,
+            "fraction": round(min(done / self.total, 1.0), 4),
+            "done": done,
+            "total": self.total,
+            "unit": self.unit,
+            "rate": round(rate, 2),
+            "eta": round(eta, 1) if eta is not None else None,
+        }
+        print(PROGRESS_PREFIX + json.dumps(event), flush=True)
+
+def parse_progress(line):
+    # Progress event of a printed line, or None for a regular log line
+    if not line.startswith(PROGRESS_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(PROGRESS_PREFIX):])
+    except ValueError:
+        return None
@@ -0,0 +1,68 @@
+import os
+
+# Rough peak memory of a job: per point while filtering and gridding a cloud, per
+# DEM cell while gap-filling, and a floor for footprints and raster blocks
+BYTES_PER_POINT = 200
+BYTES_PER_CELL = 40
+BASE_JOB_BYTES = 512 * 1024 ** 2
+
+# Points read at a time when the point cloud is streamed
+LAS_CHUNK_SIZE = 5_000_000
+
+# Block size (rows, or tile size for COG) used for raster outputs, which is also the height
+# of the DEM strips of the memmap workspace
+RASTER_BLOCK_SIZE = 512
+
+# Number of gap-fill iterations, the averaging window grows by one cell each iteration.
+# A cell then depends on cells up to FILL_HALO rows away, which is the halo a row
+# strip needs to give the same result as the full grid.
+FILL_ITERATIONS = 15
+FILL_HALO = FILL_ITERATIONS * (FILL_ITERATIONS - 1) // 2
+
+def available_memory():
+    try:
+        import psutil  # pip install psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+def point_cloud_size(point_cloud, cell_size=1.0):
+    # Point count and DEM grid rows and columns from the LAS header only
+    import laspy  # pip install laspy
+
+    with laspy.open(point_cloud) as reader:
+        header = reader.header
+        rows = int((header.maxs[1] - header.mins[1]) / cell_size + 1)
+        cols = int((header.maxs[0] - header.mins[0]) / cell_size + 1)
+        return header.point_count, rows, cols
+
+def stage_memory(point_count, rows, cols, workspace="memory", workers=1):
+    # Memory of the filtering, which holds the whole cloud, and of a DEM stage, which holds
+    # its grid and the whole cloud, or with the memmap workspace one streamed chunk of it and
+    # the strips being built, one per worker, each with its halo above and below
+    filter_memory = BASE_JOB_BYTES + point_count * BYTES_PER_POINT
+    if workspace == "memmap":
+        points = min(point_count, LAS_CHUNK_SIZE)
+        strips = min(workers, -(-rows // RASTER_BLOCK_SIZE))
+        cells = strips * min(rows, RASTER_BLOCK_SIZE + 2 * FILL_HALO) * cols
+    else:
+        points = point_count
+        cells = rows * cols
+    dem_memory = BASE_JOB_BYTES + cells * BYTES_PER_CELL + points * BYTES_PER_POINT
+    return filter_memory, dem_memory
+
+def estimate_job_memory(params):
+    # Peak memory of a job. With concurrent stages the DSM, which depends on no other
+    # stage, runs next to the filtering and then next to the DTM.
+    point_cloud = params.get('point_cloud')
+    if not point_cloud:
+        return BASE_JOB_BYTES
+    workers = params.get('workers', 1)
+    workers = workers if workers and workers > 0 else os.cpu_count() or 1
+    filter_memory, dem_memory = stage_memory(*point_cloud_size(point_cloud, params.get('cell_size', 1.0)),
+                                             params.get('workspace', 'memory'), workers)
+    if params.get('height_method') == 'points':
+        return filter_memory
+    if params.get('stage_jobs', 0) == 1:
+        return max(filter_memory, dem_memory)
+    return dem_memory + max(filter_memory, dem_memory)
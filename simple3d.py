@@ -1,59 +1,120 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout
-from PyQt5.QtGui import QIcon
-from lod1 import CityModelGUI
-from digitizer import DigitizerApp
-from database import database_gui
-from kml import KMLGeneratorApp
+import time
+import argparse
+import importlib
+import traceback
+from PyQt5.QtWidgets import QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QSplashScreen, QLabel, QMessageBox
+from PyQt5.QtGui import QIcon, QPixmap
+from PyQt5.QtCore import Qt
+
+# Tabs in display order: attribute name, tab title, module and widget class. Modules are
+# only imported when their tab is first opened, since some of them pull in GDAL,
+# SQLAlchemy or geopandas.
+TABS = [
+    ("city_model", "City Model Generator", "lod1", "CityModelGUI"),
+    ("digitizer", "Orthophoto Digitizer", "digitizer", "DigitizerApp"),
+    ("database", "Connect Database", "database", "database_gui"),
+    ("kmlgen", "Export 3D KML", "kml", "KMLGeneratorApp"),
+]
 
 class IntegratedApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Simple3D")
         self.setGeometry(100, 100, 1000, 800)
-        
+
+        # Import and build times of each loaded tab, in seconds
+        self.load_times = {}
+
         # Create a tab widget
         self.tabs = QTabWidget()
         self.setCentralWidget(self.tabs)
-        
-        # Create the first tab for the City Model GUI
-        self.city_model_tab = QWidget()
-        self.city_model_layout = QVBoxLayout()
-        self.city_model_widget = CityModelGUI()
-        self.city_model_layout.addWidget(self.city_model_widget)
-        self.city_model_tab.setLayout(self.city_model_layout)
-        self.tabs.addTab(self.city_model_tab, "City Model Generator")
-        
-        # Create the second tab for the Digitizer GUI
-        self.digitizer_tab = QWidget()
-        self.digitizer_layout = QVBoxLayout()
-        self.digitizer_widget = DigitizerApp()
-        self.digitizer_layout.addWidget(self.digitizer_widget)
-        self.digitizer_tab.setLayout(self.digitizer_layout)
-        self.tabs.addTab(self.digitizer_tab, "Orthophoto Digitizer")
-
-        # Create the third tab for connect the database
-        self.database_tab = QWidget()
-        self.database_layout = QVBoxLayout()
-        self.database_widget = database_gui()
-        self.database_layout.addWidget(self.database_widget)
-        self.database_tab.setLayout(self.database_layout)
-        self.tabs.addTab(self.database_tab, "Connect Database")
-
-        # Create the fourth tab for export as KML
-        self.kmlgen_tab = QWidget()
-        self.kmlgen_layout = QVBoxLayout()
-        self.kmlgen_widget = KMLGeneratorApp()
-        self.kmlgen_layout.addWidget(self.kmlgen_widget)
-        self.kmlgen_tab.setLayout(self.kmlgen_layout)
-        self.tabs.addTab(self.kmlgen_tab, "Export 3D KML")
-        
+
+        # Create an empty page for every tab, the widget is built on first activation
+        for name, title, module_name, class_name in TABS:
+            tab = QWidget()
+            tab.setLayout(QVBoxLayout())
+            setattr(self, f"{name}_tab", tab)
+            setattr(self, f"{name}_widget", None)
+            setattr(self, f"{name}_error", None)
+            self.tabs.addTab(tab, title)
+
+        self.tabs.currentChanged.connect(self.load_tab)
+
+        # Build the tab shown at startup
+        self.load_tab(self.tabs.currentIndex())
+
         # Set the window icon
         self.setWindowIcon(QIcon("ui/logo.png"))
 
+    def load_tab(self, index):
+        name, title, module_name, class_name = TABS[index]
+        if getattr(self, f"{name}_widget") is not None or getattr(self, f"{name}_error") is not None:
+            return
+
+        # An exception must not leave this slot, PyQt aborts on it. A tab that fails to load,
+        # for example without an optional dependency such as GDAL, keeps a placeholder.
+        self.statusBar().showMessage(f"Loading {title}...")
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        error = None
+        try:
+            start = time.perf_counter()
+            module = importlib.import_module(module_name)
+            imported = time.perf_counter()
+            widget = getattr(module, class_name)()
+            built = time.perf_counter()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+        finally:
+            QApplication.restoreOverrideCursor()
+            self.statusBar().clearMessage()
+        if error is not None:
+            setattr(self, f"{name}_error", error)
+            placeholder = QLabel(f"{title} could not be loaded.\n\n{error}")
+            placeholder.setAlignment(Qt.AlignCenter)
+            placeholder.setWordWrap(True)
+            getattr(self, f"{name}_tab").layout().addWidget(placeholder)
+            QMessageBox.critical(self, "Error", f"Failed to load {title}: {error}")
+            return
+
+        getattr(self, f"{name}_tab").layout().addWidget(widget)
+        setattr(self, f"{name}_widget", widget)
+        self.load_times[module_name] = (imported - start, built - imported)
+
+    def load_all_tabs(self):
+        for index in range(len(TABS)):
+            self.load_tab(index)
+
+def print_import_report(app_start, window_shown, load_times):
+    # Time to first window and import/build time of every tab
+    print(f"{'module':<12}{'import (s)':>12}{'build (s)':>12}")
+    for module_name, (import_time, build_time) in load_times.items():
+        print(f"{module_name:<12}{import_time:>12.3f}{build_time:>12.3f}")
+    print(f"Time to first window: {window_shown - app_start:.3f} s")
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    app_start = time.perf_counter()
+    parser = argparse.ArgumentParser(description='Simple3D')
+    parser.add_argument('--import-report', action='store_true', help='Load every tab, print import times and exit')
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_args)
+
+    # Splash screen while the first tab is loading
+    splash = QSplashScreen(QPixmap("ui/logo.png"))
+    splash.showMessage("Loading Simple3D...", Qt.AlignBottom | Qt.AlignHCenter)
+    splash.show()
+    app.processEvents()
+
     main_window = IntegratedApp()
     main_window.show()
+    splash.finish(main_window)
+    window_shown = time.perf_counter()
+
+    if args.import_report:
+        main_window.load_all_tabs()
+        print_import_report(app_start, window_shown, main_window.load_times)
+        sys.exit(0)
+
     sys.exit(app.exec_())
@@ -0,0 +1,41 @@
+import os
+import geopandas as gpd #pip install geopandas
+
+# Formats of the intermediate footprint and result tables, by file extension. GeoParquet
+# is columnar and reads and writes fastest, GeoPackage opens in any GIS.
+INTERMEDIATE_FORMATS = {"gpkg": ".gpkg", "parquet": ".parquet"}
+
+def arrow_available():
+    # Arrow batches need pyogrio and pyarrow, otherwise OGR features are read one by one
+    try:
+        import pyogrio  # pip install pyogrio
+        import pyarrow  # pip install pyarrow
+        return True
+    except ImportError:
+        return False
+
+def is_parquet(path):
+    return os.path.splitext(path)[1].lower() in (".parquet", ".geoparquet")
+
+def intermediate_path(folder, name, intermediate_format="gpkg"):
+    return os.path.join(folder, name + INTERMEDIATE_FORMATS[intermediate_format])
+
+def read_vector(path, layer=None, columns=None):
+    # Whole table as a GeoDataFrame, as Arrow columns rather than per feature
+    if is_parquet(path):
+        return gpd.read_parquet(path, columns=columns + ["geometry"] if columns else None)
+    if arrow_available():
+        return gpd.read_file(path, layer=layer, columns=columns, engine="pyogrio", use_arrow=True)
+    return gpd.read_file(path, layer=layer, columns=columns)
+
+def write_vector(gdf, path, layer="buildings"):
+    # GeoParquet for .parquet paths, otherwise an OGR file (GeoPackage for .gpkg) written
+    # from Arrow columns in one transaction
+    if is_parquet(path):
+        gdf.to_parquet(path)
+        return
+    driver = "GPKG" if path.lower().endswith(".gpkg") else None
+    if arrow_available():
+        gdf.to_file(path, layer=layer, driver=driver, engine="pyogrio", use_arrow=True)
+    else:
+        gdf.to_file(path, layer=layer, driver=driver)
@@ -0,0 +1,254 @@
+import argparse
+import ipaddress
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import secrets
+import socket
+import sys
+import threading
+import traceback
+import checkpoint
+from progress import parse_progress
+from multiprocessing.connection import Client, Listener
+
+# Default address of the standalone worker used by batch scripts. Jobs arrive pickled, so
+# the worker only listens on loopback unless remote clients are allowed explicitly.
+DEFAULT_ADDRESS = ('localhost', 6543)
+
+# Random key of this install shared by the worker and its clients, readable by the
+# user only, next to the connection profiles
+AUTHKEY_PATH = os.path.join(os.path.expanduser("~"), ".simple3d", "worker.key")
+AUTHKEY_BYTES = 32
+
+# Seconds the GUI worker gets to stop after cancelling its job before it is terminated
+STOP_TIMEOUT = 10
+
+# Event kinds that end a job
+FINISHED = ('done', 'error', 'cancelled')
+
+class EventWriter:
+    # File-like object that forwards every printed line as a log event, safe to write
+    # from the thread forwarding the output of stage processes
+    def __init__(self, emit, kind):
+        self.emit = emit
+        self.kind = kind
+        self.buffer = ''
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.buffer += text
+            while '\n' in self.buffer:
+                line, self.buffer = self.buffer.split('\n', 1)
+                if line.strip():
+                    self.emit_line(line.rstrip())
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            if self.buffer.strip():
+                self.emit_line(self.buffer.rstrip())
+            self.buffer = ''
+
+    def emit_line(self, line):
+        # Progress lines become progress events carrying the parsed dict
+        event = parse_progress(line)
+        if event is not None:
+            self.emit('progress', event)
+        else:
+            self.emit(self.kind, line)
+
+def load_authkey(path=AUTHKEY_PATH):
+    # Key of this install, created on first use with owner-only permissions
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    key = secrets.token_bytes(AUTHKEY_BYTES)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Created by another process in the meantime
+        with open(path, 'rb') as f:
+            return f.read()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+def is_loopback(host):
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback for info in socket.getaddrinfo(host, None))
+    except (socket.gaierror, ValueError):
+        return False
+
+def run_job(params, emit):
+    # Run one pipeline job with its output sent as events, the heavy modules are
+    # only imported by the first job of the process
+    import progress
+    progress.enabled = True
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = EventWriter(emit, 'log')
+    sys.stderr = EventWriter(emit, 'stderr')
+    try:
+        import main
+        main.run_pipeline(**params)
+        status = ('done', None)
+    except checkpoint.PipelineCancelled as e:
+        status = ('cancelled', str(e))
+    except Exception:
+        status = ('error', traceback.format_exc())
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr = stdout, stderr
+    emit(*status)
+
+def worker_loop(jobs, events, cancel_event):
+    # Warm up the imports before the first job arrives
+    import main
+
+    checkpoint.cancel_event = cancel_event
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, params = job
+        cancel_event.clear()
+        run_job(params, lambda kind, message: events.put((job_id, kind, message)))
+
+class PipelineWorker:
+    # Long-lived process running pipeline jobs from a queue, used by the GUI
+    def __init__(self):
+        self.context = mp.get_context('spawn')
+        self.process = None
+        self.listeners = {}
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+
+    def start(self):
+        if self.process is not None and self.process.is_alive():
+            return
+        self.jobs = self.context.Queue()
+        self.events = self.context.Queue()
+        self.cancel_event = self.context.Event()
+        self.process = self.context.Process(target=worker_loop, args=(self.jobs, self.events, self.cancel_event))
+        self.process.start()
+        self.dispatcher = threading.Thread(target=self.dispatch, args=(self.process, self.events), daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, params):
+        self.start()
+        job_id = next(self.job_ids)
+        with self.lock:
+            self.listeners[job_id] = queue.Queue()
+        self.jobs.put((job_id, params))
+        return job_id
+
+    def job_events(self, job_id):
+        # Yield (kind, message) events of a job until it is done or failed
+        listener = self.listeners[job_id]
+        while True:
+            kind, message = listener.get()
+            yield kind, message
+            if kind in FINISHED:
+                with self.lock:
+                    del self.listeners[job_id]
+                return
+
+    def dispatch(self, process, events):
+        # Route events to the job that emitted them
+        while True:
+            try:
+                item = events.get(timeout=1)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # Fail the pending jobs if the worker died, the next submit restarts it
+                with self.lock:
+                    for listener in self.listeners.values():
+                        listener.put(('error', f'Worker process exited with code {process.exitcode}'))
+                return
+            if item is None:
+                return
+            job_id, kind, message = item
+            with self.lock:
+                listener = self.listeners.get(job_id)
+            if listener is not None:
+                listener.put((kind, message))
+
+    def cancel(self):
+        # Stop the running job at its next batch, the pipeline raises PipelineCancelled
+        if self.process is not None:
+            self.cancel_event.set()
+
+    def stop(self):
+        # Cancel the running job and give it a moment to stop at its next batch, a job
+        # that does not stop in time is terminated
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.cancel_event.set()
+            self.jobs.put(None)
+            self.process.join(STOP_TIMEOUT)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.events.put(None)
+        self.dispatcher.join()
+        self.process = None
+
+def serve(address=DEFAULT_ADDRESS, authkey=None, allow_remote=False):
+    # Standalone worker: clients send job parameters over a local connection, jobs are
+    # queued and run one at a time in this process, events go back to each client
+    if not allow_remote and not is_loopback(address[0]):
+        raise ValueError(f"Refusing to listen on {address[0]}, a non-loopback host needs allow_remote.")
+    authkey = authkey or load_authkey()
+    import main
+
+    jobs = queue.Queue()
+
+    def accept(listener):
+        while True:
+            conn = listener.accept()
+            jobs.put((conn, conn.recv()))
+
+    listener = Listener(address, authkey=authkey)
+    threading.Thread(target=accept, args=(listener,), daemon=True).start()
+    print(f"Worker listening on {address[0]}:{address[1]}")
+
+    while True:
+        conn, params = jobs.get()
+
+        def send(kind, message):
+            try:
+                conn.send((kind, message))
+            except (EOFError, OSError):
+                # Client went away, the job still runs to completion
+                pass
+
+        run_job(params, send)
+        conn.close()
+
+def submit_job(params, address=DEFAULT_ADDRESS, authkey=None):
+    # Send a job to a standalone worker and yield its (kind, message) events
+    with Client(address, authkey=authkey or load_authkey()) as conn:
+        conn.send(params)
+        while True:
+            kind, message = conn.recv()
+            yield kind, message
+            if kind in FINISHED:
+                return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simple3D pipeline worker')
+    parser.add_argument('--host', type=str, default=DEFAULT_ADDRESS[0], help='Host to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1], help='Port to listen on')
+    parser.add_argument('--allow_remote', action='store_true', help='Allow a non-loopback host (anyone holding the key of this install can run code here)')
+    args = parser.parse_args()
+
+    serve((args.host, args.port), allow_remote=args.allow_remote)